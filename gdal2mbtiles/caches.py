@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# Licensed to Ecometrica under one or more contributor license
+# agreements.  See the NOTICE file distributed with this work
+# for additional information regarding copyright ownership.
+# Ecometrica licenses this file to you under the Apache
+# License, Version 2.0 (the "License"); you may not use this
+# file except in compliance with the License.  You may obtain a
+# copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import errno
+import logging
+import os
+from tempfile import mkstemp, NamedTemporaryFile
+
+from .utils import intmd5, makedirs, rmfile
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class TileCache(object):
+    """
+    Cache of rendered tiles on disk, that persists across runs.
+
+    Tiles are stored in `directory` by a key made of the content hash of the
+    image and the settings of the renderer, so reruns over the same pixels
+    skip rendering entirely.
+
+    directory: Where the rendered tiles are stored. Created if missing.
+    max_size: Remove the least recently used tiles once the cache grows
+              beyond this many bytes. Defaults to no limit.
+    """
+
+    # Fraction of max_size to evict down to, so that eviction doesn't run
+    # again on the very next tile.
+    EVICT_RATIO = 0.9
+
+    def __init__(self, directory, max_size=None):
+        if max_size is not None and max_size < 0:
+            raise ValueError(
+                'max_size must be positive: {0!r}'.format(max_size)
+            )
+        self.max_size = max_size
+
+        self.directory = directory
+        makedirs(self.directory, ignore_exists=True)
+        self._size = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return 'TileCache(directory={directory!r})'.format(**self.__dict__)
+
+    @classmethod
+    def key(cls, hashed, renderer):
+        """
+        Returns the key of an image with content hash `hashed`, rendered by
+        `renderer`.
+        """
+        settings = intmd5(renderer.settings.encode('utf-8'))
+        return '{0:032x}-{1:032x}'.format(hashed, settings)
+
+    def filepath(self, key):
+        """Returns the path of the tile stored under `key`."""
+        # Spread tiles over subdirectories to keep directory listings short
+        return os.path.join(self.directory, key[:2], key)
+
+    @property
+    def size(self):
+        """Returns the total size of the cached tiles, in bytes."""
+        if self._size is None:
+            self._size = sum(size for _, _, size in self._files())
+        return self._size
+
+    def get(self, key):
+        """Returns the tile stored under `key`, or None."""
+        filepath = self.filepath(key)
+        try:
+            with open(filepath, 'rb') as f:
+                contents = f.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return None
+
+        # Mark the tile as recently used for eviction
+        try:
+            os.utime(filepath, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.hits += 1
+        return contents
+
+    def put(self, key, contents):
+        """Stores the tile `contents` under `key`."""
+        filepath = self.filepath(key)
+        dirname = os.path.dirname(filepath)
+        makedirs(dirname, ignore_exists=True)
+
+        # Write atomically, so that concurrent runs never read partial tiles
+        with NamedTemporaryFile(dir=dirname, prefix='.', delete=False) as f:
+            f.write(contents)
+        os.rename(f.name, filepath)
+
+        if self._size is not None:
+            self._size += len(contents)
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict(self.max_size * self.EVICT_RATIO)
+
+    def evict(self, size):
+        """Removes the least recently used tiles, down to `size` bytes."""
+        files = sorted(self._files())
+        total = sum(s for _, _, s in files)
+        for _, filepath, s in files:
+            if total <= size:
+                break
+            rmfile(filepath, ignore_missing=True)
+            total -= s
+        logger.debug(
+            'Evicted tiles from {0}, down to {1} bytes'.format(self.directory,
+                                                               total)
+        )
+        self._size = total
+
+    def _files(self):
+        """Generator of (mtime, filepath, size) for the cached tiles."""
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                filepath = os.path.join(root, name)
+                try:
+                    stat = os.stat(filepath)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                yield stat.st_mtime, filepath, stat.st_size
+
+
+class WarpCache(TileCache):
+    """
+    Cache of warped GeoTIFFs on disk, that persists across runs.
+
+    GeoTIFFs are stored in `directory` by a key made of the identity of the
+    input file and the warp settings, so that rendering the same input again,
+    with a different coloring or renderer, skips warping entirely.
+
+    Unlike TileCache, it holds filenames instead of contents, since warped
+    images can be much larger than memory.
+
+    directory: Where the warped GeoTIFFs are stored. Created if missing.
+    max_size: Remove the least recently used GeoTIFFs once the cache grows
+              beyond this many bytes. Defaults to no limit.
+    """
+
+    def __str__(self):
+        return 'WarpCache(directory={directory!r})'.format(**self.__dict__)
+
+    @classmethod
+    def key(cls, inputfile, **settings):
+        """
+        Returns the key of `inputfile` warped with `settings`.
+
+        The input is identified by its path, size and modification time, so
+        that changing it in place invalidates its GeoTIFFs.
+
+        settings: Everything that changes the warped output, like the band,
+                  spatial reference, resampling and GDAL version.
+        """
+        stat = os.stat(inputfile)
+        identity = [os.path.abspath(inputfile), stat.st_size, stat.st_mtime]
+        identity.extend(sorted((k, repr(v)) for k, v in settings.items()))
+        return '{0:032x}'.format(intmd5(repr(identity).encode('utf-8')))
+
+    def filepath(self, key):
+        """Returns the path of the GeoTIFF stored under `key`."""
+        return os.path.join(self.directory, key[:2], key + '.tif')
+
+    def mktemp(self):
+        """
+        Returns the filename of a new temporary file in the cache to warp
+        into, so that `put` can move it in without copying. It is ignored
+        until then.
+        """
+        fd, filename = mkstemp(dir=self.directory, prefix='.', suffix='.tif')
+        os.close(fd)
+        return filename
+
+    def get(self, key):
+        """Returns the filename of the GeoTIFF stored under `key`, or None."""
+        filepath = self.filepath(key)
+        # Mark the GeoTIFF as recently used for eviction
+        try:
+            os.utime(filepath, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return None
+        self.hits += 1
+        return filepath
+
+    def put(self, key, filename):
+        """
+        Moves the GeoTIFF `filename` into the cache under `key`, and returns
+        its new filename.
+
+        filename must be on the same filesystem as the cache. See `mktemp`.
+
+        Eviction makes room for it first, so it is kept even if it is larger
+        than max_size on its own.
+        """
+        filepath = self.filepath(key)
+        makedirs(os.path.dirname(filepath), ignore_exists=True)
+
+        size = os.stat(filename).st_size
+        if self.max_size is not None and self.size + size > self.max_size:
+            self.evict(max(self.max_size * self.EVICT_RATIO - size, 0))
+        os.rename(filename, filepath)
+
+        if self._size is not None:
+            self._size += size
+        return filepath
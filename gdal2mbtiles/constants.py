@@ -33,5 +33,3 @@ TILE_SIDE = 256                 # in pixels
 
 # Command-line programs
 GDALINFO = 'gdalinfo'
-GDALTRANSLATE = 'gdal_translate'
-GDALWARP = 'gdalwarp'
@@ -23,13 +23,12 @@ from __future__ import (absolute_import, division, print_function,
 # Make sure we are using the python 3 version of round in both python 2 and 3
 from builtins import round
 
+import errno
 from functools import partial
 import logging
 from math import pi
 from itertools import count
 import os
-import re
-from subprocess import CalledProcessError, check_output, Popen, PIPE
 from tempfile import NamedTemporaryFile
 from xml.etree import ElementTree
 
@@ -51,7 +50,7 @@ osr.UseExceptions()             # And OSR as well.
 
 
 from .constants import (EPSG_WEB_MERCATOR, ESRI_102113_PROJ, ESRI_102100_PROJ,
-                        GDALTRANSLATE, GDALWARP, TILE_SIDE)
+                        TILE_SIDE)
 from .exceptions import (GdalError, CalledGdalError, UnalignedInputError,
                          UnknownResamplingMethodError)
 from .gd_types import Extents, GdalFormat, XY
@@ -71,20 +70,24 @@ RESAMPLING_METHODS = {
 }
 
 
-def check_output_gdal(*popenargs, **kwargs):
-    p = Popen(stderr=PIPE, stdout=PIPE, *popenargs, **kwargs)
-    stdoutdata, stderrdata = p.communicate()
-    if p.returncode:
-        cmd = kwargs.get("args")
-        if cmd is None:
-            cmd = popenargs[0]
-        raise CalledGdalError(p.returncode, cmd, output=stdoutdata,
-                              error=stderrdata.decode('utf-8').rstrip('\n'))
-    return stdoutdata
-
-
 def preprocess(inputfile, outputfile, band=None, spatial_ref=None,
-               resampling=None, compress=None, **kwargs):
+               resampling=None, compress=None, cache=None, threads=None,
+               working_memory=None, **kwargs):
+    """
+    Extracts `band` of a GDAL-readable inputfile and warps it to
+    `spatial_ref`, rendering outputfile. See `pipeline`.
+
+    Returns the filename of the result, which is inputfile itself if there is
+    nothing to do.
+
+    cache: `caches.WarpCache` of rendered GeoTIFFs, shared across runs. The
+           GeoTIFF is then rendered into the cache instead of outputfile,
+           and reused without warping when the same input is preprocessed
+           with the same settings again.
+    threads: Number of threads to warp with. See `warp`.
+    working_memory: Size of the warp buffer and of GDAL's block cache while
+                    rendering, in MiB each. See `warp` and `VRT.render`.
+    """
     functions = []
     dataset = Dataset(inputfile)
 
@@ -106,9 +109,14 @@ def preprocess(inputfile, outputfile, band=None, spatial_ref=None,
         functions.append(
             ('Reprojecting to EPSG:{0}'.format(spatial_ref.GetEPSGCode()),
              partial(warp,
-                     spatial_ref=spatial_ref, resampling=resampling))
+                     spatial_ref=spatial_ref, resampling=resampling,
+                     threads=threads, working_memory=working_memory))
         )
 
+    # Also size the block cache for `VRT.render`
+    if working_memory is not None:
+        kwargs['working_memory'] = working_memory
+
     if not functions:
         # No work needs to be done, so just symlink the outputfile to inputfile
         rmfile(outputfile, ignore_missing=True)
@@ -116,8 +124,27 @@ def preprocess(inputfile, outputfile, band=None, spatial_ref=None,
         os.symlink(srcfile, outputfile)
         return inputfile
 
-    return pipeline(inputfile=inputfile, outputfile=outputfile,
-                    functions=functions, compress=compress, **kwargs)
+    if cache is None:
+        return pipeline(inputfile=inputfile, outputfile=outputfile,
+                        functions=functions, compress=compress, **kwargs)
+
+    if spatial_ref is not None:
+        spatial_ref = spatial_ref.ExportToWkt()
+    key = cache.key(inputfile, band=band, spatial_ref=spatial_ref,
+                    resampling=resampling, compress=compress,
+                    gdal=gdal.VersionInfo())
+    cached = cache.get(key)
+    if cached is not None:
+        logger.debug('Reusing {0} warped in {1}'.format(inputfile, cache))
+        return cached
+
+    tmpfile = cache.mktemp()
+    try:
+        pipeline(inputfile=inputfile, outputfile=tmpfile,
+                 functions=functions, compress=compress, **kwargs)
+        return cache.put(key, tmpfile)
+    finally:
+        rmfile(tmpfile, ignore_missing=True)
 
 
 def pipeline(inputfile, outputfile, functions, **kwargs):
@@ -126,6 +153,10 @@ def pipeline(inputfile, outputfile, functions, **kwargs):
 
     Functions must be an iterable of single-parameter functions that take a
     filename as input.
+
+    Intermediate VRTs are kept in GDAL's in-memory filesystem, so the whole
+    pipeline runs in this process without touching the disk until the
+    outputfile is rendered.
     """
     if not functions:
         raise ValueError('Must have at least one function')
@@ -136,7 +167,7 @@ def pipeline(inputfile, outputfile, functions, **kwargs):
         for name, f in functions:
             logging.debug(name)
             vrt = f(previous)
-            current = vrt.get_tempfile(suffix='.vrt', prefix='gdal')
+            current = vrt.get_vsimem(suffix='.vrt', prefix='gdal')
             tmpfiles.append(current)
             previous = current.name
         logging.info('Rendering reprojected image')
@@ -146,6 +177,37 @@ def pipeline(inputfile, outputfile, functions, **kwargs):
             f.close()
 
 
+def run_gdal(function, destination, source, options, **kwargs):
+    """
+    Runs a GDAL utility in-process, like `gdal.Translate` or `gdal.Warp`.
+
+    function: GDAL utility function.
+    destination: Filename to write to, usually under /vsimem/.
+    source: GDAL-readable filename. Relative filenames are made absolute,
+            since VRTs under /vsimem/ can't resolve them.
+    options: List of command-line options for the utility.
+    kwargs: Other keyword arguments for `function`, like `callback`.
+
+    The output dataset is closed, so that it is flushed to `destination`.
+
+    Raises CalledGdalError if GDAL fails.
+    """
+    if not source.startswith('/vsi'):
+        source = os.path.abspath(source)
+    options = [str(e) for e in options]
+    try:
+        dataset = function(destination, source, options=options, **kwargs)
+    except RuntimeError as e:
+        raise CalledGdalError(1, [function.__name__] + options,
+                              error=str(e))
+    if dataset is None:
+        raise CalledGdalError(1, [function.__name__] + options,
+                              error=gdal.GetLastErrorMsg())
+    # Dereferencing the dataset closes it
+    dataset = None
+    return destination
+
+
 def extract_color_band(inputfile, band):
     """
     Takes an inputfile (probably a VRT) and generates a single-band VRT.
@@ -156,40 +218,59 @@ def extract_color_band(inputfile, band):
             "band must be between 1 and {0}".format(dataset.RasterCount)
         )
 
-    command = [
-        GDALTRANSLATE,
-        '-q',                   # Quiet
+    options = [
         '-of', 'VRT',           # Output to VRT
         '-b', band,             # Single band
-        inputfile,
-        '/vsistdout'
     ]
-    try:
-        return VRT(check_output_gdal([str(e) for e in command]))
-    except CalledGdalError as e:
-        if e.error == ("ERROR 6: Read or update mode not supported on /vsistdout"):
-            # HACK: WTF?!?
-            return VRT(e.output)
-        raise
+    with VsiMemFile(suffix='.vrt', prefix='gdalband') as outputfile:
+        run_gdal(gdal.Translate, outputfile.name, inputfile, options)
+        return VRT(outputfile.read())
+
+
+def extract_window(inputfile, xoff, yoff, xsize, ysize):
+    """
+    Takes an inputfile and generates a VRT of the window of `xsize` by
+    `ysize` pixels at offset (`xoff`, `yoff`), georeferenced where it lies.
+    """
+    dataset = Dataset(inputfile)
+    if not (0 <= xoff and 0 < xsize and xoff + xsize <= dataset.RasterXSize
+            and 0 <= yoff and 0 < ysize and
+            yoff + ysize <= dataset.RasterYSize):
+        raise ValueError(
+            'window {0!r} must be within {1}x{2} pixels'.format(
+                (xoff, yoff, xsize, ysize),
+                dataset.RasterXSize, dataset.RasterYSize
+            )
+        )
+
+    options = [
+        '-of', 'VRT',           # Output to VRT
+        '-srcwin', xoff, yoff, xsize, ysize,
+    ]
+    with VsiMemFile(suffix='.vrt', prefix='gdalwindow') as outputfile:
+        run_gdal(gdal.Translate, outputfile.name, inputfile, options)
+        return VRT(outputfile.read())
 
 
-def warp(inputfile, spatial_ref=None, cmd=GDALWARP, resampling=None,
-         maximum_resolution=None):
+def warp(inputfile, spatial_ref=None, resampling=None,
+         maximum_resolution=None, threads=None, working_memory=None):
     """
     Takes an GDAL-readable inputfile and generates the VRT to warp it.
+
+    threads: Number of threads to warp with. Defaults to the number of CPUs.
+    working_memory: Size of the warp buffer, in MiB. Defaults to GDAL's
+                    default, 64 MiB as of GDAL 2.
     """
     dataset = Dataset(inputfile)
 
-    warp_cmd = [
-        cmd,
-        '-q',                   # Quiet - FIXME: Use logging
+    options = [
         '-of', 'VRT',           # Output to VRT
     ]
 
     # Warping to Mercator.
     if spatial_ref is None:
         spatial_ref = SpatialReference.FromEPSG(EPSG_WEB_MERCATOR)
-    warp_cmd.extend(['-t_srs', spatial_ref.GetEPSGString()])
+    options.extend(['-t_srs', spatial_ref.GetEPSGString()])
 
     # Resampling method
     if resampling is not None:
@@ -200,80 +281,98 @@ def warp(inputfile, spatial_ref=None, cmd=GDALWARP, resampling=None,
                 raise UnknownResamplingMethodError(resampling)
         elif resampling not in list(RESAMPLING_METHODS.values()):
             raise UnknownResamplingMethodError(resampling)
-        warp_cmd.extend(['-r', resampling])
+        options.extend(['-r', resampling])
 
     # Propagate No Data Value
     nodata_values = [dataset.GetRasterBand(i).GetNoDataValue()
                      for i in range(1, dataset.RasterCount + 1)]
     if any(nodata_values):
         nodata_values = [str(v).lower() for v in nodata_values]
-        warp_cmd.extend(['-dstnodata', ' '.join(nodata_values)])
+        options.extend(['-dstnodata', ' '.join(nodata_values)])
 
-    # Call gdalwarp
-    warp_cmd.extend([inputfile, '/vsistdout'])
+    # Warp with several threads. The VRT keeps NUM_THREADS, so it applies
+    # whenever the VRT is read.
+    if threads is None:
+        threads = 'ALL_CPUS'
+    options.extend(['-multi', '-wo', 'NUM_THREADS={0}'.format(threads)])
 
-    try:
-        return VRT(check_output_gdal([str(e) for e in warp_cmd]))
-    except CalledGdalError as e:
-        if e.error == ("ERROR 6: Read or update mode not supported on /vsistdout"):
-            return VRT(e.output)
-        raise
+    # Working memory, in bytes since GDAL reads small numbers as MB
+    if working_memory is not None:
+        options.extend(['-wm', working_memory * 1024 * 1024])
 
+    with VsiMemFile(suffix='.vrt', prefix='gdalwarp') as outputfile:
+        run_gdal(gdal.Warp, outputfile.name, inputfile, options)
+        return VRT(outputfile.read())
 
-def supported_formats(cmd=GDALWARP):
+
+def supported_formats():
+    """
+    Returns a GdalFormat for each raster driver registered with GDAL, with
+    the attributes that `gdalwarp --formats` lists.
+    """
     if supported_formats._cache is None:
-        result = None
-        output = check_output([cmd, '--formats'])
-        for line in output.splitlines():
-            # Look for the header
-            if result is None:
-                if line == 'Supported Formats:':
-                    result = []
+        result = []
+        for i in range(gdal.GetDriverCount()):
+            driver = gdal.GetDriver(i)
+            metadata = driver.GetMetadata() or {}
+            if metadata.get(gdal.DCAP_RASTER) != 'YES':
                 continue
 
-            m = supported_formats.format_re.match(line)
-            if m:
-                attributes = frozenset(m.group('attributes'))
-                result.append(GdalFormat(can_read=('r' in attributes),
-                                         can_write=('w' in attributes),
-                                         can_update=('+' in attributes),
-                                         has_virtual_io=('v' in attributes),
-                                         **m.groupdict()))
+            can_read = metadata.get(gdal.DCAP_OPEN) == 'YES'
+            can_update = metadata.get(gdal.DCAP_CREATE) == 'YES'
+            can_write = (can_update or
+                         metadata.get(gdal.DCAP_CREATECOPY) == 'YES')
+            has_virtual_io = metadata.get(gdal.DCAP_VIRTUALIO) == 'YES'
+            attributes = ''.join(
+                flag for flag, present in [('r', can_read),
+                                           ('w', can_write),
+                                           ('+', can_update),
+                                           ('v', has_virtual_io)]
+                if present
+            )
+            result.append(GdalFormat(name=driver.ShortName,
+                                     attributes=attributes,
+                                     description=driver.LongName,
+                                     can_read=can_read,
+                                     can_write=can_write,
+                                     can_update=can_update,
+                                     has_virtual_io=has_virtual_io))
 
         supported_formats._cache = result
 
     return supported_formats._cache
-supported_formats.format_re = re.compile(r'\s+(?P<name>.+?)'
-                                         r'\s+\((?P<attributes>.+?)\):'
-                                         r'\s+(?P<description>.*)$')
 supported_formats._cache = None
 
 
-def resampling_methods(cmd=GDALWARP):
+def resampling_methods():
+    """
+    Returns the names of the resampling methods that GDAL can warp with, as
+    passed to `warp`.
+    """
     if resampling_methods._cache is None:
-        result = None
-        try:
-            output = check_output([cmd, '--help'])
-        except CalledProcessError as e:
-            if e.returncode == 1 and e.output is not None:
-                output = e.output
-            else:
-                raise
-
-        for line in output.splitlines():
-            # Look for the header
-            if result is None:
-                if line == 'Available resampling methods:':
-                    result = []
-                continue
-
-            result.extend(m.strip(' \t.').split()[0] for m in line.split(','))
-            if line.endswith('.'):
-                break
-
-        resampling_methods._cache = result
-
+        resampling_methods._cache = [
+            name for constant, name in resampling_methods.constants
+            if hasattr(gdalconst, constant)
+        ]
     return resampling_methods._cache
+# gdalconst constants of each resampling method, since older versions of
+# GDAL lack some of them.
+resampling_methods.constants = [
+    ('GRA_NearestNeighbour', 'near'),
+    ('GRA_Bilinear', 'bilinear'),
+    ('GRA_Cubic', 'cubic'),
+    ('GRA_CubicSpline', 'cubicspline'),
+    ('GRA_Lanczos', 'lanczos'),
+    ('GRA_Average', 'average'),
+    ('GRA_RMS', 'rms'),
+    ('GRA_Mode', 'mode'),
+    ('GRA_Max', 'max'),
+    ('GRA_Min', 'min'),
+    ('GRA_Med', 'med'),
+    ('GRA_Q1', 'q1'),
+    ('GRA_Q3', 'q3'),
+    ('GRA_Sum', 'sum'),
+]
 resampling_methods._cache = None
 
 
@@ -921,45 +1020,51 @@ class VRT(object):
         tempfile.seek(0)
         return tempfile
 
-    def render(self, outputfile, cmd=GDALTRANSLATE, working_memory=1024,
-               compress=None, tempdir=None):
-        """Generate a GeoTIFF from a vrt string"""
+    def get_vsimem(self, **kwargs):
+        """Returns a VsiMemFile with the VRT, readable by GDAL in-process."""
+        kwargs.setdefault('suffix', '.vrt')
+        return VsiMemFile(contents=self.content, **kwargs)
+
+    def render(self, outputfile, working_memory=1024, compress=None,
+               callback=None):
+        """
+        Generate a GeoTIFF from a vrt string
+
+        working_memory: Size of GDAL's block cache, in MiB.
+        compress: GeoTIFF compression, like 'LZW' or 'DEFLATE'.
+        callback: GDAL progress function, called with the fraction
+                  completed, a message and user data.
+        """
         tmpfile = NamedTemporaryFile(
             suffix='.tif', prefix='gdalrender',
             dir=os.path.dirname(outputfile), delete=False
         )
 
         try:
-            with self.get_tempfile(dir=tempdir) as inputfile:
-                warp_cmd = [
-                    cmd,
-                    '-q',                   # Quiet - FIXME: Use logging
+            with self.get_vsimem(prefix='gdalrender') as inputfile:
+                options = [
                     '-of', 'GTiff',         # Output to GeoTIFF
                     '-co', 'BIGTIFF=IF_SAFER',  # Use BigTIFF if >2GB
                     '-co', 'NUM_THREADS=ALL_CPUS', # multithreaded compression for GeoTiff
-                    # gdal_translate does not support the following
-                    # '-multi',               # Use multiple processes
-                    # '-overwrite',           # Overwrite outputfile
                 ]
 
-                # Set the working memory so that gdalwarp doesn't stall of disk
-                # I/O
-                warp_cmd.extend([
-                    # gdal_translate does not support -wm
-                    # '-wm', working_memory,
-                    '--config', 'GDAL_CACHEMAX', working_memory
-                ])
-
                 # Use compression
                 compress = str(compress).upper()
                 if compress and compress != 'NONE':
-                    warp_cmd.extend(['-co', 'COMPRESS=%s' % compress])
+                    options.extend(['-co', 'COMPRESS=%s' % compress])
                     if compress in ('LZW', 'DEFLATE'):
-                        warp_cmd.extend(['-co', 'PREDICTOR=2'])
-
-                # Run gdalwarp and output to tmpfile.name
-                warp_cmd.extend([inputfile.name, tmpfile.name])
-                check_output_gdal([str(e) for e in warp_cmd])
+                        options.extend(['-co', 'PREDICTOR=2'])
+
+                # Set the working memory so that the warp doesn't stall on
+                # disk I/O
+                cachemax = gdal.GetCacheMax()
+                gdal.SetCacheMax(working_memory * 1024 * 1024)
+                try:
+                    # Render to tmpfile.name
+                    run_gdal(gdal.Translate, tmpfile.name, inputfile.name,
+                             options, callback=callback)
+                finally:
+                    gdal.SetCacheMax(cachemax)
 
                 # If it succeeds, then we move it to overwrite the actual
                 # output
@@ -968,3 +1073,47 @@ class VRT(object):
         finally:
             rmfile(tmpfile.name, ignore_missing=True)
             rmfile(tmpfile.name + '.aux.xml', ignore_missing=True)
+
+
+class VsiMemFile(object):
+    """
+    Temporary file in GDAL's /vsimem/ filesystem.
+
+    It is only visible to GDAL in this process, and is removed when closed,
+    like `tempfile.NamedTemporaryFile`.
+
+    contents: Initial contents of the file. Defaults to creating nothing, so
+              that GDAL can write it.
+    """
+
+    _counter = count()
+
+    def __init__(self, contents=None, suffix='', prefix='tmp'):
+        self.name = '/vsimem/{prefix}{pid:d}-{n:d}{suffix}'.format(
+            prefix=prefix, pid=os.getpid(), n=next(self._counter),
+            suffix=suffix
+        )
+        if contents is not None:
+            gdal.FileFromMemBuffer(self.name, contents)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self):
+        """Returns the contents of the file."""
+        stat = gdal.VSIStatL(self.name)
+        if stat is None:
+            raise IOError(errno.ENOENT, 'No such file', self.name)
+        f = gdal.VSIFOpenL(self.name, 'rb')
+        try:
+            return gdal.VSIFReadL(1, stat.size, f)
+        finally:
+            gdal.VSIFCloseL(f)
+
+    def close(self):
+        """Removes the file."""
+        if gdal.VSIStatL(self.name) is not None:
+            gdal.Unlink(self.name)
@@ -21,18 +21,36 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 from functools import partial
+from heapq import merge
+from itertools import groupby, islice
+from math import ceil, sqrt
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+from subprocess import CalledProcessError
 from tempfile import NamedTemporaryFile
+from timeit import default_timer
 
-from .gdal import Dataset, preprocess
-from .renderers import PngRenderer
+from pyvips import Error as VipsError
+
+from .constants import TILE_SIDE
+from .gdal import Dataset, extract_window, preprocess
+from .mbtiles import MBTiles, tile_id
+from .renderers import (DataRenderer, HybridRenderer, JpegRenderer,
+                        PngRenderer, WebpRenderer)
 from .storages import MbtilesStorage, NestedFileStorage, SimpleFileStorage
-from .vips import TmsPyramid, validate_resolutions
+from .utils import NamedTemporaryDir, solid_pixel
+from .vips import (Image, TmsPyramid, VImageAdapter, reduce_tiles,
+                   validate_resolutions)
 
 
 def image_mbtiles(inputfile, outputfile, metadata,
                   min_resolution=None, max_resolution=None, fill_borders=None,
                   zoom_offset=None, colors=None, renderer=None,
-                  preprocessor=None, pngdata=None):
+                  preprocessor=None, pngdata=None, compact=False,
+                  order=None, staging=None, checkpoint=None,
+                  memory_limit=None, append=False, overzoom=False,
+                  cache=None, indexed=False, shared_palette=False):
     """
     Slices a GDAL-readable inputfile into a pyramid of PNG tiles.
 
@@ -42,11 +60,31 @@ def image_mbtiles(inputfile, outputfile, metadata,
     max_resolution: Maximum resolution to upsample tiles.
     fill_borders: Fill borders of image with empty tiles.
     zoom_offset: Offset zoom level to fit unprojected images to square maps.
+    compact: Use the compact MBTiles schema. See `MBTiles._create`.
+    order: Order in which tiles are saved, and of the packed keys with
+           `compact`. See `TmsTiles.ORDERS`.
+    staging: Staging database for the output. See `MbtilesStorage.create`.
+    checkpoint: Copy staged tiles into the output every N tiles.
+    memory_limit: Write into the output directly beyond this many bytes.
+    append: Add tiles to an existing outputfile, keeping its metadata
+            except for the bounds and zoom levels.
+    overzoom: Don't store zoom levels above the native resolution. Readers
+              upsample them from x-nativezoom instead. See `MBTiles.get`.
+    cache: `caches.TileCache` of rendered tiles, shared across runs.
 
     colors: Color palette applied to single band files.
             colors=ColorGradient({0: rgba(0, 0, 0, 255),
                                   10: rgba(255, 255, 255, 255)})
-            Defaults to no colorization.
+            Defaults to no colorization. With a DataRenderer, tiles keep the
+            raw values of the first band instead, and `colors` is stored as
+            JSON in the x-colors metadata for clients to style them.
+    indexed: Keep the palette indexes of `colors` through slicing, and
+             render them as paletted PNGs with exactly its colors. Needs
+             ColorExact or ColorPalette, and a PngRenderer.
+    shared_palette: Quantize a single palette for the whole image, and
+                    remap every tile to it instead of quantizing each tile.
+                    Needs a PngRenderer with png8. See
+                    `PngRenderer.quantize`.
     preprocessor: Function to run on the TmsPyramid before slicing.
 
     If `min_resolution` is None, don't downsample.
@@ -58,19 +96,71 @@ def image_mbtiles(inputfile, outputfile, metadata,
 
     if renderer is None:
         renderer = PngRenderer(**pngdata)
-
-    with MbtilesStorage.create(filename=outputfile,
-                               metadata=metadata,
-                               zoom_offset=zoom_offset,
-                               renderer=renderer) as storage:
+    values = isinstance(renderer, DataRenderer)
+    if values:
+        # Border tiles are transparent RGBA, not values
+        fill_borders = False
+    if indexed:
+        if colors is None:
+            raise ValueError('indexed needs colors')
+        if not isinstance(renderer, PngRenderer):
+            raise ValueError(
+                'indexed needs a PngRenderer: {0!r}'.format(renderer)
+            )
+    if shared_palette:
+        quantizers = [r for r in getattr(renderer, 'renderers', [renderer])
+                      if isinstance(r, PngRenderer) and r.png8 is not False]
+        if not quantizers:
+            raise ValueError(
+                'shared_palette needs a PngRenderer with png8: {0!r}'.format(
+                    renderer
+                )
+            )
+
+    if append:
+        if staging is not None:
+            raise ValueError('Cannot stage tiles while appending')
+        storage = MbtilesStorage.append(filename=outputfile,
+                                        zoom_offset=zoom_offset,
+                                        renderer=renderer,
+                                        cache=cache)
+    else:
+        storage = MbtilesStorage.create(filename=outputfile,
+                                        metadata=metadata,
+                                        zoom_offset=zoom_offset,
+                                        renderer=renderer,
+                                        compact=compact,
+                                        order=order,
+                                        staging=staging,
+                                        checkpoint=checkpoint,
+                                        memory_limit=memory_limit,
+                                        cache=cache)
+
+    with storage:
         pyramid = TmsPyramid(inputfile=inputfile,
                              storage=storage,
                              min_resolution=min_resolution,
-                             max_resolution=max_resolution)
+                             max_resolution=max_resolution,
+                             order=order)
         if preprocessor is None:
             preprocessor = colorize
 
         pyramid = preprocessor(**locals())
+        if indexed:
+            renderer.palette = pyramid.palette
+        if shared_palette:
+            palette = quantizers[0].quantize(pyramid.image)
+            for quantizer in quantizers:
+                quantizer.shared_palette = palette
+
+        native_resolution = None
+        if overzoom and max_resolution is not None and \
+                max_resolution > pyramid.resolution:
+            native_resolution = pyramid.resolution
+            pyramid.max_resolution = native_resolution
+            if pyramid.min_resolution is not None:
+                pyramid.min_resolution = min(pyramid.min_resolution,
+                                             native_resolution)
 
         pyramid.slice(fill_borders=fill_borders)
 
@@ -82,14 +172,26 @@ def image_mbtiles(inputfile, outputfile, metadata,
         if max_resolution is None:
             max_resolution = pyramid.resolution
 
+        min_zoom = min_resolution + zoom_offset
+        max_zoom = max_resolution + zoom_offset
         metadata = storage.mbtiles.metadata
-        metadata['x-minzoom'] = min_resolution + zoom_offset
-        metadata['x-maxzoom'] = max_resolution + zoom_offset
+        if append:
+            min_zoom = min(min_zoom, int(metadata.get('x-minzoom', min_zoom)))
+            max_zoom = max(max_zoom, int(metadata.get('x-maxzoom', max_zoom)))
+        metadata['x-minzoom'] = min_zoom
+        metadata['x-maxzoom'] = max_zoom
+        if native_resolution is not None:
+            metadata['x-nativezoom'] = native_resolution + zoom_offset
+        if len(renderer.formats) > 1:
+            _set_formats(metadata=metadata, renderer=renderer)
+        if values and colors is not None:
+            metadata['x-colors'] = colors.to_json()
 
 
 def image_pyramid(inputfile, outputdir,
                   min_resolution=None, max_resolution=None, fill_borders=None,
-                  colors=None, renderer=None, preprocessor=None):
+                  colors=None, renderer=None, preprocessor=None,
+                  order=None):
     """
     Slices a GDAL-readable inputfile into a pyramid of PNG tiles.
 
@@ -99,6 +201,7 @@ def image_pyramid(inputfile, outputdir,
     max_resolution: Maximum resolution to upsample tiles.
     fill_borders: Fill borders of image with empty tiles.
     preprocessor: Function to run on the TmsPyramid before slicing.
+    order: Order in which tiles are saved. See `TmsTiles.ORDERS`.
 
     Filenames are in the format ``{tms_z}/{tms_x}/{tms_y}.png``.
 
@@ -115,7 +218,8 @@ def image_pyramid(inputfile, outputdir,
     pyramid = TmsPyramid(inputfile=inputfile,
                          storage=storage,
                          min_resolution=min_resolution,
-                         max_resolution=max_resolution)
+                         max_resolution=max_resolution,
+                         order=order)
     if preprocessor is None:
         preprocessor = colorize
     pyramid = preprocessor(**locals())
@@ -123,7 +227,8 @@ def image_pyramid(inputfile, outputdir,
 
 
 def image_slice(inputfile, outputdir, fill_borders=None,
-                colors=None, renderer=None, preprocessor=None):
+                colors=None, renderer=None, preprocessor=None,
+                order=None):
     """
     Slices a GDAL-readable inputfile into PNG tiles.
 
@@ -135,6 +240,7 @@ def image_slice(inputfile, outputdir, fill_borders=None,
                                   10: rgba(255, 255, 255, 255)})
             Defaults to no colorization.
     preprocessor: Function to run on the TmsPyramid before slicing.
+    order: Order in which tiles are saved. See `TmsTiles.ORDERS`.
 
     Filenames are in the format ``{tms_z}-{tms_x}-{tms_y}-{image_hash}.png``.
 
@@ -148,7 +254,8 @@ def image_slice(inputfile, outputdir, fill_borders=None,
     pyramid = TmsPyramid(inputfile=inputfile,
                          storage=storage,
                          min_resolution=None,
-                         max_resolution=None)
+                         max_resolution=None,
+                         order=order)
     if preprocessor is None:
         preprocessor = colorize
     pyramid = preprocessor(**locals())
@@ -158,7 +265,11 @@ def image_slice(inputfile, outputdir, fill_borders=None,
 def warp_mbtiles(inputfile, outputfile, metadata, colors=None, band=None,
                  spatial_ref=None, resampling=None,
                  min_resolution=None, max_resolution=None, fill_borders=None,
-                 zoom_offset=None, renderer=None, pngdata=None):
+                 zoom_offset=None, renderer=None, pngdata=None,
+                 compact=False, order=None, staging=None, checkpoint=None,
+                 memory_limit=None, append=False, overzoom=False,
+                 cache=None, indexed=False, shared_palette=False,
+                 warp_cache=None, warp_threads=None, warp_memory=None):
     """
     Warps a GDAL-readable inputfile into a pyramid of PNG tiles.
 
@@ -169,35 +280,59 @@ def warp_mbtiles(inputfile, outputfile, metadata, colors=None, band=None,
             colors=ColorGradient({0: rgba(0, 0, 0, 255),
                                   10: rgba(255, 255, 255, 255)})
             Defaults to no colorization.
-    band: Select band to palettize and expand to RGBA. Defaults to 1.
+    band: Select band to palettize and expand to RGBA, or whose raw values
+          a DataRenderer keeps. Defaults to 1.
+    indexed: Render palette indexes of `colors` as paletted PNGs. See
+             `image_mbtiles`.
+    shared_palette: Remap every tile to a single png8 palette. See
+                    `image_mbtiles`.
     spatial_ref: Destination gdal.SpatialReference. Defaults to EPSG:3857,
                  Web Mercator
     resampling: Resampling algorithm. Defaults to GDAL's default,
                 nearest neighbour as of GDAL 1.9.1.
+    warp_threads: Number of threads to warp with. Defaults to the number of
+                  CPUs.
+    warp_memory: Memory for GDAL's warp buffer and block cache, in MiB each.
+                 Defaults to GDAL's warp buffer and a 1 GiB block cache.
+    warp_cache: `caches.WarpCache` of warped GeoTIFFs, shared across runs.
 
     min_resolution: Minimum resolution to downsample tiles.
     max_resolution: Maximum resolution to upsample tiles.
     fill_borders: Fill borders of image with empty tiles.
     zoom_offset: Offset zoom level to fit unprojected images to square maps.
+    compact: Use the compact MBTiles schema. See `MBTiles._create`.
+    order: Order in which tiles are saved, and of the packed keys with
+           `compact`. See `TmsTiles.ORDERS`.
+    staging: Staging database for the output. See `MbtilesStorage.create`.
+    checkpoint: Copy staged tiles into the output every N tiles.
+    memory_limit: Write into the output directly beyond this many bytes.
+    append: Add tiles to an existing outputfile, keeping its metadata
+            except for the bounds and zoom levels.
+    overzoom: Don't store zoom levels above the native resolution. Readers
+              upsample them from x-nativezoom instead. See `MBTiles.get`.
+    cache: `caches.TileCache` of rendered tiles, shared across runs.
 
     If `min_resolution` is None, don't downsample.
     If `max_resolution` is None, don't upsample.
     """
-    if colors and band is None:
+    if (colors or isinstance(renderer, DataRenderer)) and band is None:
         band = 1
-    
+
     if pngdata is None:
         pngdata = dict()
 
-    with NamedTemporaryFile(suffix='.tif') as tempfile:
+    with NamedTemporaryDir() as tempdir:
         dataset = Dataset(inputfile)
         validate_resolutions(resolution=dataset.GetNativeResolution(),
                              min_resolution=min_resolution,
                              max_resolution=max_resolution,
                              strict=False)
-        warped = preprocess(inputfile=inputfile, outputfile=tempfile.name,
+        tempfile = os.path.join(tempdir, 'warped.tif')
+        warped = preprocess(inputfile=inputfile, outputfile=tempfile,
                             band=band, spatial_ref=spatial_ref,
-                            resampling=resampling, compress='LZW')
+                            resampling=resampling, compress='LZW',
+                            threads=warp_threads, working_memory=warp_memory,
+                            cache=warp_cache)
         preprocessor = partial(resample_after_warp,
                                whole_world=dataset.IsWholeWorld())
         return image_mbtiles(inputfile=warped, outputfile=outputfile,
@@ -208,13 +343,405 @@ def warp_mbtiles(inputfile, outputfile, metadata, colors=None, band=None,
                              preprocessor=preprocessor,
                              fill_borders=fill_borders,
                              zoom_offset=zoom_offset,
-                             pngdata=pngdata)
+                             pngdata=pngdata,
+                             compact=compact,
+                             order=order,
+                             staging=staging,
+                             checkpoint=checkpoint,
+                             memory_limit=memory_limit,
+                             append=append,
+                             overzoom=overzoom,
+                             cache=cache,
+                             indexed=indexed,
+                             shared_palette=shared_palette)
+
+
+def overview_mbtiles(filename, min_zoom=None, max_zoom=None, kernel=None,
+                     renderer=None, pngdata=None, processes=None):
+    """
+    Builds the lower zoom levels of an MBTiles file from the tiles it
+    already has.
+
+    filename: The .mbtiles file, which is updated in place.
+    min_zoom: Lowest zoom level to build. Defaults to 0.
+    max_zoom: Zoom level to build from. Defaults to the lowest zoom level
+              in the file.
+    kernel: Reduction kernel. See `REDUCE_KERNELS`. tiff tiles of raw values
+            can only be reduced by 'nearest', their default.
+    renderer: Used to render the new tiles. Defaults to the format in the
+              metadata. tiff tiles need a DataRenderer.
+    pngdata: Arguments for the default PngRenderer.
+    processes: Number of threads that decode, reduce and render tiles.
+               Defaults to the number of CPUs.
+
+    Each tile is reduced from the 2x2 tiles above it. Zoom levels are built
+    one at a time, reading a pair of columns at a time, so memory use does
+    not grow with the size of the file. Tiles that duplicate images already
+    in the file are not stored again.
+    """
+    if min_zoom is None:
+        min_zoom = 0
+
+    if pngdata is None:
+        pngdata = dict()
+
+    if processes is None:
+        processes = cpu_count()
+
+    storage = MbtilesStorage.append(filename=filename, renderer=renderer)
+    with storage:
+        mbtiles = storage.mbtiles
+        metadata = mbtiles.metadata
+        values = metadata.get('format') == 'tiff'
+        if renderer is None:
+            formats = metadata.get('x-formats', '').split(',')
+            if values:
+                storage.renderer = DataRenderer()
+            elif len(formats) > 1:
+                if 'webp' in formats:
+                    opaque = WebpRenderer()
+                else:
+                    opaque = JpegRenderer()
+                storage.renderer = HybridRenderer(
+                    opaque=opaque, transparent=PngRenderer(**pngdata)
+                )
+            elif metadata.get('format') == 'jpg':
+                storage.renderer = JpegRenderer()
+            elif metadata.get('format') == 'webp':
+                storage.renderer = WebpRenderer()
+            else:
+                storage.renderer = PngRenderer(**pngdata)
+        _check_values(filename=filename, values=values,
+                      renderer=storage.renderer)
+
+        if max_zoom is None:
+            zooms = mbtiles.zoom_levels()
+            if not zooms:
+                return
+            max_zoom = zooms[0]
+        if min_zoom >= max_zoom:
+            return
+
+        worker = partial(_overview_tile, storage=storage, kernel=kernel,
+                         values=values)
+        batch_size = max(processes * 16, storage.renderer.batch_size)
+        pool = ThreadPool(processes=processes)
+        try:
+            for z in range(max_zoom - 1, min_zoom - 1, -1):
+                quads = _overview_quads(mbtiles=mbtiles, z=z)
+                while True:
+                    # The main thread owns the database, so only hand
+                    # batches of decoded tiles to the workers.
+                    batch = list(islice(quads, batch_size))
+                    if not batch:
+                        break
+                    tiles = pool.map(worker, batch)
+                    rendered = iter(storage.renderer.postrender(
+                        [contents for _, _, _, contents in tiles
+                         if contents is not None]
+                    ))
+                    for x, y, hashed, contents in tiles:
+                        if contents is not None:
+                            contents = next(rendered)
+                        storage.save_rendered(x=x, y=y, z=z, hashed=hashed,
+                                              contents=contents)
+        finally:
+            pool.close()
+            pool.join()
+
+        metadata['x-minzoom'] = min(min_zoom,
+                                    int(metadata.get('x-minzoom', min_zoom)))
+        metadata['x-maxzoom'] = max(max_zoom,
+                                    int(metadata.get('x-maxzoom', max_zoom)))
+        if mbtiles.has_coverage:
+            storage.write_coverage()
+
+
+def _overview_quads(mbtiles, z):
+    """
+    Yields (x, y, tiles) for each tile at zoom level `z` that has tiles
+    above it in `mbtiles`.
+
+    tiles: Tile data for the upper left, upper right, lower left and lower
+           right tiles at zoom level `z + 1`, or None where missing.
+    """
+    parents = (x // 2 for x in mbtiles.columns(z=z + 1))
+    for x, _ in groupby(parents):
+        left = ((row, 0, data)
+                for row, data in mbtiles.column(x=2 * x, z=z + 1))
+        right = ((row, 1, data)
+                 for row, data in mbtiles.column(x=2 * x + 1, z=z + 1))
+        for y, group in groupby(merge(left, right),
+                                key=lambda t: t[0] // 2):
+            quad = dict(((side, row % 2), data) for row, side, data in group)
+            # TMS rows count upwards, so the upper tiles are in odd rows
+            yield x, y, (quad.get((0, 1)), quad.get((1, 1)),
+                         quad.get((0, 0)), quad.get((1, 0)))
+
+
+def _overview_tile(quad, storage, kernel, values=False):
+    """
+    Returns (x, y, hashed, contents) for a quad from `_overview_quads`.
+
+    contents is prerendered, see `Renderer.prerender`, or None if `storage`
+    has already seen the image.
+    """
+    x, y, tiles = quad
+    image = reduce_tiles(*tiles, kernel=kernel, values=values)
+    hashed = storage.get_hash(image)
+    contents = None
+    if tile_id(hashed) not in storage.seen:
+        contents = storage.renderer.prerender(image)
+    return x, y, hashed, contents
+
+
+def transcode_mbtiles(filename, renderer, processes=None):
+    """
+    Re-encodes every image in an MBTiles file in place.
+
+    filename: The .mbtiles file, which is updated in place.
+    renderer: Used to render the decoded images again, for instance a
+              PngRenderer with png8 or optimize.
+    processes: Number of threads that decode and render images. Defaults to
+               the number of CPUs.
+
+    Since tiles share images by tile_id, each distinct image is rendered
+    once, however many tiles use it. The format metadata is updated to match
+    `renderer`.
+
+    tiff tiles of raw values can only be transcoded by a DataRenderer, and
+    other tiles not by one.
+    """
+    if processes is None:
+        processes = cpu_count()
+
+    pool = ThreadPool(processes=processes)
+    try:
+        with MBTiles(filename=filename) as mbtiles:
+            values = mbtiles.metadata.get('format') == 'tiff'
+            _check_values(filename=filename, values=values,
+                          renderer=renderer)
+            worker = partial(_transcode_image, renderer=renderer,
+                             values=values)
+            batch_size = max(processes * 16, renderer.batch_size)
+            images = mbtiles.images(page_size=batch_size)
+            while True:
+                # The main thread owns the database, so only hand batches of
+                # encoded images to the workers.
+                batch = list(islice(images, batch_size))
+                if not batch:
+                    break
+                identifiers, contents = zip(*pool.map(worker, batch))
+                mbtiles.replace_images(
+                    zip(identifiers, renderer.postrender(list(contents)))
+                )
+
+            _set_formats(metadata=mbtiles.metadata, renderer=renderer)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _set_formats(metadata, renderer):
+    """
+    Sets the format metadata for tiles rendered by `renderer`.
+
+    Renderers that mix formats, like HybridRenderer, also list all of them,
+    comma-separated, in x-formats.
+    """
+    if renderer.format is not None:
+        metadata['format'] = renderer.format
+    if len(renderer.formats) > 1:
+        metadata['x-formats'] = ','.join(renderer.formats)
+    elif 'x-formats' in metadata:
+        del metadata['x-formats']
+
+
+def _check_values(filename, values, renderer):
+    """
+    Raises ValueError unless `renderer` is a DataRenderer exactly when the
+    tiles of `filename` hold raw values.
+    """
+    if values and not isinstance(renderer, DataRenderer):
+        raise ValueError(
+            '{0} has tiff tiles of raw values, which need a DataRenderer: '
+            '{1!r}'.format(filename, renderer)
+        )
+    if not values and isinstance(renderer, DataRenderer):
+        raise ValueError(
+            '{0} has image tiles, which a DataRenderer cannot '
+            'render'.format(filename)
+        )
+
+
+def _transcode_image(image, renderer, values=False):
+    """
+    Returns (tile_id, data) with the image from `MBTiles.images`
+    prerendered. See `Renderer.prerender`.
+
+    values: Decode raw values as they are, instead of as an RGBA image.
+    """
+    identifier, data = image
+    if values:
+        decoded = Image.new_from_buffer(data, '')
+    else:
+        decoded = VImageAdapter.from_buffer(data)
+    return identifier, renderer.prerender(decoded)
+
+
+def tune_mbtiles(filename, renderers, count=200):
+    """
+    Benchmarks `renderers` on a sample of the images in an MBTiles file.
+
+    filename: The .mbtiles file to sample from, which is not modified.
+    renderers: List of renderers to compare.
+    count: Number of images to sample, spread over the zoom levels. See
+           `MBTiles.sample`.
+
+    Returns a list of (renderer, size, seconds) in the order of `renderers`,
+    with the mean size in bytes and encoding time in seconds per tile. Both
+    are None for renderers that fail, for instance when pngquant is missing.
+
+    Images are rendered as MbtilesStorage would, so single colour tiles are
+    rendered by `Renderer.render_solid`, and the rest in batches by
+    `Renderer.render_all`.
+
+    tiff tiles of raw values are not images, so they can't be tuned.
+    """
+    with MBTiles(filename=filename) as mbtiles:
+        if mbtiles.metadata.get('format') == 'tiff':
+            raise ValueError(
+                '{0} has tiff tiles of raw values, which cannot be '
+                'tuned'.format(filename)
+            )
+        samples = mbtiles.sample(count=count)
+    if not samples:
+        raise ValueError('No tiles to sample in {0}'.format(filename))
+
+    # Decode up front, so that decoding isn't timed with the first renderer
+    images = [VImageAdapter.from_buffer(data).copy_memory()
+              for data in samples]
+    solids = []
+    others = []
+    for image in images:
+        data = image.write_to_memory()
+        pixel = solid_pixel(data, len(data) // (image.width * image.height))
+        if pixel is None:
+            others.append(image)
+        else:
+            solids.append((image, pixel))
+
+    results = []
+    for renderer in renderers:
+        start = default_timer()
+        try:
+            contents = [renderer.render_solid(image, pixel)
+                        for image, pixel in solids]
+            contents.extend(renderer.render_all(others))
+        except (CalledProcessError, EnvironmentError, VipsError):
+            results.append((renderer, None, None))
+            continue
+        seconds = default_timer() - start
+        results.append((renderer,
+                        sum(len(data) for data in contents) / len(images),
+                        seconds / len(images)))
+    return results
+
+
+def tune_raster(inputfile, renderers, count=200, colors=None, band=None,
+                spatial_ref=None, resampling=None, min_resolution=None,
+                max_resolution=None):
+    """
+    Benchmarks `renderers` on tiles sliced from a sample of a GDAL-readable
+    inputfile, without rendering all of it first.
+
+    inputfile: Filename
+    renderers: List of renderers to compare.
+    count: Number of tiles to sample, spread over the zoom levels.
+
+    colors, band, spatial_ref, resampling: As for `warp_mbtiles`.
+    min_resolution: Minimum resolution to sample tiles from.
+    max_resolution: Maximum resolution to sample tiles from.
+
+    A window in the middle of inputfile, of about `count` tiles at
+    `max_resolution`, is warped and sliced into lossless PNG tiles, which
+    are then sampled like in `tune_mbtiles`. Unlike the tiles of a rendered
+    MBTiles file, they haven't been through lossy encoding already.
+
+    Returns a list of (renderer, size, seconds). See `tune_mbtiles`.
+
+    If `min_resolution` is None, don't downsample.
+    If `max_resolution` is None, don't upsample.
+    """
+    dataset = Dataset(inputfile)
+
+    # Each resolution above the native one doubles the side of the tiles
+    levels = 0
+    if max_resolution is not None:
+        levels = max(0, max_resolution - dataset.GetNativeResolution())
+    side = max(TILE_SIDE, (TILE_SIDE * int(ceil(sqrt(count)))) >> levels)
+    xsize = min(side, dataset.RasterXSize)
+    ysize = min(side, dataset.RasterYSize)
+    window = extract_window(inputfile=inputfile,
+                            xoff=(dataset.RasterXSize - xsize) // 2,
+                            yoff=(dataset.RasterYSize - ysize) // 2,
+                            xsize=xsize, ysize=ysize)
+
+    metadata = dict(
+        name='tune',
+        type='baselayer',
+        version='1.0.0',
+        description='Sample of {0}'.format(os.path.basename(inputfile)),
+        format='png',
+    )
+    with NamedTemporaryDir() as tempdir:
+        # Rendered, since VIPS can't read the VRT if it needs no warping
+        windowfile = window.render(
+            outputfile=os.path.join(tempdir, 'window.tif')
+        )
+        outputfile = os.path.join(tempdir, 'sample.mbtiles')
+        warp_mbtiles(inputfile=windowfile, outputfile=outputfile,
+                     metadata=metadata, colors=colors, band=band,
+                     spatial_ref=spatial_ref, resampling=resampling,
+                     min_resolution=min_resolution,
+                     max_resolution=max_resolution, fill_borders=False,
+                     renderer=PngRenderer(compression=1))
+        return tune_mbtiles(filename=outputfile, renderers=renderers,
+                            count=count)
+
+
+def recommend_renderer(results, max_size=None, max_seconds=None):
+    """
+    Returns the renderer that best meets the targets, or None.
+
+    results: List of (renderer, size, seconds) from `tune_raster` or
+             `tune_mbtiles`.
+    max_size: Largest acceptable mean size of a tile, in bytes.
+    max_seconds: Longest acceptable mean encoding time of a tile.
+
+    Of the renderers within both targets, this is the fastest if only
+    `max_size` is given, and otherwise the smallest.
+    """
+    candidates = [
+        (renderer, size, seconds) for renderer, size, seconds in results
+        if size is not None and
+        (max_size is None or size <= max_size) and
+        (max_seconds is None or seconds <= max_seconds)
+    ]
+    if not candidates:
+        return None
+    if max_size is not None and max_seconds is None:
+        best = min(candidates, key=lambda result: result[2])
+    else:
+        best = min(candidates, key=lambda result: result[1])
+    return best[0]
 
 
 def warp_pyramid(inputfile, outputdir, colors=None, band=None,
                  spatial_ref=None, resampling=None,
                  min_resolution=None, max_resolution=None, fill_borders=None,
-                 renderer=None):
+                 renderer=None, order=None, warp_threads=None,
+                 warp_memory=None):
     """
     Warps a GDAL-readable inputfile into a pyramid of PNG tiles.
 
@@ -230,10 +757,15 @@ def warp_pyramid(inputfile, outputdir, colors=None, band=None,
                  Web Mercator
     resampling: Resampling algorithm. Defaults to GDAL's default,
                 nearest neighbour as of GDAL 1.9.1.
+    warp_threads: Number of threads to warp with. Defaults to the number of
+                  CPUs.
+    warp_memory: Memory for GDAL's warp buffer and block cache, in MiB each.
+                 Defaults to GDAL's warp buffer and a 1 GiB block cache.
 
     min_resolution: Minimum resolution to downsample tiles.
     max_resolution: Maximum resolution to upsample tiles.
     fill_borders: Fill borders of image with empty tiles.
+    order: Order in which tiles are saved. See `TmsTiles.ORDERS`.
 
     Filenames are in the format ``{tms_z}/{tms_x}/{tms_y}.png``.
 
@@ -254,7 +786,8 @@ def warp_pyramid(inputfile, outputdir, colors=None, band=None,
                              strict=False)
         warped = preprocess(inputfile=inputfile, outputfile=tempfile.name,
                             band=band, spatial_ref=spatial_ref,
-                            resampling=resampling, compress='LZW')
+                            resampling=resampling, compress='LZW',
+                            threads=warp_threads, working_memory=warp_memory)
         preprocessor = partial(resample_after_warp,
                                whole_world=dataset.IsWholeWorld())
         return image_pyramid(inputfile=warped, outputdir=outputdir,
@@ -262,12 +795,14 @@ def warp_pyramid(inputfile, outputdir, colors=None, band=None,
                              max_resolution=max_resolution,
                              colors=colors, renderer=renderer,
                              preprocessor=preprocessor,
-                             fill_borders=fill_borders)
+                             fill_borders=fill_borders,
+                             order=order)
 
 
 def warp_slice(inputfile, outputdir, fill_borders=None, colors=None, band=None,
                spatial_ref=None, resampling=None,
-               renderer=None):
+               renderer=None, order=None, warp_threads=None,
+               warp_memory=None):
     """
     Warps a GDAL-readable inputfile into a directory of PNG tiles.
 
@@ -284,9 +819,14 @@ def warp_slice(inputfile, outputdir, fill_borders=None, colors=None, band=None,
                  Web Mercator
     resampling: Resampling algorithm. Defaults to GDAL's default,
                 nearest neighbour as of GDAL 1.9.1.
+    warp_threads: Number of threads to warp with. Defaults to the number of
+                  CPUs.
+    warp_memory: Memory for GDAL's warp buffer and block cache, in MiB each.
+                 Defaults to GDAL's warp buffer and a 1 GiB block cache.
 
     min_resolution: Minimum resolution to downsample tiles.
     max_resolution: Maximum resolution to upsample tiles.
+    order: Order in which tiles are saved. See `TmsTiles.ORDERS`.
 
     Filenames are in the format ``{tms_z}-{tms_x}-{tms_y}-{image_hash}.png``.
 
@@ -300,19 +840,25 @@ def warp_slice(inputfile, outputdir, fill_borders=None, colors=None, band=None,
         dataset = Dataset(inputfile)
         warped = preprocess(inputfile=inputfile, outputfile=tempfile.name,
                             band=band, spatial_ref=spatial_ref,
-                            resampling=resampling, compress='LZW')
+                            resampling=resampling, compress='LZW',
+                            threads=warp_threads, working_memory=warp_memory)
         preprocessor = partial(resample_after_warp,
                                whole_world=dataset.IsWholeWorld())
         return image_slice(inputfile=warped, outputdir=outputdir,
                            colors=colors, renderer=renderer,
                            preprocessor=preprocessor,
-                           fill_borders=fill_borders)
+                           fill_borders=fill_borders,
+                           order=order)
 
 
 # Preprocessors
 
-def resample_after_warp(pyramid, colors, whole_world, **kwargs):
+def resample_after_warp(pyramid, colors, whole_world, indexed=False,
+                        values=False, **kwargs):
     resolution = pyramid.dataset.GetNativeResolution()
+    if values:
+        # Resample raw values by nearest neighbour
+        pyramid.extract_values()
     if whole_world:
         # We must resample the image to fit whole tiles, even if this makes the
         # extents of the image go PAST the full world.
@@ -322,12 +868,15 @@ def resample_after_warp(pyramid, colors, whole_world, **kwargs):
         pyramid.dataset.resample_to_world()
     else:
         pyramid.dataset.resample(resolution=resolution)
-    colorize(pyramid=pyramid, colors=colors)
+    if not values:
+        colorize(pyramid=pyramid, colors=colors, indexed=indexed)
     pyramid.dataset.align_to_grid(resolution=resolution)
     return pyramid
 
 
-def colorize(pyramid, colors, **kwargs):
-    if colors is not None:
-        pyramid.colorize(colors)
+def colorize(pyramid, colors, indexed=False, values=False, **kwargs):
+    if values:
+        pyramid.extract_values()
+    elif colors is not None:
+        pyramid.colorize(colors, indexed=indexed)
     return pyramid
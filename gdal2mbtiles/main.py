@@ -14,6 +14,23 @@
 # You can also pipe in any GDAL-readable file:
 #   $ cat input.tiff | gdal2mbtiles > output.mbtiles
 #
+# To ship only the tiles that changed between two MBTiles files, run:
+#   $ gdal2mbtiles diff old.mbtiles new.mbtiles patch.mbtiles
+#   $ gdal2mbtiles apply old.mbtiles patch.mbtiles
+#
+# To cut a regional subset out of an MBTiles file, run:
+#   $ gdal2mbtiles extract --bounds -10 35 5 45 world.mbtiles iberia.mbtiles
+#
+# To build the lower zoom levels of an MBTiles file from its tiles, run:
+#   $ gdal2mbtiles overviews --min-zoom 0 world.mbtiles
+#
+# To re-encode the tiles of an MBTiles file in place, run:
+#   $ gdal2mbtiles transcode --format png --png8 256 world.mbtiles
+#
+# To compare encoding settings on a sample of the tiles of a GDAL-readable
+# file, before rendering it, run:
+#   $ gdal2mbtiles tune --max-resolution 8 --max-size 20 world.tiff
+#
 # Licensed to Ecometrica under one or more contributor license
 # agreements.  See the NOTICE file distributed with this work
 # for additional information regarding copyright ownership.
@@ -50,7 +67,7 @@ if __name__ == '__main__' and __package__ is None:
 
 from .gdal import RESAMPLING_METHODS, SpatialReference
 from .gd_types import rgba
-from .mbtiles import Metadata
+from .mbtiles import MBTiles, Metadata
 
 
 COLORING_METHODS = {
@@ -125,6 +142,7 @@ def png8_arg(s):
 
 def parse_args(args):
     """Parses command-line `args`"""
+    from gdal2mbtiles.vips import TmsTiles
 
     LatestMetadata = Metadata.latest()
 
@@ -138,7 +156,9 @@ def parse_args(args):
     group.add_argument('INPUT', type=argparse.FileType('rb'), nargs='?',
                        default=sys.stdin,
                        help='GDAL-readable file.')
-    group.add_argument('OUTPUT', type=argparse.FileType('wb'), nargs='?',
+    # Opened for appending so that --append can read it. It is otherwise
+    # replaced when the MBTiles file is created.
+    group.add_argument('OUTPUT', type=argparse.FileType('ab'), nargs='?',
                        help='Output filename. Defaults to INPUT.mbtiles')
 
     group = parser.add_argument_group(title='MBTiles metadata arguments')
@@ -156,7 +176,32 @@ def parse_args(args):
     group.add_argument('--format',
                        default=LatestMetadata.FORMATS.PNG,
                        choices=LatestMetadata.FORMATS,
-                       help='Tile image format. Defaults to "png"')
+                       help=('Tile image format. "tiff" keeps the raw '
+                             'values of --colorize-band, for clients to '
+                             'style with the --color ramp. Defaults to '
+                             '"png"'))
+
+    group = parser.add_argument_group(title='MBTiles storage arguments')
+    group.add_argument('--compact', action='store_true', default=False,
+                       help=('Key tiles by a single packed integer to shrink '
+                             'the index, along a Hilbert curve with '
+                             '--tile-order hilbert. Defaults to the standard '
+                             'schema.'))
+    group.add_argument('--staging', default=None, metavar='FILENAME',
+                       help=('Write tiles into FILENAME first, like :memory: '
+                             'or a file on a tmpfs, then copy them into '
+                             'OUTPUT. Defaults to writing OUTPUT directly.'))
+    group.add_argument('--checkpoint', type=int, default=None, metavar='N',
+                       help=('With --staging, copy tiles into OUTPUT every '
+                             'N tiles. Defaults to only at the end.'))
+    group.add_argument('--memory-limit', type=int, default=None,
+                       metavar='MIB',
+                       help=('With --staging, write into OUTPUT directly '
+                             'once the staged tiles exceed MIB mebibytes.'))
+    group.add_argument('--append', action='store_true', default=False,
+                       help=('Add the rendered zoom levels to an existing '
+                             'OUTPUT, without rendering its tiles again. '
+                             'Defaults to replacing OUTPUT.'))
 
     group = parser.add_argument_group(title='GDAL warp arguments')
     group.add_argument('--spatial-reference', type=int, default=3857,
@@ -167,6 +212,23 @@ def parse_args(args):
                        choices=list(RESAMPLING_METHODS.values()),
                        help=('Resampling algorithm for warping. '
                              'Defaults to "near" (nearest-neighbour)'))
+    group.add_argument('--warp-threads', type=int, default=None, metavar='N',
+                       help=('Number of threads to warp with. Defaults to '
+                             'the number of CPUs.'))
+    group.add_argument('--warp-memory', type=int, default=None,
+                       metavar='MIB',
+                       help=('Memory for the warp buffer and for the GDAL '
+                             'block cache, in mebibytes each. Defaults to '
+                             'the GDAL warp buffer and a 1024 MiB cache.'))
+    group.add_argument('--warp-cache', default=None, metavar='DIRECTORY',
+                       help=('Keep warped GeoTIFFs in DIRECTORY, and reuse '
+                             'them instead of warping the same INPUT with '
+                             'the same settings again.'))
+    group.add_argument('--warp-cache-size', type=int, default=None,
+                       metavar='MIB',
+                       help=('With --warp-cache, remove the least recently '
+                             'used GeoTIFFs beyond MIB mebibytes. Defaults '
+                             'to no limit.'))
 
     group = parser.add_argument_group(title='Rendering arguments')
     group.add_argument('--min-resolution', type=int, default=None,
@@ -186,6 +248,18 @@ def parse_args(args):
                        metavar='N',
                        help=('Offset zoom level by N to fit unprojected '
                              'images to square maps. Defaults to 0.'))
+    group.add_argument('--tile-order', default='row',
+                       choices=TmsTiles.ORDERS,
+                       help=('Order in which tiles are written, and with '
+                             '--compact, stored. "hilbert" keeps neighbouring '
+                             'tiles close together on disk, but with '
+                             '--compact, readers of the standard tiles view '
+                             'unpack every tile key with recursive SQL, which '
+                             'is slow. Defaults to "row"'))
+    group.add_argument('--overzoom', action='store_true', default=False,
+                       help=('Do not store resolutions above the native '
+                             'resolution. Readers upsample them from the '
+                             'x-nativezoom metadata instead.'))
 
     group = parser.add_argument_group(title='Coloring arguments')
     group.add_argument('--coloring', default=None,
@@ -196,13 +270,48 @@ def parse_args(args):
                        help=('Examples: --color="0:#ff00ff" --color=255:red'))
     group.add_argument('--colorize-band', metavar='COLORIZE-BAND',
                        type=colorize_band_arg, default=None,
-                       help='Raster band to colorize. Defaults to 1')
+                       help=('Raster band to colorize, or to keep the values '
+                             'of with --format tiff. Defaults to 1'))
+    group.add_argument('--indexed', action='store_true', default=False,
+                       help=('With --coloring exact or palette, render '
+                             'paletted PNGs with exactly the --color colors, '
+                             'instead of RGBA PNGs.'))
     group.add_argument('--png8', default=None,
                        type=png8_arg,
                        help=('Quantizes 32-bit RGBA to 8-bit RGBA paletted '
                              'PNGs. If an integer, specifies number of '
                              'colors in palette between 2 and 256. '
                              'Default to False.'))
+    group.add_argument('--png8-effort', default=None, metavar='N',
+                       type=int, choices=range(1, 11),
+                       help=('Effort spent quantizing for --png8, from 1 '
+                             '(fastest) to 10 (best quality). Defaults to 7.'))
+    group.add_argument('--shared-palette', action='store_true', default=False,
+                       help=('With --png8, quantize one palette from a '
+                             'sample of the whole image, and remap every '
+                             'tile to it instead of quantizing each tile.'))
+    group.add_argument('--webp-lossless', action='store_true', default=False,
+                       help='With --format webp, compress losslessly.')
+    group.add_argument('--webp-quality', default=None, metavar='N',
+                       type=int, choices=range(101),
+                       help=('With --format webp, lossy quality between 0 and '
+                             '100. Defaults to 75.'))
+    group.add_argument('--webp-effort', default=None, metavar='N',
+                       type=int, choices=range(7),
+                       help=('With --format webp, effort spent compressing, '
+                             'from 0 (fastest) to 6 (smallest). '
+                             'Defaults to 4.'))
+    group.add_argument('--hybrid', action='store_true', default=False,
+                       help=('Render opaque tiles in --format jpg or webp, '
+                             'and tiles with transparency as PNG.'))
+    group.add_argument('--cache', default=None, metavar='DIRECTORY',
+                       help=('Keep rendered tiles in DIRECTORY, and reuse '
+                             'them instead of rendering the same images '
+                             'with the same settings again.'))
+    group.add_argument('--cache-size', type=int, default=None, metavar='MIB',
+                       help=('With --cache, remove the least recently used '
+                             'tiles beyond MIB mebibytes. Defaults to no '
+                             'limit.'))
 
     args = parser.parse_args(args=args)
 
@@ -214,22 +323,60 @@ def parse_args(args):
             # Set default output name based on input name
             args.OUTPUT = open(
                 os.path.splitext(args.INPUT.name)[0] + '.mbtiles',
-                mode='wb'
+                mode='ab'
             )
 
     if args.name is None:
         args.name = os.path.basename(args.INPUT.name)
 
+    if args.append:
+        if args.OUTPUT == sys.stdout:
+            parser.error('--append requires an OUTPUT file')
+        if args.staging is not None:
+            parser.error('--append cannot be used with --staging')
+    if args.staging is None:
+        if args.checkpoint is not None:
+            parser.error('--checkpoint needs --staging')
+        if args.memory_limit is not None:
+            parser.error('--memory-limit needs --staging')
+
     # Make sure that --color and --coloring match up
-    if args.coloring is None and (args.colors or
-                                  args.colorize_band is not None):
+    if args.coloring is None and (
+            args.colors or
+            (args.colorize_band is not None and args.format != 'tiff')):
         parser.error('must provide --coloring')
     elif args.coloring is not None and not args.colors:
         parser.error('must provide at least one --color')
 
+    if args.indexed:
+        if args.coloring not in ('exact', 'palette'):
+            parser.error('--indexed needs --coloring exact or palette')
+        if args.format != 'png' or args.hybrid or args.png8:
+            parser.error('--indexed needs --format png, without --png8 '
+                         'or --hybrid')
+
+    if args.shared_palette and (not args.png8 or
+                                (args.format != 'png' and not args.hybrid)):
+        parser.error('--shared-palette needs --png8, with --format png or '
+                     '--hybrid')
+
     # Transform choices into ColorBase classes
     args.coloring = coloring_arg(args.coloring)
 
+    if args.hybrid and args.format not in ('jpg', 'webp'):
+        parser.error('--hybrid needs --format jpg or webp')
+
+    if args.cache_size is not None and args.cache is None:
+        parser.error('--cache-size needs --cache')
+
+    if args.warp_threads is not None and args.warp_threads < 1:
+        parser.error('--warp-threads must be at least 1')
+    if args.warp_memory is not None and args.warp_memory < 1:
+        parser.error('--warp-memory must be at least 1')
+
+    if args.warp_cache_size is not None and args.warp_cache is None:
+        parser.error('--warp-cache-size needs --warp-cache')
+
     return args
 
 
@@ -258,9 +405,413 @@ def input_output(inputfile, outputfile):
             f.close()
 
 
+def parse_diff_args(args):
+    """Parses command-line `args` for the diff command"""
+    parser = argparse.ArgumentParser(
+        prog='gdal2mbtiles diff',
+        description=('Writes a patch containing the tiles that changed '
+                     'between two MBTiles files')
+    )
+    parser.add_argument('-v', '--verbose', action='count',
+                        help='explain what is being done')
+    parser.add_argument('OLD', help='Original MBTiles file.')
+    parser.add_argument('NEW', help='Updated MBTiles file.')
+    parser.add_argument('PATCH', help='Output patch filename.')
+    return parser.parse_args(args=args)
+
+
+def diff_main(args=None, use_logging=True):
+    args = parse_diff_args(args=args)
+
+    if use_logging:
+        configure_logging(args)
+
+    with MBTiles(filename=args.OLD) as old:
+        logging.info('Comparing {0} with {1}'.format(args.OLD, args.NEW))
+        old.diff(other=args.NEW, filename=args.PATCH).close()
+    return 0
+
+
+def parse_apply_args(args):
+    """Parses command-line `args` for the apply command"""
+    parser = argparse.ArgumentParser(
+        prog='gdal2mbtiles apply',
+        description='Applies a patch made by "gdal2mbtiles diff"'
+    )
+    parser.add_argument('-v', '--verbose', action='count',
+                        help='explain what is being done')
+    parser.add_argument('TARGET', help='MBTiles file to update in place.')
+    parser.add_argument('PATCH', help='Patch filename.')
+    return parser.parse_args(args=args)
+
+
+def apply_main(args=None, use_logging=True):
+    args = parse_apply_args(args=args)
+
+    if use_logging:
+        configure_logging(args)
+
+    with MBTiles(filename=args.TARGET) as target:
+        logging.info('Applying {0} to {1}'.format(args.PATCH, args.TARGET))
+        target.apply(patch=args.PATCH)
+    return 0
+
+
+def parse_extract_args(args):
+    """Parses command-line `args` for the extract command"""
+    parser = argparse.ArgumentParser(
+        prog='gdal2mbtiles extract',
+        description=('Copies the tiles within some bounds and zoom levels '
+                     'into a new MBTiles file')
+    )
+    parser.add_argument('-v', '--verbose', action='count',
+                        help='explain what is being done')
+    parser.add_argument('--bounds', type=float, nargs=4, required=True,
+                        metavar=('LEFT', 'BOTTOM', 'RIGHT', 'TOP'),
+                        help='Bounds in WGS84 longitude and latitude.')
+    parser.add_argument('--min-zoom', type=int, default=None,
+                        help='Minimum zoom level. Defaults to the lowest.')
+    parser.add_argument('--max-zoom', type=int, default=None,
+                        help='Maximum zoom level. Defaults to the highest.')
+    parser.add_argument('SOURCE', help='MBTiles file to copy tiles from.')
+    parser.add_argument('DEST', help='Output MBTiles filename.')
+    args = parser.parse_args(args=args)
+
+    left, bottom, right, top = args.bounds
+    if left >= right or bottom >= top:
+        parser.error('--bounds must be LEFT BOTTOM RIGHT TOP')
+    return args
+
+
+def extract_main(args=None, use_logging=True):
+    args = parse_extract_args(args=args)
+
+    if use_logging:
+        configure_logging(args)
+
+    with MBTiles(filename=args.SOURCE) as source:
+        zooms = source.zoom_levels()
+        if args.min_zoom is not None:
+            zooms = [z for z in zooms if z >= args.min_zoom]
+        if args.max_zoom is not None:
+            zooms = [z for z in zooms if z <= args.max_zoom]
+
+        logging.info('Extracting {0} from {1}'.format(args.DEST,
+                                                      args.SOURCE))
+        source.extract(bounds=args.bounds, zooms=zooms,
+                       dest=args.DEST).close()
+    return 0
+
+
+def parse_overviews_args(args):
+    """Parses command-line `args` for the overviews command"""
+    from gdal2mbtiles.vips import REDUCE_KERNELS
+
+    parser = argparse.ArgumentParser(
+        prog='gdal2mbtiles overviews',
+        description=('Builds the lower zoom levels of an MBTiles file from '
+                     'the tiles it already has')
+    )
+    parser.add_argument('-v', '--verbose', action='count',
+                        help='explain what is being done')
+    parser.add_argument('--min-zoom', type=int, default=0,
+                        help='Lowest zoom level to build. Defaults to 0.')
+    parser.add_argument('--max-zoom', type=int, default=None,
+                        help=('Zoom level to build from. Defaults to the '
+                              'lowest zoom level in the file.'))
+    parser.add_argument('--kernel', default=None,
+                        choices=REDUCE_KERNELS,
+                        help=('Kernel for reducing tiles. Defaults to '
+                              '"linear", or "nearest" for tiff tiles'))
+    parser.add_argument('--png8', default=None, metavar='N', type=png8_arg,
+                        help=('Quantizes 32-bit RGBA to 8-bit RGBA paletted '
+                              'PNGs. Defaults to None (do not quantize)'))
+    parser.add_argument('--processes', type=int, default=None, metavar='N',
+                        help=('Number of tiles to reduce at once. '
+                              'Defaults to the number of CPUs.'))
+    parser.add_argument('FILE', help='MBTiles file to update in place.')
+    args = parser.parse_args(args=args)
+
+    if args.max_zoom is not None and args.min_zoom >= args.max_zoom:
+        parser.error('--min-zoom must be lower than --max-zoom')
+    if args.processes is not None and args.processes < 1:
+        parser.error('--processes must be at least 1')
+    return args
+
+
+def overviews_main(args=None, use_logging=True):
+    args = parse_overviews_args(args=args)
+
+    if use_logging:
+        configure_logging(args)
+
+    from gdal2mbtiles.helpers import overview_mbtiles
+
+    logging.info('Building overviews in {0}'.format(args.FILE))
+    overview_mbtiles(filename=args.FILE,
+                     min_zoom=args.min_zoom, max_zoom=args.max_zoom,
+                     kernel=args.kernel, pngdata={'png8': args.png8},
+                     processes=args.processes)
+    return 0
+
+
+def parse_transcode_args(args):
+    """Parses command-line `args` for the transcode command"""
+    parser = argparse.ArgumentParser(
+        prog='gdal2mbtiles transcode',
+        description='Re-encodes every image in an MBTiles file in place'
+    )
+    parser.add_argument('-v', '--verbose', action='count',
+                        help='explain what is being done')
+    parser.add_argument('--format', default='png',
+                        choices=['png', 'jpg', 'webp'],
+                        help='Image format of the tiles. Defaults to "png"')
+    parser.add_argument('--png8', default=None, metavar='N', type=png8_arg,
+                        help=('Quantizes 32-bit RGBA to 8-bit RGBA paletted '
+                              'PNGs. Defaults to None (do not quantize)'))
+    parser.add_argument('--optimize', type=int, default=None, metavar='N',
+                        choices=range(8),
+                        help=('Optimizes PNGs with OptiPNG at level N, '
+                              'between 0 and 7. Defaults to None'))
+    parser.add_argument('--jpeg-quality', type=int, default=None,
+                        metavar='N', choices=range(101),
+                        help='JPEG quality, between 0 and 100. Defaults to 75')
+    parser.add_argument('--webp-lossless', action='store_true', default=False,
+                        help='Compress WebP losslessly.')
+    parser.add_argument('--webp-quality', type=int, default=None,
+                        metavar='N', choices=range(101),
+                        help=('WebP lossy quality, between 0 and 100. '
+                              'Defaults to 75'))
+    parser.add_argument('--webp-effort', type=int, default=None,
+                        metavar='N', choices=range(7),
+                        help=('WebP effort spent compressing, from 0 '
+                              '(fastest) to 6 (smallest). Defaults to 4'))
+    parser.add_argument('--processes', type=int, default=None, metavar='N',
+                        help=('Number of images to encode at once. '
+                              'Defaults to the number of CPUs.'))
+    parser.add_argument('FILE', help='MBTiles file to update in place.')
+    args = parser.parse_args(args=args)
+
+    if args.format != 'png' and (args.png8 or args.optimize is not None):
+        parser.error('--png8 and --optimize need --format png')
+    if args.format != 'jpg' and args.jpeg_quality is not None:
+        parser.error('--jpeg-quality needs --format jpg')
+    if args.format != 'webp' and (args.webp_lossless or
+                                  args.webp_quality is not None or
+                                  args.webp_effort is not None):
+        parser.error('--webp-lossless, --webp-quality and --webp-effort need '
+                     '--format webp')
+    if args.processes is not None and args.processes < 1:
+        parser.error('--processes must be at least 1')
+    return args
+
+
+def transcode_main(args=None, use_logging=True):
+    args = parse_transcode_args(args=args)
+
+    if use_logging:
+        configure_logging(args)
+
+    from gdal2mbtiles.helpers import transcode_mbtiles
+    from gdal2mbtiles.renderers import (JpegRenderer, PngRenderer,
+                                        WebpRenderer)
+
+    if args.format == 'jpg':
+        renderer = JpegRenderer(compression=args.jpeg_quality)
+    elif args.format == 'webp':
+        renderer = WebpRenderer(lossless=args.webp_lossless,
+                                quality=args.webp_quality,
+                                effort=args.webp_effort)
+    else:
+        renderer = PngRenderer(png8=args.png8, optimize=args.optimize)
+
+    logging.info('Transcoding {0} to {1}'.format(args.FILE, args.format))
+    transcode_mbtiles(filename=args.FILE, renderer=renderer,
+                      processes=args.processes)
+    return 0
+
+
+def parse_tune_args(args):
+    """Parses command-line `args` for the tune command"""
+    parser = argparse.ArgumentParser(
+        prog='gdal2mbtiles tune',
+        description=('Benchmarks encoding settings on a sample of the tiles '
+                     'of a GDAL-readable file')
+    )
+    parser.add_argument('-v', '--verbose', action='count',
+                        help='explain what is being done')
+    parser.add_argument('--count', type=int, default=200, metavar='N',
+                        help=('Number of tiles to sample across the zoom '
+                              'levels. Defaults to 200.'))
+    parser.add_argument('--format', action='append', default=None,
+                        dest='formats', choices=['png', 'jpg', 'webp'],
+                        help=('Image format to try. May be repeated. '
+                              'Defaults to all of them.'))
+    parser.add_argument('--max-size', type=float, default=None,
+                        metavar='KIB',
+                        help=('Recommend the fastest settings whose tiles '
+                              'average at most KIB kibibytes.'))
+    parser.add_argument('--max-time', type=float, default=None,
+                        metavar='MS',
+                        help=('Recommend settings that encode a tile in at '
+                              'most MS milliseconds on average.'))
+    parser.add_argument('--mbtiles', action='store_true', default=False,
+                        help=('Sample the tiles of FILE, an MBTiles file '
+                              'that was already rendered, instead of '
+                              'slicing them from a GDAL-readable FILE.'))
+    parser.add_argument('FILE', help='GDAL-readable file to sample tiles of.')
+
+    group = parser.add_argument_group(title='Raster arguments')
+    group.add_argument('--spatial-reference', type=int, default=None,
+                       help=('Destination EPSG spatial reference. '
+                             'Defaults to 3857'))
+    group.add_argument('--resampling', default=None,
+                       choices=list(RESAMPLING_METHODS.values()),
+                       help=('Resampling algorithm for warping. '
+                             'Defaults to "near" (nearest-neighbour)'))
+    group.add_argument('--min-resolution', type=int, default=None,
+                       help=('Minimum resolution to sample tiles from. '
+                             'Defaults to None (do not downsample)'))
+    group.add_argument('--max-resolution', type=int, default=None,
+                       help=('Maximum resolution to sample tiles from. '
+                             'Defaults to None (do not upsample)'))
+    group.add_argument('--coloring', default=None,
+                       choices=COLORING_METHODS,
+                       help='Coloring algorithm.')
+    group.add_argument('--color', dest='colors', action='append',
+                       type=color_arg, metavar='BAND-VALUE:HTML-COLOR',
+                       help=('Examples: --color="0:#ff00ff" --color=255:red'))
+    group.add_argument('--colorize-band', metavar='COLORIZE-BAND',
+                       type=colorize_band_arg, default=None,
+                       help='Raster band to colorize. Defaults to 1')
+    args = parser.parse_args(args=args)
+
+    if args.count < 1:
+        parser.error('--count must be at least 1')
+
+    if args.mbtiles:
+        if any(value is not None for value in (
+                args.spatial_reference, args.resampling,
+                args.min_resolution, args.max_resolution, args.coloring,
+                args.colors, args.colorize_band)):
+            parser.error('--mbtiles cannot be used with raster arguments')
+    else:
+        if args.spatial_reference is None:
+            args.spatial_reference = 3857
+        # Make sure that --color and --coloring match up
+        if args.coloring is None and (args.colors or
+                                      args.colorize_band is not None):
+            parser.error('must provide --coloring')
+        elif args.coloring is not None and not args.colors:
+            parser.error('must provide at least one --color')
+        # Transform choices into ColorBase classes
+        args.coloring = coloring_arg(args.coloring)
+    if args.formats is None:
+        args.formats = ['png', 'jpg', 'webp']
+    return args
+
+
+def tune_renderers(formats):
+    """Returns a list of (label, renderer) for the tune command to try."""
+    from gdal2mbtiles.renderers import (HybridRenderer, JpegRenderer,
+                                        PngRenderer, WebpRenderer)
+
+    result = []
+    if 'png' in formats:
+        for compression in range(1, 10):
+            result.append(('png compression={0}'.format(compression),
+                           PngRenderer(compression=compression)))
+        result.append(('png interlace', PngRenderer(interlace=True)))
+        for png8 in (16, 64, 256):
+            result.append(('png png8={0}'.format(png8),
+                           PngRenderer(png8=png8)))
+    if 'jpg' in formats:
+        # Tiles with transparency stay PNG, as with --hybrid
+        for quality in (50, 75, 90):
+            result.append((
+                'jpg quality={0} hybrid'.format(quality),
+                HybridRenderer(opaque=JpegRenderer(compression=quality))
+            ))
+    if 'webp' in formats:
+        for quality in (50, 75, 90):
+            result.append(('webp quality={0}'.format(quality),
+                           WebpRenderer(quality=quality)))
+        for effort in (0, 6):
+            result.append(('webp effort={0}'.format(effort),
+                           WebpRenderer(effort=effort)))
+        result.append(('webp lossless', WebpRenderer(lossless=True)))
+    return result
+
+
+def tune_main(args=None, use_logging=True):
+    args = parse_tune_args(args=args)
+
+    if use_logging:
+        configure_logging(args)
+
+    from gdal2mbtiles.helpers import (recommend_renderer, tune_mbtiles,
+                                      tune_raster)
+
+    candidates = tune_renderers(args.formats)
+    renderers = [renderer for _, renderer in candidates]
+    labels = dict((id(renderer), label) for label, renderer in candidates)
+    logging.info('Sampling {0} tiles from {1}'.format(args.count, args.FILE))
+    if args.mbtiles:
+        results = tune_mbtiles(filename=args.FILE, renderers=renderers,
+                               count=args.count)
+    else:
+        colors = None
+        if args.coloring:
+            colors = args.coloring(args.colors)
+        results = tune_raster(
+            inputfile=args.FILE, renderers=renderers, count=args.count,
+            colors=colors, band=args.colorize_band,
+            spatial_ref=SpatialReference.FromEPSG(args.spatial_reference),
+            resampling=args.resampling,
+            min_resolution=args.min_resolution,
+            max_resolution=args.max_resolution
+        )
+
+    print('{0:<24} {1:>10} {2:>10}'.format('SETTINGS', 'KIB/TILE',
+                                          'MS/TILE'))
+    for renderer, size, seconds in results:
+        if size is None:
+            print('{0:<24} {1:>21}'.format(labels[id(renderer)],
+                                           'unavailable'))
+        else:
+            print('{0:<24} {1:>10.2f} {2:>10.2f}'.format(
+                labels[id(renderer)], size / 1024, seconds * 1000
+            ))
+
+    max_size = max_seconds = None
+    if args.max_size is not None:
+        max_size = args.max_size * 1024
+    if args.max_time is not None:
+        max_seconds = args.max_time / 1000
+    best = recommend_renderer(results, max_size=max_size,
+                              max_seconds=max_seconds)
+    if best is None:
+        print('No settings meet the targets')
+        return 1
+    print('Recommended: {0}'.format(labels[id(best)]))
+    return 0
+
+
+COMMANDS = {
+    'apply': apply_main,
+    'diff': diff_main,
+    'extract': extract_main,
+    'overviews': overviews_main,
+    'transcode': transcode_main,
+    'tune': tune_main,
+}
+
+
 def main(args=None, use_logging=True):
     if args is None:
         args = sys.argv[1:]
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args=args[1:], use_logging=use_logging)
     args = parse_args(args=args)
 
     if use_logging:
@@ -268,7 +819,11 @@ def main(args=None, use_logging=True):
 
     # HACK: Import here, so that VIPS doesn't parse sys.argv!!!
     # In vimagemodule.cxx, SWIG_init actually does argument parsing
+    from gdal2mbtiles.caches import TileCache, WarpCache
     from gdal2mbtiles.helpers import warp_mbtiles
+    from gdal2mbtiles.renderers import (DataRenderer, HybridRenderer,
+                                        JpegRenderer, PngRenderer,
+                                        WebpRenderer)
 
     with input_output(inputfile=args.INPUT,
                       outputfile=args.OUTPUT) as (inputfile, outputfile):
@@ -285,28 +840,73 @@ def main(args=None, use_logging=True):
         spatial_ref = SpatialReference.FromEPSG(args.spatial_reference)
 
         # Coloring
-        if not args.coloring:
-            colors = band = None
-        else:
+        colors = None
+        band = args.colorize_band
+        if args.coloring:
             colors = args.coloring(args.colors)
-            band = args.colorize_band
 
-        # PNG rendering
-        pngdata = {'png8': args.png8}
+        # Rendering
+        pngdata = {'png8': args.png8, 'effort': args.png8_effort}
+        if args.format == 'jpg':
+            renderer = JpegRenderer()
+        elif args.format == 'webp':
+            renderer = WebpRenderer(lossless=args.webp_lossless,
+                                    quality=args.webp_quality,
+                                    effort=args.webp_effort)
+        elif args.format == 'tiff':
+            renderer = DataRenderer()
+        else:
+            renderer = None
+        if args.hybrid:
+            renderer = HybridRenderer(opaque=renderer,
+                                      transparent=PngRenderer(**pngdata))
+
+        cache = None
+        if args.cache is not None:
+            cache_size = None
+            if args.cache_size is not None:
+                cache_size = args.cache_size * 1024 ** 2
+            cache = TileCache(directory=args.cache, max_size=cache_size)
+
+        warp_cache = None
+        if args.warp_cache is not None:
+            cache_size = None
+            if args.warp_cache_size is not None:
+                cache_size = args.warp_cache_size * 1024 ** 2
+            warp_cache = WarpCache(directory=args.warp_cache,
+                                   max_size=cache_size)
+
+        # Staging
+        memory_limit = None
+        if args.memory_limit is not None:
+            memory_limit = args.memory_limit * 1024 ** 2
 
         warp_mbtiles(inputfile=inputfile.name, outputfile=outputfile.name,
                      # MBTiles
                      metadata=metadata,
                      # GDAL
                      spatial_ref=spatial_ref, resampling=args.resampling,
+                     warp_threads=args.warp_threads,
+                     warp_memory=args.warp_memory,
+                     warp_cache=warp_cache,
                      # Rendering
                      min_resolution=args.min_resolution,
                      max_resolution=args.max_resolution,
                      fill_borders=args.fill_borders,
                      zoom_offset=args.zoom_offset,
+                     order=args.tile_order,
+                     renderer=renderer,
                      pngdata=pngdata,
+                     compact=args.compact,
+                     staging=args.staging,
+                     checkpoint=args.checkpoint,
+                     memory_limit=memory_limit,
+                     append=args.append,
+                     overzoom=args.overzoom,
+                     cache=cache,
+                     shared_palette=args.shared_palette,
                      # Coloring
-                     colors=colors, band=band)
+                     colors=colors, band=band, indexed=args.indexed)
         return 0
 
 
@@ -20,11 +20,15 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
 from distutils.version import LooseVersion
 import errno
+from math import ceil, floor, log, pi, radians, tan
 import os
 import sqlite3
-from struct import pack, unpack
+from struct import calcsize, pack, unpack, unpack_from
 
 try:
      from UserDict import DictMixin
@@ -37,7 +41,7 @@ except NameError:
   basestring = str
 
 from .gd_types import enum
-from .utils import rmfile
+from .utils import hilbert_coordinates, hilbert_index, rmfile
 
 
 class MBTilesError(RuntimeError):
@@ -248,7 +252,8 @@ class Metadata_1_1(Metadata_1_0):
     version: The version of the tileset, as a plain number.
     description: A description of the layer as plain text.
     format: The image file format of the tile data:
-            mbtiles.FORMATS.PNG or mbtiles.FORMATS.JPG
+            mbtiles.FORMATS.PNG, mbtiles.FORMATS.JPG, mbtiles.FORMATS.WEBP
+            or mbtiles.FORMATS.TIFF, for data tiles of raw values
 
     Optional metadata:
     bounds: The maximum extent of the rendered map area. Bounds must define
@@ -263,7 +268,9 @@ class Metadata_1_1(Metadata_1_0):
     OPTIONAL = Metadata_1_0.OPTIONAL + ('bounds',)
 
     FORMATS = enum(PNG='png',
-                   JPG='jpg')
+                   JPG='jpg',
+                   WEBP='webp',
+                   TIFF='tiff')
 
     def _clean_format(self, value):
         if value not in self.FORMATS:
@@ -308,7 +315,8 @@ class Metadata_1_2(Metadata_1_1):
     version: The version of the tileset, as a plain number.
     description: A description of the layer as plain text.
     format: The image file format of the tile data:
-            mbtiles.FORMATS.PNG or mbtiles.FORMATS.JPG
+            mbtiles.FORMATS.PNG, mbtiles.FORMATS.JPG, mbtiles.FORMATS.WEBP
+            or mbtiles.FORMATS.TIFF, for data tiles of raw values
 
     Optional metadata:
     bounds: The maximum extent of the rendered map area. Bounds must define
@@ -324,11 +332,364 @@ class Metadata_1_2(Metadata_1_1):
     OPTIONAL = Metadata_1_1.OPTIONAL + ('attribution',)
 
 
+# The compact schema stores the Z/X/Y coordinates of each tile as a single
+# packed integer: 8 bits of zoom level, then 28 bits each of column and row.
+# Packed keys sort in the same order as (zoom_level, tile_column, tile_row).
+#
+# With the 'hilbert' order, the 56 bits below the zoom level hold the
+# distance of the tile along a Hilbert curve over its zoom level instead, so
+# that neighbouring tiles sort close together. Such keys are stored in a
+# hilbert_key column instead of tile_key.
+TILE_KEY_ZOOM_SHIFT = 56
+TILE_KEY_COLUMN_SHIFT = 28
+TILE_KEY_MASK = (1 << TILE_KEY_COLUMN_SHIFT) - 1
+TILE_KEY_INDEX_MASK = (1 << TILE_KEY_ZOOM_SHIFT) - 1
+TILE_KEY_ORDERS = ('row', 'hilbert')
+TILE_KEY_COLUMNS = {'row': 'tile_key', 'hilbert': 'hilbert_key'}
+
+
+def pack_tile_key(x, y, z, order=None):
+    """
+    Returns the packed integer key for TMS coordinates `x`, `y`, `z`.
+
+    order: One of TILE_KEY_ORDERS. Defaults to 'row'.
+    """
+    if order is None:
+        order = 'row'
+    if order not in TILE_KEY_ORDERS:
+        raise ValueError(
+            'order {0!r} must be one of: {1}'.format(
+                order, ', '.join(TILE_KEY_ORDERS)
+            )
+        )
+    if not 0 <= z <= TILE_KEY_COLUMN_SHIFT:
+        raise ValueError(
+            'z {0!r} must be between 0 and {1}'.format(z,
+                                                      TILE_KEY_COLUMN_SHIFT)
+        )
+    # The Hilbert curve only covers the tiles of zoom level z
+    last = (1 << z) - 1 if order == 'hilbert' else TILE_KEY_MASK
+    if not (0 <= x <= last and 0 <= y <= last):
+        raise ValueError(
+            'Invalid tile coordinates: {0!r}'.format((x, y, z))
+        )
+    if order == 'hilbert':
+        return (z << TILE_KEY_ZOOM_SHIFT) | hilbert_index(order=z, x=x, y=y)
+    return (z << TILE_KEY_ZOOM_SHIFT) | (x << TILE_KEY_COLUMN_SHIFT) | y
+
+
+def unpack_tile_key(key, order=None):
+    """
+    Returns the TMS coordinates (x, y, z) for a packed integer `key`.
+
+    order: One of TILE_KEY_ORDERS. Defaults to 'row'.
+    """
+    z = key >> TILE_KEY_ZOOM_SHIFT
+    if order == 'hilbert':
+        x, y = hilbert_coordinates(order=z, d=key & TILE_KEY_INDEX_MASK)
+        return x, y, z
+    return ((key >> TILE_KEY_COLUMN_SHIFT) & TILE_KEY_MASK,
+            key & TILE_KEY_MASK,
+            z)
+
+
+def _zoom_key_range(z):
+    """
+    Returns the first and last packed keys of zoom level `z`, in any
+    TILE_KEY_ORDERS.
+    """
+    return (z << TILE_KEY_ZOOM_SHIFT,
+            ((z + 1) << TILE_KEY_ZOOM_SHIFT) - 1)
+
+
+def tile_id(hashed):
+    """Returns the tile_id for an image hash, as used in the images table."""
+    # tile_id must be a 64-bit signed integer, but hashing functions
+    # produce unsigned integers.
+    return unpack(b'q', pack(b'Q', hashed & 0xffffffffffffffff))[0]
+
+
+def tile_format(data):
+    """
+    Returns the format of the tile `data`, from its signature, or None.
+
+    Tiles rendered by HybridRenderer mix formats within one file, so the
+    format metadata is not enough to decode them.
+    """
+    header = bytes(data[:12])
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    return None
+
+
+# Luminance quantization table of the JPEG standard, which libjpeg scales
+# by the quality setting.
+JPEG_LUMINANCE_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+
+def _jpeg_luminance_table(quality):
+    """
+    Returns the sorted luminance table that libjpeg saves at `quality`.
+    """
+    if quality < 50:
+        scale = 5000 // quality
+    else:
+        scale = 200 - quality * 2
+    return sorted(max(1, min(255, (value * scale + 50) // 100))
+                  for value in JPEG_LUMINANCE_TABLE)
+
+
+def jpeg_quality(data):
+    """
+    Returns the libjpeg quality level, from 1 to 100, that JPEG `data` was
+    most likely saved with, or None if it has no luminance table.
+
+    The quality is the one whose scaled standard luminance table is closest
+    to the table in `data`, so it is exact for tiles saved by libjpeg.
+    """
+    data = bytearray(data)
+    offset = 2
+    while offset + 4 <= len(data) and data[offset] == 0xff:
+        marker = data[offset + 1]
+        length = (data[offset + 2] << 8) | data[offset + 3]
+        if marker == 0xda:
+            # Start of scan, so there are no more tables
+            break
+        if marker == 0xdb:
+            # Define quantization tables. Each is an info byte with the
+            # precision and table number, followed by 64 values.
+            table = offset + 4
+            while table < offset + 2 + length:
+                precision, number = data[table] >> 4, data[table] & 0x0f
+                size = 2 if precision else 1
+                values = data[table + 1:table + 1 + 64 * size]
+                if number == 0:
+                    if size == 2:
+                        values = [(values[i] << 8) | values[i + 1]
+                                  for i in range(0, len(values), 2)]
+                    # Tables are stored in zigzag order, so compare them
+                    # sorted
+                    values = sorted(values)
+                    return min(
+                        range(1, 101),
+                        key=lambda quality: sum(
+                            abs(a - b) for a, b in
+                            zip(values, _jpeg_luminance_table(quality))
+                        )
+                    )
+                table += 1 + 64 * size
+        offset += 2 + length
+    return None
+
+
+# Coverage bitmaps are stored as runs of tiles sharing the same state. Each
+# run is a state byte followed by an unsigned 32-bit length.
+COVERAGE_RUN = b'<BI'
+COVERAGE_RUN_SIZE = calcsize(COVERAGE_RUN)
+COVERAGE_RUN_MAX = 0xffffffff
+
+
+def _pack_runs(runs):
+    """Returns the binary encoding of `runs`, a list of (state, length)."""
+    result = []
+    for state, length in runs:
+        while length > 0:
+            result.append(pack(COVERAGE_RUN, state,
+                               min(length, COVERAGE_RUN_MAX)))
+            length -= COVERAGE_RUN_MAX
+    return b''.join(result)
+
+
+def _unpack_runs(data):
+    """
+    Decodes binary `data` from `_pack_runs`.
+
+    Returns (ends, states), where run i covers the cells from ends[i - 1] up
+    to, but not including, ends[i].
+    """
+    ends = []
+    states = []
+    end = 0
+    for offset in range(0, len(data), COVERAGE_RUN_SIZE):
+        state, length = unpack_from(COVERAGE_RUN, data, offset)
+        end += length
+        if states and states[-1] == state:
+            ends[-1] = end
+        else:
+            ends.append(end)
+            states.append(state)
+    return ends, states
+
+
+# Latitude limit of the spherical mercator tiling scheme
+MERCATOR_MAX_LATITUDE = 85.0511287798066
+
+
+def tile_range(bounds, z):
+    """
+    Returns the TMS tiles (min_x, min_y, max_x, max_y) that intersect
+    `bounds` at zoom level `z`.
+
+    bounds: (left, bottom, right, top) in WGS84 longitude and latitude.
+    """
+    left, bottom, right, top = bounds
+    if left > right or bottom > top:
+        raise ValueError('Invalid bounds: {0!r}'.format(bounds))
+
+    def column(lon):
+        return (lon + 180.0) / 360.0 * (1 << z)
+
+    def row(lat):
+        # TMS rows count upwards from the south
+        lat = max(-MERCATOR_MAX_LATITUDE, min(lat, MERCATOR_MAX_LATITUDE))
+        return (1 + log(tan(pi / 4 + radians(lat) / 2)) / pi) / 2 * (1 << z)
+
+    def clamp(i):
+        return max(0, min(int(i), (1 << z) - 1))
+
+    min_x, min_y = clamp(floor(column(left))), clamp(floor(row(bottom)))
+    # Tiles that only touch the right or top edge are excluded
+    max_x = max(min_x, clamp(ceil(column(right)) - 1))
+    max_y = max(min_y, clamp(ceil(row(top)) - 1))
+    return min_x, min_y, max_x, max_y
+
+
+def _hilbert_zxy_sql(key):
+    """
+    Returns SQL expressions for the Z/X/Y coordinates of a Hilbert `key`.
+
+    Each coordinate is unpacked by a recursive query, like
+    `hilbert_coordinates`, which is much slower than unpacking keys in the
+    'row' order, but lets any SQLite client read the tiles view.
+    """
+    z = '({0} >> {1})'.format(key, TILE_KEY_ZOOM_SHIFT)
+    # Bits of the distance t that pick the quadrant at each level
+    rx = '((t >> 1) & 1)'
+    ry = '((t + (t >> 1)) & 1)'
+    query = (
+        '(WITH RECURSIVE h(s, t, x, y) AS ('
+        'SELECT 1, {key} & {mask}, 0, 0 '
+        'UNION ALL '
+        'SELECT s << 1, t >> 2, '
+        'CASE WHEN {ry} THEN x WHEN {rx} THEN s - 1 - y ELSE y END '
+        '+ s * {rx}, '
+        'CASE WHEN {ry} THEN y WHEN {rx} THEN s - 1 - x ELSE x END '
+        '+ s * {ry} '
+        'FROM h WHERE s < 1 << {z}) '
+        'SELECT {{0}} FROM h WHERE s >= 1 << {z})'
+    ).format(key=key, mask=TILE_KEY_INDEX_MASK, rx=rx, ry=ry, z=z)
+    return z, query.format('x'), query.format('y')
+
+
+def _hilbert_key_sql(z, x, y):
+    """
+    Returns an SQL expression for the Hilbert key of the Z/X/Y expressions
+    `z`, `x` and `y`, packed by a recursive query like `hilbert_index`.
+    """
+    n = '(1 << {0})'.format(z)
+    # Bits of the coordinates that pick the quadrant at each level
+    rx = '((x & s) > 0)'
+    ry = '((y & s) > 0)'
+    return (
+        '(WITH RECURSIVE h(s, x, y, d) AS ('
+        'SELECT {n} >> 1, {x}, {y}, 0 '
+        'UNION ALL '
+        'SELECT s >> 1, '
+        'CASE WHEN {ry} THEN x WHEN {rx} THEN {n} - 1 - y ELSE y END, '
+        'CASE WHEN {ry} THEN y WHEN {rx} THEN {n} - 1 - x ELSE x END, '
+        'd + s * s * (3 * {rx} + {ry} - 2 * {rx} * {ry}) '
+        'FROM h WHERE s > 0) '
+        'SELECT ({z} << {shift}) | d FROM h WHERE s = 0)'
+    ).format(n=n, x=x, y=y, z=z, rx=rx, ry=ry, shift=TILE_KEY_ZOOM_SHIFT)
+
+
+def _zxy_sql(table, order):
+    """
+    Returns SQL expressions for the Z/X/Y columns of a map `table`.
+
+    order: Order of the packed keys of `table`, or None for the standard
+           schema. See `MBTiles.key_order`.
+    """
+    if order is None:
+        return ('{0}.zoom_level'.format(table),
+                '{0}.tile_column'.format(table),
+                '{0}.tile_row'.format(table))
+    if order == 'hilbert':
+        return _hilbert_zxy_sql(
+            key='{0}.{1}'.format(table, TILE_KEY_COLUMNS[order])
+        )
+    return ('({0}.tile_key >> {1})'.format(table, TILE_KEY_ZOOM_SHIFT),
+            '(({0}.tile_key >> {1}) & {2})'.format(table,
+                                                   TILE_KEY_COLUMN_SHIFT,
+                                                   TILE_KEY_MASK),
+            '({0}.tile_key & {1})'.format(table, TILE_KEY_MASK))
+
+
+def _key_sql(table, order, key_order):
+    """
+    Returns an SQL expression for the packed key of a map `table`, in
+    `key_order`.
+
+    order: Order of the packed keys of `table`, or None for the standard
+           schema.
+    """
+    if order == key_order:
+        return '{0}.{1}'.format(table, TILE_KEY_COLUMNS[order])
+    z, x, y = _zxy_sql(table=table, order=order)
+    if key_order == 'hilbert':
+        return _hilbert_key_sql(z=z, x=x, y=y)
+    return '(({0} << {1}) | ({2} << {3}) | {4})'.format(
+        z, TILE_KEY_ZOOM_SHIFT, x, TILE_KEY_COLUMN_SHIFT, y
+    )
+
+
+def _match_sql(outer, outer_order, inner, inner_order):
+    """
+    Returns an SQL condition matching rows of `outer` with rows of `inner`.
+
+    outer_order, inner_order: Orders of the packed keys of each table, or
+                              None for the standard schema.
+
+    The condition is written so that lookups into `inner` use its primary key.
+    """
+    if inner_order is not None:
+        return '{0} = {1}'.format(
+            _key_sql(table=inner, order=inner_order, key_order=inner_order),
+            _key_sql(table=outer, order=outer_order, key_order=inner_order)
+        )
+    return ' AND '.join(
+        '{0} = {1}'.format(i, o)
+        for i, o in zip(_zxy_sql(table=inner, order=None),
+                        _zxy_sql(table=outer, order=outer_order))
+    )
+
+
 class MBTiles(object):
     """Represents an MBTiles file."""
 
     Metadata = Metadata
 
+    # States of the tiles in a coverage bitmap
+    COVERAGE = enum(MISSING=0, TILE=1, EMPTY=2)
+
+    # Number of decoded tiles kept for overzooming. See `get`.
+    OVERZOOM_CACHE_SIZE = 16
+
     # Pragmas for the SQLite connection
     _connection_options = {
         'auto_vacuum': 'NONE',
@@ -346,6 +707,13 @@ class MBTiles(object):
         self._conn = None
         self._metadata = None
         self._version = version
+        self._compact = None
+        self._key_order = None
+        self._coverage = {}
+        self._has_coverage = None
+        self._stale_coverage = set()
+        self._ancestors = OrderedDict()
+        self._page_size = None
 
         self.open(options=options, create=create)
 
@@ -379,6 +747,13 @@ class MBTiles(object):
 
     def _open(self, options=None, create=False):
         self.close()
+        self._compact = None
+        self._key_order = None
+        self._coverage = {}
+        self._has_coverage = None
+        self._stale_coverage = set()
+        self._ancestors = OrderedDict()
+        self._page_size = None
 
         if self.filename != ':memory:':
             mode = 'wb' if create else 'rb'
@@ -409,21 +784,42 @@ class MBTiles(object):
         return self._conn
 
     @classmethod
-    def create(cls, filename, metadata, version=None):
-        """Create a new MBTiles file. See `Metadata`"""
+    def create(cls, filename, metadata, version=None, compact=False,
+               order=None):
+        """
+        Create a new MBTiles file. See `Metadata`
+
+        compact: Use the compact schema, see `_create`.
+        order: Order of the packed keys of the compact schema, see `_create`.
+        """
         if version is None:
             version = cls.Metadata._detect(keys=list(metadata.keys()))
-        mbtiles = cls._create(filename=filename, version=version)
+        mbtiles = cls._create(filename=filename, version=version,
+                              compact=compact, order=order)
         mbtiles.metadata._setup(metadata)
         return mbtiles
 
     @classmethod
-    def _create(cls, filename, version):
+    def _create(cls, filename, version, compact=False, order=None):
         """
         Creates a new MBTiles file named `filename`.
 
         If `filename` already exists, it gets deleted and recreated.
+
+        If `compact` is True, the map table is keyed by a single packed
+        integer instead of a composite (zoom_level, tile_column, tile_row)
+        primary key. See `pack_tile_key`. `order` is one of
+        TILE_KEY_ORDERS, and defaults to 'row'.
         """
+        if order is None:
+            order = 'row'
+        if order not in TILE_KEY_ORDERS:
+            raise ValueError(
+                'order {0!r} must be one of: {1}'.format(
+                    order, ', '.join(TILE_KEY_ORDERS)
+                )
+            )
+
         # The MBTiles spec defines a tiles table as:
         #     CREATE TABLE tiles (
         #         zoom_level INTEGER,
@@ -454,30 +850,67 @@ class MBTiles(object):
                 """
             )
 
-            # Then we reference the Z/X/Y coordinates in the map table.
-            conn.execute(
-                """
-                CREATE TABLE map (
-                    zoom_level INTEGER NOT NULL,
-                    tile_column INTEGER NOT NULL,
-                    tile_row INTEGER NOT NULL,
-                    tile_id INTEGER NOT NULL
-                        REFERENCES images (tile_id)
-                        ON DELETE CASCADE ON UPDATE CASCADE,
-                    PRIMARY KEY (zoom_level, tile_column, tile_row)
+            if compact:
+                # Then we reference the packed Z/X/Y coordinates in the map
+                # table. An INTEGER PRIMARY KEY is the rowid itself, so the
+                # rows are stored in a single B-tree ordered by the key,
+                # without a separate index for the primary key. With Hilbert
+                # keys, neighbouring tiles are stored close together.
+                conn.execute(
+                    """
+                    CREATE TABLE map (
+                        {key} INTEGER PRIMARY KEY,
+                        tile_id INTEGER NOT NULL
+                            REFERENCES images (tile_id)
+                            ON DELETE CASCADE ON UPDATE CASCADE
+                    )
+                    """.format(key=TILE_KEY_COLUMNS[order])
                 )
-                """
-            )
 
-            # Finally, we emulate the tiles table using a view.
-            conn.execute(
-                """
-                CREATE VIEW tiles AS
-                    SELECT zoom_level, tile_column, tile_row, tile_data
-                    FROM map, images
-                    WHERE map.tile_id = images.tile_id
-                """
-            )
+                # Finally, we emulate the tiles table using a view that
+                # unpacks the coordinates. Hilbert keys take a recursive
+                # query per row, so the view is slow for readers that scan
+                # it, while this class looks tiles up by key instead.
+                zoom_level, tile_column, tile_row = _zxy_sql(table='map',
+                                                             order=order)
+                conn.execute(
+                    """
+                    CREATE VIEW tiles AS
+                        SELECT {zoom_level} AS zoom_level,
+                               {tile_column} AS tile_column,
+                               {tile_row} AS tile_row,
+                               tile_data
+                        FROM map, images
+                        WHERE map.tile_id = images.tile_id
+                    """.format(zoom_level=zoom_level,
+                               tile_column=tile_column,
+                               tile_row=tile_row)
+                )
+            else:
+                # Then we reference the Z/X/Y coordinates in the map table.
+                conn.execute(
+                    """
+                    CREATE TABLE map (
+                        zoom_level INTEGER NOT NULL,
+                        tile_column INTEGER NOT NULL,
+                        tile_row INTEGER NOT NULL,
+                        tile_id INTEGER NOT NULL
+                            REFERENCES images (tile_id)
+                            ON DELETE CASCADE ON UPDATE CASCADE,
+                        PRIMARY KEY (zoom_level, tile_column, tile_row)
+                    )
+                    """
+                )
+
+                # Finally, we emulate the tiles table using a view.
+                conn.execute(
+                    """
+                    CREATE VIEW tiles AS
+                        SELECT zoom_level, tile_column, tile_row, tile_data
+                        FROM map, images
+                        WHERE map.tile_id = images.tile_id
+                    """
+                )
 
             # We also need a table to store metadata.
             conn.execute(
@@ -491,6 +924,381 @@ class MBTiles(object):
 
         return mbtiles
 
+    def backup(self, filename):
+        """
+        Copies this database into the file `filename`, replacing it.
+
+        Uses SQLite's online backup API, which requires Python 3.7 or later.
+        """
+        if not hasattr(self._conn, 'backup'):
+            raise MBTilesError(
+                'Backing up MBTiles files requires Python 3.7 or later.'
+            )
+        conn = sqlite3.connect(filename)
+        try:
+            self._conn.backup(conn)
+        finally:
+            conn.close()
+
+    @property
+    def size(self):
+        """Returns the size of the database in bytes."""
+        if self._page_size is None:
+            # Only a VACUUM changes the page size of a database in use
+            self._page_size = \
+                self._conn.execute('PRAGMA page_size').fetchone()[0]
+        page_count = self._conn.execute('PRAGMA page_count').fetchone()[0]
+        return self._page_size * page_count
+
+    @property
+    def compact(self):
+        """Returns True if this file uses the compact schema."""
+        if self._compact is None:
+            self._key_order = self._read_key_order(name='main')
+            self._compact = self._key_order is not None
+        return self._compact
+
+    @property
+    def key_order(self):
+        """
+        Returns the order of the packed keys, one of TILE_KEY_ORDERS, if
+        this file uses the compact schema, otherwise None.
+        """
+        if self.compact:
+            return self._key_order
+        return None
+
+    @property
+    def _key_column(self):
+        """Returns the name of the packed key column of the compact schema."""
+        return TILE_KEY_COLUMNS[self.key_order]
+
+    def _read_key_order(self, name):
+        """Returns the `key_order` of the map table of the database `name`."""
+        cursor = self._conn.execute('PRAGMA {0}.table_info(map)'.format(name))
+        columns = [row[1] for row in cursor.fetchall()]
+        for order in TILE_KEY_ORDERS:
+            if TILE_KEY_COLUMNS[order] in columns:
+                return order
+        return None
+
+    @contextmanager
+    def _attached(self, filename, name):
+        """Attaches the database `filename` to this connection as `name`."""
+        self._conn.execute('ATTACH DATABASE :filename AS {0}'.format(name),
+                           {'filename': filename})
+        try:
+            self._conn.executescript(
+                '\n'.join('PRAGMA {0}.{1} = {2};'.format(name, k, v)
+                          for k, v in self._connection_options.items()
+                          if k in ('journal_mode', 'synchronous'))
+            )
+            yield
+        finally:
+            self._conn.execute('DETACH DATABASE {0}'.format(name))
+
+    def diff(self, other, filename):
+        """
+        Writes a patch named `filename` that turns this file into `other`.
+
+        other: MBTiles object or filename of the newer tileset.
+        filename: Name of the patch, which is itself an MBTiles file.
+
+        Tiles are compared by their tile_id, which is a hash of the raw
+        image data, so no tile_data is ever compared. The patch contains the
+        tiles that were added or changed, the images that this file is
+        missing, a `deletions` table listing the tiles that no longer exist,
+        and all the metadata of `other`.
+
+        `other` must not be open for writing by another MBTiles object.
+        """
+        if isinstance(other, MBTiles):
+            other = other.filename
+        with self.__class__(filename=other) as mbtiles:
+            metadata = dict(mbtiles.metadata)
+            version = mbtiles.version
+
+        with self.create(filename=filename, metadata=metadata,
+                         version=version) as patch:
+            with patch._conn:
+                patch._conn.execute(
+                    """
+                    CREATE TABLE deletions (
+                        zoom_level INTEGER NOT NULL,
+                        tile_column INTEGER NOT NULL,
+                        tile_row INTEGER NOT NULL,
+                        PRIMARY KEY (zoom_level, tile_column, tile_row)
+                    )
+                    """
+                )
+
+        with self._attached(filename=other, name='other'), \
+                self._attached(filename=filename, name='patch'):
+            old_order = self.key_order
+            new_order = self._read_key_order(name='other')
+            new_zxy = _zxy_sql(table='n', order=new_order)
+            old_zxy = _zxy_sql(table='o', order=old_order)
+
+            with self._conn:
+                # Tiles that are new or point to a different image
+                self._conn.execute(
+                    """
+                    INSERT INTO patch.map
+                        (zoom_level, tile_column, tile_row, tile_id)
+                    SELECT {z}, {x}, {y}, n.tile_id
+                    FROM other.map AS n
+                    LEFT JOIN main.map AS o ON {match}
+                    WHERE o.tile_id IS NULL OR o.tile_id != n.tile_id
+                    """.format(z=new_zxy[0], x=new_zxy[1], y=new_zxy[2],
+                               match=_match_sql(outer='n',
+                                                outer_order=new_order,
+                                                inner='o',
+                                                inner_order=old_order))
+                )
+
+                # Only ship the images that we don't already have
+                self._conn.execute(
+                    """
+                    INSERT INTO patch.images (tile_id, tile_data)
+                    SELECT i.tile_id, i.tile_data
+                    FROM other.images AS i
+                    WHERE i.tile_id IN (SELECT tile_id FROM patch.map) AND
+                          NOT EXISTS (SELECT 1 FROM main.images AS o
+                                      WHERE o.tile_id = i.tile_id)
+                    """
+                )
+
+                # Tiles that have disappeared
+                self._conn.execute(
+                    """
+                    INSERT INTO patch.deletions
+                        (zoom_level, tile_column, tile_row)
+                    SELECT {z}, {x}, {y}
+                    FROM main.map AS o
+                    WHERE NOT EXISTS (SELECT 1 FROM other.map AS n
+                                      WHERE {match})
+                    """.format(z=old_zxy[0], x=old_zxy[1], y=old_zxy[2],
+                               match=_match_sql(outer='o',
+                                                outer_order=old_order,
+                                                inner='n',
+                                                inner_order=new_order))
+                )
+
+        return self.__class__(filename=filename)
+
+    def zoom_levels(self):
+        """Returns the sorted list of zoom levels that have tiles."""
+        result = []
+        # One primary key lookup per possible zoom level, instead of a scan
+        for z in range(TILE_KEY_COLUMN_SHIFT + 1):
+            if self.compact:
+                first, last = _zoom_key_range(z)
+                cursor = self._conn.execute(
+                    """
+                    SELECT 1 FROM map
+                    WHERE {key} BETWEEN :first AND :last
+                    LIMIT 1
+                    """.format(key=self._key_column),
+                    {'first': first, 'last': last}
+                )
+            else:
+                cursor = self._conn.execute(
+                    'SELECT 1 FROM map WHERE zoom_level = :z LIMIT 1',
+                    {'z': z}
+                )
+            if cursor.fetchone() is not None:
+                result.append(z)
+        return result
+
+    def extract(self, bounds, zooms, dest):
+        """
+        Copies the tiles within `bounds` and `zooms` into a new file `dest`.
+
+        bounds: (left, bottom, right, top) in WGS84 longitude and latitude.
+        zooms: Zoom levels to copy. None copies all of them.
+        dest: Name of the new MBTiles file, which is returned.
+
+        Tiles are selected by ranges of columns and rows at each zoom level,
+        using the spherical mercator tiling scheme, and each image is copied
+        only once. `dest` uses the same schema as this file. Its bounds are
+        clipped to `bounds`.
+        """
+        tile_column, tile_row = _zxy_sql(table='map',
+                                         order=self.key_order)[1:]
+        present = self.zoom_levels()
+        if zooms is None:
+            zooms = present
+        zooms = sorted(set(zooms).intersection(present))
+
+        metadata = dict(self.metadata)
+        left, bottom, right, top = bounds
+        if 'bounds' in metadata:
+            l, b, r, t = [float(v) for v in metadata['bounds'].split(',')]
+            if l < right and b < top and r > left and t > bottom:
+                left, bottom = max(left, l), max(bottom, b)
+                right, top = min(right, r), min(top, t)
+            metadata['bounds'] = ','.join(
+                repr(v) for v in (left, bottom, right, top)
+            )
+        if zooms:
+            for key, value in [('x-minzoom', zooms[0]),
+                               ('x-maxzoom', zooms[-1])]:
+                if key in metadata:
+                    metadata[key] = value
+
+        self.create(filename=dest, metadata=metadata, version=self.version,
+                    compact=self.compact, order=self.key_order).close()
+
+        with self._attached(filename=dest, name='dest'):
+            with self._conn:
+                for z in zooms:
+                    min_x, min_y, max_x, max_y = tile_range(bounds=bounds,
+                                                            z=z)
+                    if self.key_order == 'row':
+                        # Columns are contiguous ranges of packed keys
+                        self._conn.execute(
+                            """
+                            INSERT INTO dest.map (tile_key, tile_id)
+                            SELECT tile_key, tile_id FROM main.map
+                            WHERE tile_key BETWEEN :first AND :last AND
+                                  {y} BETWEEN :min_y AND :max_y
+                            """.format(y=tile_row),
+                            {'first': pack_tile_key(x=min_x, y=0, z=z),
+                             'last': pack_tile_key(x=max_x, y=TILE_KEY_MASK,
+                                                   z=z),
+                             'min_y': min_y, 'max_y': max_y}
+                        )
+                    elif self.compact:
+                        # Hilbert keys are only contiguous within each zoom
+                        # level, so its tiles are filtered by coordinates
+                        first, last = _zoom_key_range(z)
+                        self._conn.execute(
+                            """
+                            INSERT INTO dest.map ({key}, tile_id)
+                            SELECT {key}, tile_id FROM main.map
+                            WHERE {key} BETWEEN :first AND :last AND
+                                  {x} BETWEEN :min_x AND :max_x AND
+                                  {y} BETWEEN :min_y AND :max_y
+                            """.format(key=self._key_column, x=tile_column,
+                                       y=tile_row),
+                            {'first': first, 'last': last,
+                             'min_x': min_x, 'max_x': max_x,
+                             'min_y': min_y, 'max_y': max_y}
+                        )
+                    else:
+                        self._conn.execute(
+                            """
+                            INSERT INTO dest.map
+                                (zoom_level, tile_column, tile_row, tile_id)
+                            SELECT zoom_level, tile_column, tile_row, tile_id
+                            FROM main.map
+                            WHERE zoom_level = :z AND
+                                  tile_column BETWEEN :min_x AND :max_x AND
+                                  tile_row BETWEEN :min_y AND :max_y
+                            """,
+                            {'z': z, 'min_x': min_x, 'max_x': max_x,
+                             'min_y': min_y, 'max_y': max_y}
+                        )
+
+                self._conn.execute(
+                    """
+                    INSERT INTO dest.images (tile_id, tile_data)
+                    SELECT tile_id, tile_data FROM main.images
+                    WHERE tile_id IN (SELECT tile_id FROM dest.map)
+                    """
+                )
+
+        result = self.__class__(filename=dest)
+        if self.has_coverage:
+            result._write_coverage(empty_id=self._coverage_empty_id())
+        return result
+
+    def apply(self, patch):
+        """
+        Applies `patch`, as generated by `diff`, to this file.
+
+        patch: MBTiles object or filename of the patch.
+
+        Images that are no longer referenced by any tile are removed.
+        """
+        if isinstance(patch, MBTiles):
+            patch = patch.filename
+
+        with self._attached(filename=patch, name='patch'):
+            cursor = self._conn.execute(
+                """
+                SELECT COUNT(*) FROM patch.sqlite_master
+                WHERE type = 'table' AND name = 'deletions'
+                """
+            )
+            if not cursor.fetchone()[0]:
+                raise InvalidFileError("Invalid MBTiles patch.")
+
+            order = self.key_order
+            patch_order = self._read_key_order(name='patch')
+            if order is not None:
+                columns = '{0}, tile_id'.format(self._key_column)
+                values = '{0}, p.tile_id'.format(
+                    _key_sql(table='p', order=patch_order, key_order=order)
+                )
+            else:
+                columns = 'zoom_level, tile_column, tile_row, tile_id'
+                values = '{0}, {1}, {2}, p.tile_id'.format(
+                    *_zxy_sql(table='p', order=patch_order)
+                )
+
+            with self._conn:
+                self._conn.execute(
+                    """
+                    DELETE FROM main.map
+                    WHERE EXISTS (SELECT 1 FROM patch.deletions AS d
+                                  WHERE {match})
+                    """.format(match=_match_sql(outer='map',
+                                                outer_order=order,
+                                                inner='d',
+                                                inner_order=None))
+                )
+                self._conn.execute(
+                    """
+                    INSERT OR IGNORE INTO main.images (tile_id, tile_data)
+                    SELECT tile_id, tile_data FROM patch.images
+                    """
+                )
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE INTO main.map ({columns})
+                    SELECT {values} FROM patch.map AS p
+                    """.format(columns=columns, values=values)
+                )
+                self._conn.execute(
+                    """
+                    DELETE FROM main.images
+                    WHERE tile_id NOT IN (SELECT tile_id FROM main.map)
+                    """
+                )
+
+                # The patch carries the complete metadata of the new file
+                self._conn.execute(
+                    """
+                    DELETE FROM main.metadata
+                    WHERE name NOT IN (SELECT name FROM patch.metadata)
+                    """
+                )
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE INTO main.metadata (name, value)
+                    SELECT name, value FROM patch.metadata
+                    """
+                )
+
+        # The metadata version may have changed
+        self._version = None
+        self._metadata = None
+
+        # Rebuild the coverage bitmaps, if this file has them
+        if self.has_coverage:
+            self._write_coverage(empty_id=self._coverage_empty_id())
+
     @property
     def version(self):
         if self._version is None:
@@ -518,9 +1326,7 @@ class MBTiles(object):
         hashed: Integer hash of the raw image data, not compressed or encoded.
         data: Compressed and encoded image buffer.
         """
-        # tile_id must be a 64-bit signed integer, but hashing functions
-        # produce unsigned integers.
-        hashed = unpack(b'q', pack(b'Q', hashed & 0xffffffffffffffff))[0]
+        hashed = tile_id(hashed)
         with self._conn:
             if data is not None:
                 # Insert tile data into images
@@ -533,48 +1339,717 @@ class MBTiles(object):
                 )
 
             # Always associate map with image
-            self._conn.execute(
+            if self.compact:
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE INTO map ({key}, tile_id)
+                    VALUES (:key, :hashed)
+                    """.format(key=self._key_column),
+                    {'key': pack_tile_key(x=x, y=y, z=z,
+                                          order=self.key_order),
+                     'hashed': hashed}
+                )
+            else:
+                self._conn.execute(
+                    """
+                    INSERT OR REPLACE
+                    INTO map (zoom_level, tile_column, tile_row, tile_id)
+                    VALUES (:z, :x, :y, :hashed)
+                    """,
+                    {'x': x, 'y': y, 'z': z, 'hashed': hashed}
+                )
+
+            # The coverage bitmap for this zoom level is now stale. It only
+            # needs dropping once, until `write_coverage` writes it again.
+            stale = self.has_coverage and z not in self._stale_coverage
+            if stale:
+                self._conn.execute(
+                    'DELETE FROM coverage WHERE zoom_level = :z', {'z': z}
+                )
+
+        if stale:
+            self._stale_coverage.add(z)
+            self._coverage[z] = None
+        self._ancestors.pop((x, y, z), None)
+
+    def columns(self, z):
+        """
+        Yields the number of each column with tiles at zoom level `z`.
+
+        Each column is found with its own primary key lookup, so the file can
+        be written to between columns. Columns of Hilbert keys are not
+        contiguous, so they are all found by one scan of the zoom level
+        instead.
+        """
+        if self.key_order == 'hilbert':
+            first, last = _zoom_key_range(z)
+            cursor = self._conn.execute(
+                """
+                SELECT hilbert_key FROM map
+                WHERE hilbert_key BETWEEN :first AND :last
+                """,
+                {'first': first, 'last': last}
+            )
+            columns = set(unpack_tile_key(row[0], order='hilbert')[0]
+                          for row in cursor)
+            for x in sorted(columns):
+                yield x
+            return
+
+        x = 0
+        while x <= TILE_KEY_MASK:
+            if self.compact:
+                cursor = self._conn.execute(
+                    """
+                    SELECT tile_key FROM map
+                    WHERE tile_key BETWEEN :first AND :last
+                    ORDER BY tile_key
+                    LIMIT 1
+                    """,
+                    {'first': pack_tile_key(x=x, y=0, z=z),
+                     'last': pack_tile_key(x=TILE_KEY_MASK, y=TILE_KEY_MASK,
+                                           z=z)}
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                x = unpack_tile_key(rows[0][0])[0]
+            else:
+                cursor = self._conn.execute(
+                    """
+                    SELECT tile_column FROM map
+                    WHERE zoom_level = :z AND tile_column >= :x
+                    ORDER BY tile_column
+                    LIMIT 1
+                    """,
+                    {'x': x, 'z': z}
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                x = rows[0][0]
+            yield x
+            x += 1
+
+    def column(self, x, z, page_size=256):
+        """
+        Yields (y, data) for the tiles in column `x` at zoom level `z`.
+
+        Tiles are read `page_size` at a time, in row order, so the file can
+        be written to between pages. See `_hilbert_column` for Hilbert keys.
+        """
+        if self.key_order == 'hilbert':
+            for row in self._hilbert_column(x=x, z=z, page_size=page_size):
+                yield row
+        elif self.compact:
+            after = pack_tile_key(x=x, y=0, z=z) - 1
+            last = pack_tile_key(x=x, y=TILE_KEY_MASK, z=z)
+            while True:
+                cursor = self._conn.execute(
+                    """
+                    SELECT tile_key, tile_data FROM map, images
+                    WHERE map.tile_key > :after AND
+                          map.tile_key <= :last AND
+                          map.tile_id = images.tile_id
+                    ORDER BY map.tile_key
+                    LIMIT :limit
+                    """,
+                    {'after': after, 'last': last, 'limit': page_size}
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                for key, data in rows:
+                    yield key & TILE_KEY_MASK, data
+                after = rows[-1][0]
+        else:
+            y = -1
+            while True:
+                cursor = self._conn.execute(
+                    """
+                    SELECT tile_row, tile_data FROM map, images
+                    WHERE map.zoom_level = :z AND
+                          map.tile_column = :x AND
+                          map.tile_row > :y AND
+                          map.tile_id = images.tile_id
+                    ORDER BY map.tile_row
+                    LIMIT :limit
+                    """,
+                    {'x': x, 'y': y, 'z': z, 'limit': page_size}
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+                y = rows[-1][0]
+
+    def _hilbert_column(self, x, z, page_size):
+        """
+        Yields (y, data) for the tiles in column `x` at zoom level `z` of a
+        file with Hilbert keys, in row order.
+
+        Aligned square blocks of tiles are contiguous ranges of Hilbert keys.
+        The blocks along the column are split from the whole zoom level
+        down, skipping empty ones, until they span `page_size` keys, and
+        the tiles of each block are read together.
+        """
+        leaf = 0
+        while 1 << (2 * leaf) < page_size and leaf < z:
+            leaf += 1
+
+        # Blocks of 2**level tiles a side, as (level, bottom row), with the
+        # lowest rows at the end
+        blocks = [(z, 0)]
+        while blocks:
+            level, bottom = blocks.pop()
+            size = 1 << (2 * level)
+            first = pack_tile_key(x=x, y=bottom, z=z,
+                                  order='hilbert') // size * size
+            last = first + size - 1
+            if level > leaf:
+                cursor = self._conn.execute(
+                    """
+                    SELECT 1 FROM map
+                    WHERE hilbert_key BETWEEN :first AND :last
+                    LIMIT 1
+                    """,
+                    {'first': first, 'last': last}
+                )
+                if cursor.fetchone() is not None:
+                    half = 1 << (level - 1)
+                    blocks.append((level - 1, bottom + half))
+                    blocks.append((level - 1, bottom))
+                continue
+
+            # Only read the images of the tiles in this column
+            cursor = self._conn.execute(
                 """
-                INSERT OR REPLACE
-                INTO map (zoom_level, tile_column, tile_row, tile_id)
-                VALUES (:z, :x, :y, :hashed)
+                SELECT hilbert_key, tile_id FROM map
+                WHERE hilbert_key BETWEEN :first AND :last
                 """,
-                {'x': x, 'y': y, 'z': z, 'hashed': hashed}
+                {'first': first, 'last': last}
             )
+            tiles = []
+            for key, image_id in cursor.fetchall():
+                column, row, _ = unpack_tile_key(key, order='hilbert')
+                if column == x:
+                    tiles.append((row, image_id))
+            if not tiles:
+                continue
+            image_ids = sorted(set(image_id for _, image_id in tiles))
+            cursor = self._conn.execute(
+                """
+                SELECT tile_id, tile_data FROM images
+                WHERE tile_id IN ({0})
+                """.format(', '.join('?' * len(image_ids))),
+                image_ids
+            )
+            images = dict(cursor.fetchall())
+            for row, image_id in sorted(tiles):
+                yield row, images[image_id]
+
+    def tile_ids(self):
+        """Yields the tile_id of every image in the database."""
+        cursor = self._conn.execute('SELECT tile_id FROM images')
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+
+    def images(self, page_size=256):
+        """
+        Yields (tile_id, data) for every image in the database, each once,
+        no matter how many tiles use it.
+
+        Images are read `page_size` at a time, in tile_id order, so the file
+        can be written to between pages. See `replace_images`.
+        """
+        after = None
+        while True:
+            if after is None:
+                cursor = self._conn.execute(
+                    """
+                    SELECT tile_id, tile_data FROM images
+                    ORDER BY tile_id
+                    LIMIT :limit
+                    """,
+                    {'limit': page_size}
+                )
+            else:
+                cursor = self._conn.execute(
+                    """
+                    SELECT tile_id, tile_data FROM images
+                    WHERE tile_id > :after
+                    ORDER BY tile_id
+                    LIMIT :limit
+                    """,
+                    {'after': after, 'limit': page_size}
+                )
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            after = rows[-1][0]
+
+    def replace_images(self, images):
+        """
+        Replaces the data of existing images, keeping every tile that uses
+        them.
+
+        images: Iterable of (tile_id, data), as yielded by `images`.
+        """
+        with self._conn:
+            self._conn.executemany(
+                'UPDATE images SET tile_data = ? WHERE tile_id = ?',
+                ((data, tile_id) for tile_id, data in images)
+            )
+
+    def sample(self, count):
+        """
+        Returns the data of up to `count` images, spread over the zoom levels.
+
+        Images are picked in tile_id order within each zoom level. Since
+        tile_ids come from content hashes, the sample is arbitrary, but the
+        same every time. Zoom levels with fewer images leave their share to
+        the others.
+        """
+        zooms = self.zoom_levels()
+        result = []
+        for i, z in enumerate(zooms):
+            limit = (count - len(result)) // (len(zooms) - i)
+            if limit <= 0:
+                continue
+            if self.compact:
+                where = '{0} BETWEEN :first AND :last'.format(
+                    self._key_column
+                )
+            else:
+                where = 'zoom_level = :z'
+            first, last = _zoom_key_range(z)
+            cursor = self._conn.execute(
+                """
+                SELECT tile_data FROM images
+                WHERE tile_id IN (
+                    SELECT DISTINCT tile_id FROM map
+                    WHERE {0}
+                    ORDER BY tile_id
+                    LIMIT :limit
+                )
+                """.format(where),
+                {'z': z, 'limit': limit, 'first': first, 'last': last}
+            )
+            result.extend(row[0] for row in cursor.fetchall())
+        return result
+
+    @property
+    def nativezoom(self):
+        """
+        Returns the highest zoom level with stored tiles, if the zoom levels
+        above it are overzoomed on read, otherwise None. See `get`.
+        """
+        value = self.metadata.get('x-nativezoom')
+        if value is None:
+            return None
+        return int(value)
+
+    def _tile_key(self, x, y, z):
+        """
+        Returns the packed key of the tile at `x`, `y`, `z` in a compact
+        file, or None if the coordinates cannot be packed, in which case
+        there is no such tile.
+        """
+        try:
+            return pack_tile_key(x=x, y=y, z=z, order=self.key_order)
+        except ValueError:
+            return None
 
     def get(self, x, y, z):
         """
         Returns the compressed image data at coordinates `x`, `y`, `z`.
 
         x, y, z: TMS coordinates for the tile.
+
+        If the x-nativezoom metadata is set, tiles above that zoom level are
+        not stored, but cropped out of their ancestor at x-nativezoom and
+        scaled up with nearest-neighbour, like `TmsTiles.upsample`. JPEG
+        tiles are encoded again at the quality of their ancestor, which still
+        loses a little more detail, while the other formats are lossless.
         """
-        cursor = self._conn.execute(
-            """
-            SELECT tile_data FROM tiles
-            WHERE zoom_level = :z AND
-                  tile_column = :x AND
-                  tile_row = :y
-            """,
-            {'x': x, 'y': y, 'z': z}
-        )
+        if self.compact:
+            key = self._tile_key(x=x, y=y, z=z)
+            if key is None:
+                return self._overzoom(x=x, y=y, z=z)
+            # Look up the packed key directly, because the tiles view
+            # computes its coordinates and cannot use the primary key.
+            cursor = self._conn.execute(
+                """
+                SELECT tile_data FROM map, images
+                WHERE map.{key} = :key AND
+                      map.tile_id = images.tile_id
+                """.format(key=self._key_column),
+                {'key': key}
+            )
+        else:
+            cursor = self._conn.execute(
+                """
+                SELECT tile_data FROM tiles
+                WHERE zoom_level = :z AND
+                      tile_column = :x AND
+                      tile_row = :y
+                """,
+                {'x': x, 'y': y, 'z': z}
+            )
         result = cursor.fetchone()
         if result is None:
-            return None
+            return self._overzoom(x=x, y=y, z=z)
         return result[0]
 
+    def _overzoom_ancestor(self, x, y, z):
+        """
+        Returns the coordinates (x, y, z) of the stored ancestor that the
+        tile at `x`, `y`, `z` would be overzoomed from, or None if it is at
+        or below x-nativezoom.
+        """
+        nativezoom = self.nativezoom
+        if nativezoom is None or z <= nativezoom:
+            return None
+        levels = z - nativezoom
+        return x >> levels, y >> levels, nativezoom
+
+    def _overzoom(self, x, y, z):
+        """Returns the image data of an overzoomed tile, or None."""
+        coordinates = self._overzoom_ancestor(x=x, y=y, z=z)
+        if coordinates is None:
+            return None
+
+        ancestor, format, quality = self._ancestor(*coordinates)
+        if ancestor is None:
+            return None
+
+        scale = 2 ** (z - coordinates[2])
+        width = ancestor.width // scale
+        height = ancestor.height // scale
+        # TMS rows count upwards, but image rows count downwards
+        image = ancestor.crop((x % scale) * width,
+                              (scale - 1 - y % scale) * height,
+                              width, height).zoom(scale, scale)
+        # Keep the format of the ancestor, which may differ from the format
+        # metadata in files with mixed formats.
+        if format is None:
+            format = self.metadata.get('format')
+        if format == 'jpg':
+            options = {}
+            if quality is not None:
+                options['Q'] = quality
+            return image.extract_band(0, n=3).write_to_buffer('.jpg',
+                                                              **options)
+        if format == 'webp':
+            return image.write_to_buffer('.webp', lossless=True)
+        if format == 'tiff':
+            return image.write_to_buffer('.tif', compression='deflate')
+        return image.write_to_buffer('.png')
+
+    def _ancestor(self, x, y, z):
+        """
+        Returns (image, format, quality) for the decoded tile at `x`, `y`,
+        `z`, from a small LRU. quality is the JPEG quality, or None.
+        """
+        key = (x, y, z)
+        result = self._ancestors.pop(key, None)
+        if result is None:
+            data = self.get(x=x, y=y, z=z)
+            if data is None:
+                return None, None, None
+            # Import here, so that reading stored tiles needs neither VIPS
+            # nor GDAL
+            from .vips import Image, VImageAdapter
+            format = tile_format(data)
+            if format == 'tiff':
+                # Data tiles keep their raw values. See DataRenderer.
+                image = Image.new_from_buffer(data, '')
+            else:
+                image = VImageAdapter.from_buffer(data)
+            quality = None
+            if format == 'jpg':
+                quality = jpeg_quality(data)
+            result = (image.copy_memory(), format, quality)
+            while len(self._ancestors) >= self.OVERZOOM_CACHE_SIZE:
+                self._ancestors.popitem(last=False)
+        self._ancestors[key] = result
+        return result
+
     def all(self):
         """
         Returns all of the compressed image data
         """
-        cursor = self._conn.execute(
-            """
-            SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
-            ORDER BY zoom_level, tile_column, tile_row
-            """
-        )
+        if self.compact:
+            # Unpacking keys in Python is much faster than the recursive
+            # queries of the tiles view for Hilbert keys
+            cursor = self._conn.execute(
+                """
+                SELECT {key}, tile_data FROM map, images
+                WHERE map.tile_id = images.tile_id
+                ORDER BY map.{key}
+                """.format(key=self._key_column)
+            )
+        else:
+            cursor = self._conn.execute(
+                """
+                SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
+                ORDER BY zoom_level, tile_column, tile_row
+                """
+            )
         while True:
             rows = cursor.fetchmany()
             if not rows:
                 return
-            for z, x, y, data in rows:
-                yield z, x, y, data
+            for row in rows:
+                if self.compact:
+                    x, y, z = unpack_tile_key(row[0], order=self.key_order)
+                    row = (z, x, y, row[1])
+                yield row
+
+    @property
+    def has_coverage(self):
+        """Returns True if this file stores coverage bitmaps."""
+        if self._has_coverage is None:
+            cursor = self._conn.execute(
+                """
+                SELECT COUNT(*) FROM sqlite_master
+                WHERE type = 'table' AND name = 'coverage'
+                """
+            )
+            self._has_coverage = bool(cursor.fetchone()[0])
+        return self._has_coverage
+
+    def write_coverage(self, empty=None):
+        """
+        Writes a coverage bitmap for each zoom level into the coverage table.
+
+        empty: Integer hash of the empty tile, as passed to `insert`. Tiles
+               with this hash are recorded as empty instead of present.
+
+        Each bitmap spans the bounding box of the tiles at its zoom level,
+        column by column, and is run-length encoded. See `COVERAGE` for the
+        states. Bitmaps are replaced wholesale, and the bitmap for a zoom
+        level is dropped by the first tile inserted at that level afterwards.
+
+        Looking up a tile bisects the run ends of its bitmap, so it takes
+        O(log n) in the number of runs, without touching the map index.
+        """
+        self._write_coverage(
+            empty_id=None if empty is None else tile_id(empty)
+        )
+
+    def _write_coverage(self, empty_id):
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS coverage (
+                    zoom_level INTEGER PRIMARY KEY,
+                    min_column INTEGER NOT NULL,
+                    min_row INTEGER NOT NULL,
+                    max_column INTEGER NOT NULL,
+                    max_row INTEGER NOT NULL,
+                    empty_id INTEGER,
+                    runs BLOB NOT NULL
+                )
+                """
+            )
+            self._conn.execute('DELETE FROM coverage')
+
+            for (z, min_column, min_row, max_column, max_row,
+                 tiles) in self._coverage_tiles():
+                height = max_row - min_row + 1
+                runs = []
+
+                def extend(state, length):
+                    if length <= 0:
+                        return
+                    if runs and runs[-1][0] == state:
+                        runs[-1][1] += length
+                    else:
+                        runs.append([state, length])
+
+                position = 0
+                for x, y, image_id in tiles:
+                    index = (x - min_column) * height + (y - min_row)
+                    extend(self.COVERAGE.MISSING, index - position)
+                    extend(self.COVERAGE.EMPTY if image_id == empty_id
+                           else self.COVERAGE.TILE, 1)
+                    position = index + 1
+                extend(self.COVERAGE.MISSING,
+                       (max_column - min_column + 1) * height - position)
+
+                self._conn.execute(
+                    """
+                    INSERT INTO coverage (zoom_level,
+                                          min_column, min_row,
+                                          max_column, max_row,
+                                          empty_id, runs)
+                    VALUES (:z, :min_column, :min_row,
+                            :max_column, :max_row,
+                            :empty_id, :runs)
+                    """,
+                    {'z': z,
+                     'min_column': min_column, 'min_row': min_row,
+                     'max_column': max_column, 'max_row': max_row,
+                     'empty_id': empty_id,
+                     'runs': sqlite3.Binary(_pack_runs(runs))}
+                )
+
+        self._has_coverage = True
+        self._stale_coverage = set()
+        self._coverage = {}
+
+    def _coverage_tiles(self):
+        """
+        Yields (z, min_column, min_row, max_column, max_row, tiles) for each
+        zoom level, where `tiles` are the (x, y, tile_id) of its tiles,
+        column by column.
+        """
+        if self.key_order == 'hilbert':
+            # Hilbert keys are unpacked in Python, which is much faster than
+            # in SQL, and sorted by column
+            for z in self.zoom_levels():
+                first, last = _zoom_key_range(z)
+                cursor = self._conn.execute(
+                    """
+                    SELECT hilbert_key, tile_id FROM map
+                    WHERE hilbert_key BETWEEN :first AND :last
+                    """,
+                    {'first': first, 'last': last}
+                )
+                tiles = sorted(
+                    unpack_tile_key(key, order='hilbert')[:2] + (image_id,)
+                    for key, image_id in cursor
+                )
+                rows = [y for x, y, image_id in tiles]
+                yield (z, tiles[0][0], min(rows), tiles[-1][0], max(rows),
+                       tiles)
+            return
+
+        zoom_level, tile_column, tile_row = _zxy_sql(table='map',
+                                                     order=self.key_order)
+        cursor = self._conn.execute(
+            """
+            SELECT {z}, MIN({x}), MIN({y}), MAX({x}), MAX({y})
+            FROM map
+            GROUP BY {z}
+            """.format(z=zoom_level, x=tile_column, y=tile_row)
+        )
+        extents = cursor.fetchall()
+
+        for z, min_column, min_row, max_column, max_row in extents:
+            # Walk the tiles in primary key order, which is column by
+            # column, without gaps.
+            if self.compact:
+                first, last = _zoom_key_range(z)
+                cursor = self._conn.execute(
+                    """
+                    SELECT {x}, {y}, tile_id FROM map
+                    WHERE tile_key BETWEEN :first AND :last
+                    ORDER BY tile_key
+                    """.format(x=tile_column, y=tile_row),
+                    {'first': first, 'last': last}
+                )
+            else:
+                cursor = self._conn.execute(
+                    """
+                    SELECT tile_column, tile_row, tile_id FROM map
+                    WHERE zoom_level = :z
+                    ORDER BY tile_column, tile_row
+                    """,
+                    {'z': z}
+                )
+            yield z, min_column, min_row, max_column, max_row, cursor
+
+    def _coverage_empty_id(self):
+        """Returns the tile_id recorded as empty in the coverage table."""
+        cursor = self._conn.execute('SELECT empty_id FROM coverage LIMIT 1')
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def _read_coverage(self, z):
+        """Returns the decoded coverage bitmap for zoom level `z`, or None."""
+        if z not in self._coverage:
+            coverage = None
+            if self.has_coverage:
+                cursor = self._conn.execute(
+                    """
+                    SELECT min_column, min_row, max_column, max_row, runs
+                    FROM coverage
+                    WHERE zoom_level = :z
+                    """,
+                    {'z': z}
+                )
+                row = cursor.fetchone()
+                if row is not None:
+                    coverage = row[:4] + _unpack_runs(row[4])
+            self._coverage[z] = coverage
+        return self._coverage[z]
+
+    def coverage(self, x, y, z):
+        """
+        Returns the `COVERAGE` state of the tile at coordinates `x`, `y`, `z`.
+
+        Bisects the runs of the bitmap, in O(log n) of their number.
+        Returns None if there is no coverage bitmap for zoom level `z`.
+        Overzoomed tiles have the state of their ancestor. See `get`.
+        """
+        coverage = self._read_coverage(z)
+        if coverage is None:
+            ancestor = self._overzoom_ancestor(x=x, y=y, z=z)
+            if ancestor is None:
+                return None
+            return self.coverage(*ancestor)
+        min_column, min_row, max_column, max_row, ends, states = coverage
+        if not (min_column <= x <= max_column and min_row <= y <= max_row):
+            return self.COVERAGE.MISSING
+        index = (x - min_column) * (max_row - min_row + 1) + (y - min_row)
+        return states[bisect_right(ends, index)]
+
+    def exists(self, x, y, z):
+        """
+        Returns True if there is a tile at coordinates `x`, `y`, `z`.
+
+        Uses the coverage bitmap when there is one, in O(log n) of its runs,
+        and the map table otherwise. Overzoomed tiles exist if their ancestor
+        does, like in `get`.
+        """
+        state = self.coverage(x=x, y=y, z=z)
+        if state is not None:
+            return state != self.COVERAGE.MISSING
+
+        if self.compact:
+            cursor = self._conn.execute(
+                'SELECT 1 FROM map WHERE {0} = :key'.format(self._key_column),
+                {'key': self._tile_key(x=x, y=y, z=z)}
+            )
+        else:
+            cursor = self._conn.execute(
+                """
+                SELECT 1 FROM map
+                WHERE zoom_level = :z AND
+                      tile_column = :x AND
+                      tile_row = :y
+                """,
+                {'x': x, 'y': y, 'z': z}
+            )
+        if cursor.fetchone() is not None:
+            return True
+        ancestor = self._overzoom_ancestor(x=x, y=y, z=z)
+        return ancestor is not None and self.exists(*ancestor)
+
+    def is_empty(self, x, y, z):
+        """
+        Returns True if the tile at coordinates `x`, `y`, `z` is empty.
+
+        Only the coverage bitmap knows which tiles are empty, so this returns
+        False if there is no bitmap for zoom level `z`.
+        """
+        return self.coverage(x=x, y=y, z=z) == self.COVERAGE.EMPTY
@@ -20,16 +20,33 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
-from subprocess import check_call
-from tempfile import gettempdir, NamedTemporaryFile
+from shutil import rmtree
+from struct import pack, unpack
+from subprocess import CalledProcessError, PIPE, Popen, check_call
+from tempfile import gettempdir, mkdtemp
+import zlib
 
-from .utils import rmfile
+import numpy
+from pyvips import Error as VipsError, Image, at_least_libvips
+
+from .gd_types import rgba
 
 
 class Renderer(object):
     _suffix = ''
 
+    # Value of the MBTiles format metadata for rendered tiles
+    format = None
+
+    # Number of images that are best rendered together. See `render_all`.
+    batch_size = 1
+
+    # Attributes that don't change the rendered tiles. See `settings`.
+    _volatile = ('suffix', 'tempdir')
+
     def __init__(self, suffix=None, tempdir=None):
         if suffix is None:
             suffix = self.__class__._suffix
@@ -42,9 +59,54 @@ class Renderer(object):
     def __str__(self):
         return 'Renderer(suffix={suffix!r})'.format(**self.__dict__)
 
+    @property
+    def formats(self):
+        """Returns the formats of the rendered tiles."""
+        if self.format is None:
+            return ()
+        return (self.format,)
+
+    @property
+    def settings(self):
+        """
+        Returns a string that identifies how tiles are rendered, so that
+        rendered tiles can be cached. See `caches.TileCache`.
+        """
+        items = []
+        for name, value in sorted(self.__dict__.items()):
+            if name.startswith('_') or name in self._volatile:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = [getattr(v, 'settings', v) for v in value]
+            items.append('{0}={1}'.format(name, value))
+        return '{0}({1})'.format(self.__class__.__name__, ', '.join(items))
+
     def render(self, image):
         raise NotImplementedError()
 
+    def prerender(self, image):
+        """
+        Returns the VIPS `image` rendered in-process, to be finished by
+        `postrender`.
+        """
+        return self.render(image)
+
+    def render_solid(self, image, pixel):
+        """
+        Returns the rendered VIPS `image`, where every pixel is `pixel`.
+
+        pixel: Bytes of the single pixel value, as in `image.write_to_memory`.
+        """
+        return self.render(image)
+
+    def postrender(self, contents):
+        """Returns the finished tiles for a list of `prerender` results."""
+        return contents
+
+    def render_all(self, images):
+        """Returns a list of the rendered VIPS `images`."""
+        return self.postrender([self.prerender(image) for image in images])
+
 
 class JpegRenderer(Renderer):
     """
@@ -59,6 +121,8 @@ class JpegRenderer(Renderer):
     """
     _suffix = '.jpeg'
 
+    format = 'jpg'
+
     def __init__(self, compression=None, profile=None, **kwargs):
         if compression is None:
             compression = 75
@@ -89,10 +153,7 @@ class JpegRenderer(Renderer):
         if image.bands > 3:
             # Strip out alpha channel, otherwise transparent pixels turn white.
             image = image.extract_band(0, n=3)
-        with NamedTemporaryFile(suffix=self.suffix,
-                                dir=self.tempdir) as rendered:
-            image.write_to_file(rendered.name, **self._vips_options)
-            return rendered.read()
+        return image.write_to_buffer('.jpg', **self._vips_options)
 
 
 class PngRenderer(Renderer):
@@ -104,20 +165,66 @@ class PngRenderer(Renderer):
     png8: Quantizes 32-bit RGBA to 8-bit RGBA paletted PNGs. Default False.
           If an integer, specifies number of colors in palette.
           If True, defaults to 256 colors.
+    effort: Effort spent quantizing for png8, from 1 (fastest) to 10 (best
+            quality). Default 7.
     optimize: Optimizes PNG using optipng. Default False. See `optipng -h`.
+    processes: Number of batches of tiles that pngquant and optipng process
+               at once. Default is the number of CPUs.
+    palette: List of rgba colors of the palette indexes in single band
+             images, see `ColorBase.colorize_indexed`. Such images are
+             rendered as paletted PNGs with exactly these colors, instead of
+             greyscale. Default None.
+    shared_palette: List of rgba colors that every tile is remapped to,
+                    including greyscale ones, see `quantize` and `remap`.
+                    Default None.
     suffix: Suffix for filename. Default '.png'.
 
     If optimize is not False, then compression is ignored and set to 0, to
     prevent double-compression. In general, VIPS compression is faster than
     optimizing with OptiPNG.
+
+    Tiles are encoded in memory. OptiPNG, and pngquant for many tiles at
+    once, work on files in a scratch directory in `tempdir`. Each is started
+    once per batch of BATCH_SIZE tiles, see `render_all`.
+
+    With png8, palettes of 2, 4, 16 or 256 colors are quantized in-process
+    by VIPS, if it was built with libimagequant. Other sizes are quantized
+    by pngquant, which also uses libimagequant.
+
+    With a palette shared by every tile, from `quantize`, tiles are remapped
+    to it by a lookup table instead of being quantized one by one. This is
+    much faster, and identical regions get identical colors across tiles.
     """
     _suffix = '.png'
 
+    format = 'png'
+
     PNGQUANT = 'pngquant'
     OPTIPNG = 'optipng'
 
+    # Number of files per pngquant or optipng process
+    BATCH_SIZE = 256
+
+    # PNG bit depth for each palette size that VIPS can quantize to
+    PALETTE_BITDEPTHS = {2: 1, 4: 2, 16: 4, 256: 8}
+
+    # Whether VIPS can save paletted PNGs, or None if not probed yet
+    _vips_palette = None
+
+    # Largest side of the image sample that `quantize` works on
+    SAMPLE_SIZE = 1024
+
+    # Bits kept of each RGBA channel to look up the nearest palette color
+    LOOKUP_BITS = 5
+
+    # (shared_palette, lookup table) for `remap`
+    _lookup = None
+
+    _volatile = Renderer._volatile + ('processes',)
+
     def __init__(self, compression=None, interlace=None, png8=None,
-                 optimize=None, **kwargs):
+                 palette=None, shared_palette=None,
+                 effort=None, optimize=None, processes=None, **kwargs):
         if compression is None:
             compression = 6
         _compression = int(compression)
@@ -144,6 +251,15 @@ class PngRenderer(Renderer):
                 )
         self.png8 = _png8
 
+        if effort is None:
+            effort = 7
+        _effort = int(effort)
+        if not 1 <= _effort <= 10:
+            raise ValueError(
+                'effort must be between 1 and 10: {0!r}'.format(effort)
+            )
+        self.effort = _effort
+
         _optimize = optimize
         if _optimize is None:
             _optimize = False
@@ -157,8 +273,38 @@ class PngRenderer(Renderer):
             self.compression = 1  # Reduce cost of double-compression
         self.optimize = _optimize
 
+        if processes is None:
+            processes = cpu_count()
+        self.processes = processes
+
+        for name, value in [('palette', palette),
+                            ('shared_palette', shared_palette)]:
+            if value is not None and not 1 <= len(value) <= 256:
+                raise ValueError(
+                    '{0} must have between 1 and 256 colors: {1!r}'.format(
+                        name, len(value)
+                    )
+                )
+        self.palette = palette
+        self.shared_palette = shared_palette
+
         super(PngRenderer, self).__init__(**kwargs)
 
+    @property
+    def batch_size(self):
+        if self.optimize is False and not self._pngquant:
+            return 1
+        return self.BATCH_SIZE * self.processes
+
+    @property
+    def _pngquant(self):
+        """Returns True if png8 needs pngquant instead of VIPS."""
+        if self.png8 is False or self.palette is not None or \
+                self.shared_palette is not None:
+            return False
+        return (self.png8 not in self.PALETTE_BITDEPTHS or
+                not self.vips_palette())
+
     @property
     def _vips_options(self):
         return {
@@ -168,24 +314,431 @@ class PngRenderer(Renderer):
 
     def render(self, image):
         """Returns the rendered VIPS `image`."""
-        with NamedTemporaryFile(suffix=self.suffix,
-                                dir=self.tempdir) as rendered:
-            image.write_to_file(rendered.name, **self._vips_options)
-            filename = rendered.name
+        return self.postrender([self.prerender(image)])[0]
+
+    def render_solid(self, image, pixel):
+        """
+        Returns the VIPS `image`, where every pixel is `pixel`, as a 1-bit
+        paletted PNG.
+
+        This is exact and smaller than anything quantizing or optimizing can
+        produce, without running either.
+        """
+        if image.format != 'uchar' or image.bands not in (1, 2, 3, 4):
+            return self.render(image)
+
+        pixel = bytearray(pixel)
+        if self._indexed(image):
+            color = rgba(0, 0, 0, 0)
+            if pixel[0] < len(self.palette):
+                color = self.palette[pixel[0]]
+        else:
+            if image.bands in (1, 2):
+                pixel[1:1] = pixel[:1] * 2
+            if len(pixel) == 3:
+                pixel.append(255)
+            color = rgba(*pixel)
+            if self.shared_palette is not None:
+                # Match the remapped tiles around this one
+                index = self._nearest(numpy.array([pixel], dtype=numpy.uint8))
+                color = self.shared_palette[index[0]]
+
+        return paletted_png(data=bytes(bytearray(image.width * image.height)),
+                            width=image.width, height=image.height,
+                            palette=[color], compression=9)
+
+    def prerender(self, image):
+        """
+        Returns the VIPS `image` encoded as a PNG, and quantized if VIPS can.
+        """
+        if self._indexed(image):
+            return paletted_png(data=image.write_to_memory(),
+                                width=image.width, height=image.height,
+                                palette=self.palette,
+                                compression=self.compression)
+        if self.shared_palette is not None:
+            return paletted_png(data=self.remap(image),
+                                width=image.width, height=image.height,
+                                palette=self.shared_palette,
+                                compression=self.compression)
+
+        contents = None
+        if self.png8 is not False:
+            contents = self._render_palette(image)
+        if contents is None:
+            contents = image.write_to_buffer('.png', **self._vips_options)
+        return contents
+
+    def _indexed(self, image):
+        """Returns True if `image` holds indexes into `palette`."""
+        return (self.palette is not None and image.bands == 1 and
+                image.format == 'uchar')
+
+    def quantize(self, image):
+        """
+        Returns a palette of `png8` rgba colors for the whole VIPS `image`.
+
+        The palette is quantized from a sample of at most SAMPLE_SIZE pixels
+        on each side, so it costs about as much as quantizing a few tiles.
+        Set it as `shared_palette` to remap every tile to it.
+        """
+        if self.png8 is False:
+            raise ValueError('quantize needs png8')
+        scale = min(1.0, self.SAMPLE_SIZE / max(image.width, image.height))
+        if scale < 1.0:
+            # Nearest-neighbour keeps the sample to colors in the image
+            image = image.resize(scale, kernel='nearest')
+        contents = self._render_palette(image)
+        if contents is None:
+            contents = self._pipe(
+                [self.PNGQUANT, '--force', '--speed', str(11 - self.effort),
+                 str(self.png8), '-'],
+                image.write_to_buffer('.png', **self._vips_options)
+            )
+        return png_palette(contents)
+
+    def remap(self, image):
+        """
+        Returns the indexes of the `shared_palette` colors nearest to each
+        pixel of the VIPS `image`, one byte per pixel, row by row.
+        """
+        if image.format != 'uchar' or image.bands not in (1, 2, 3, 4):
+            raise ValueError(
+                'Cannot remap {0} image with {1} bands'.format(image.format,
+                                                                image.bands)
+            )
+        pixels = numpy.frombuffer(image.write_to_memory(),
+                                  dtype=numpy.uint8).reshape(-1, image.bands)
+        if image.bands in (1, 2):
+            pixels = pixels[:, [0, 0, 0] + list(range(1, image.bands))]
+        if pixels.shape[1] == 3:
+            pixels = numpy.hstack([
+                pixels, numpy.full((len(pixels), 1), 255, dtype=numpy.uint8)
+            ])
+        return self._nearest(pixels).tobytes()
+
+    def _nearest(self, pixels):
+        """
+        Returns the indexes of the `shared_palette` colors nearest to the
+        RGBA `pixels`, as an array of bytes.
+
+        Nearest colors are looked up by the top LOOKUP_BITS of each channel,
+        in a table that is filled in as new colors turn up.
+        """
+        if self._lookup is None or \
+                self._lookup[0] is not self.shared_palette:
+            self._lookup = (self.shared_palette,
+                            numpy.full(1 << (4 * self.LOOKUP_BITS), -1,
+                                       dtype=numpy.int16))
+        lookup = self._lookup[1]
+
+        shift = 8 - self.LOOKUP_BITS
+        bins = (pixels >> shift).astype(numpy.uint32)
+        keys = numpy.zeros(len(pixels), dtype=numpy.uint32)
+        for band in range(4):
+            keys = (keys << self.LOOKUP_BITS) | bins[:, band]
+
+        missing = numpy.unique(keys[lookup[keys] < 0])
+        if missing.size:
+            # Match each bin by the color in its middle
+            mask = (1 << self.LOOKUP_BITS) - 1
+            colors = numpy.stack(
+                [(missing >> (self.LOOKUP_BITS * (3 - band))) & mask
+                 for band in range(4)],
+                axis=1
+            )
+            colors = (colors << shift) | (1 << shift >> 1)
+            lookup[missing] = nearest_colors(colors, self.shared_palette)
+
+        return lookup[keys].astype(numpy.uint8)
+
+    def postrender(self, contents):
+        """
+        Returns the `prerender` results quantized by pngquant, if VIPS
+        couldn't, and optimized by optipng.
+        """
+        if self._pngquant:
+            # pngquant's --speed runs from 1 (best quality) to 11
+            args = [self.PNGQUANT, '--force', '--speed',
+                    str(11 - self.effort), str(self.png8)]
+            if len(contents) == 1:
+                contents = [self._pipe(args + ['-'], contents[0])]
+            else:
+                contents = self._run_batches(args + ['--ext', '.png'],
+                                             contents)
+
+        if self.optimize is not False:
+            contents = self._run_batches(
+                [self.OPTIPNG, '-o{0:d}'.format(self.optimize), '-quiet'],
+                contents
+            )
+
+        return contents
+
+    def _run_batches(self, args, contents):
+        """
+        Returns `contents` after running command `args` on them in place, in
+        parallel batches of BATCH_SIZE files.
+        """
+        batches = [contents[i:i + self.BATCH_SIZE]
+                   for i in range(0, len(contents), self.BATCH_SIZE)]
+        if len(batches) <= 1 or self.processes <= 1:
+            results = [self._run_batch(args, batch) for batch in batches]
+        else:
+            pool = ThreadPool(processes=min(self.processes, len(batches)))
+            try:
+                results = pool.map(lambda batch: self._run_batch(args, batch),
+                                   batches)
+            finally:
+                pool.close()
+                pool.join()
+        return [data for result in results for data in result]
+
+    def _run_batch(self, args, contents):
+        """
+        Returns `contents` after running command `args` on them in place, in
+        a single process.
+        """
+        tempdir = mkdtemp(dir=self.tempdir)
+        try:
+            filenames = [os.path.join(tempdir, '{0:d}.png'.format(i))
+                         for i in range(len(contents))]
+            for filename, data in zip(filenames, contents):
+                with open(filename, 'wb') as output:
+                    output.write(data)
+            check_call(args + filenames)
+            result = []
+            for filename in filenames:
+                with open(filename, 'rb') as rendered:
+                    result.append(rendered.read())
+            return result
+        finally:
+            rmtree(tempdir, ignore_errors=True)
+
+    def _render_palette(self, image):
+        """
+        Returns `image` quantized into a paletted PNG by VIPS, or None if VIPS
+        can't quantize to `png8` colors.
+        """
+        bitdepth = self.PALETTE_BITDEPTHS.get(self.png8)
+        if bitdepth is None or not self.vips_palette():
+            return None
+        return image.write_to_buffer('.png', palette=True,
+                                     bitdepth=bitdepth, effort=self.effort,
+                                     **self._vips_options)
+
+    @classmethod
+    def vips_palette(cls):
+        """
+        Returns True if VIPS can save paletted PNGs.
+
+        VIPS before 8.7, or built without libimagequant, can't. This is
+        probed once, on a single pixel, so errors saving real tiles are never
+        mistaken for missing support.
+        """
+        if PngRenderer._vips_palette is None:
+            try:
+                pixel = Image.black(1, 1, bands=4)
+                pixel.write_to_buffer('.png', palette=True, bitdepth=8)
+            except VipsError:
+                PngRenderer._vips_palette = False
+            else:
+                PngRenderer._vips_palette = True
+        return PngRenderer._vips_palette
+
+    @classmethod
+    def _pipe(cls, args, contents):
+        """Returns the output of command `args` with `contents` as input."""
+        process = Popen(args, stdin=PIPE, stdout=PIPE)
+        output, _ = process.communicate(contents)
+        if process.returncode:
+            raise CalledProcessError(process.returncode, args)
+        return output
+
+
+class WebpRenderer(Renderer):
+    """
+    Render a VIPS image as a WebP.
+
+    Transparent areas are kept, in both lossy and lossless modes.
+
+    lossless: Use lossless compression. Default False.
+    quality: Lossy quality level. Default 75.
+    effort: Effort spent compressing, from 0 (fastest) to 6 (smallest).
+            Default 4.
+    suffix: Suffix for filename. Default '.webp'.
+    """
+    _suffix = '.webp'
+
+    format = 'webp'
+
+    def __init__(self, lossless=None, quality=None, effort=None, **kwargs):
+        self.lossless = bool(lossless)
+
+        if quality is None:
+            quality = 75
+        _quality = int(quality)
+        if not 0 <= _quality <= 100:
+            raise ValueError(
+                'quality must be between 0 and 100: {0!r}'.format(quality)
+            )
+        self.quality = _quality
+
+        if effort is None:
+            effort = 4
+        _effort = int(effort)
+        if not 0 <= _effort <= 6:
+            raise ValueError(
+                'effort must be between 0 and 6: {0!r}'.format(effort)
+            )
+        self.effort = _effort
+
+        super(WebpRenderer, self).__init__(**kwargs)
+
+    @property
+    def _vips_options(self):
+        # VIPS 8.12 renamed reduction_effort to effort
+        if at_least_libvips(8, 12):
+            effort = 'effort'
+        else:
+            effort = 'reduction_effort'
+        return {
+            'Q': self.quality,
+            'lossless': self.lossless,
+            effort: self.effort,
+        }
+
+    def render(self, image):
+        """Returns the rendered VIPS `image`."""
+        return image.write_to_buffer('.webp', **self._vips_options)
+
+    def render_solid(self, image, pixel):
+        """
+        Returns the VIPS `image`, where every pixel is `pixel`, as a lossless
+        WebP, which is exact and smaller than a lossy one.
+        """
+        options = self._vips_options
+        options['lossless'] = True
+        return image.write_to_buffer('.webp', **options)
 
-            if self.png8 is not False:
-                check_call([self.PNGQUANT, '--force', str(self.png8),
-                            filename])
-                filename = os.path.splitext(filename)[0] + '-fs8.png'
 
-            if self.optimize is not False:
-                check_call([self.OPTIPNG, '-o{0:d}'.format(self.optimize),
-                            '-quiet', filename])
+class HybridRenderer(Renderer):
+    """
+    Render each VIPS image with one of two renderers, depending on whether it
+    is opaque.
+
+    Satellite imagery is usually opaque, except at the edges of its
+    footprint, so most tiles can be lossy without black fringes at the edges.
 
-            with open(filename, 'rb') as result:
-                if rendered.name != filename:
-                    rmfile(filename, ignore_missing=True)
-                return result.read()
+    opaque: Renders fully opaque tiles. Default JpegRenderer().
+    transparent: Renders tiles with any transparency. Default PngRenderer().
+
+    The format of each tile can be told from its data, see
+    `mbtiles.tile_format`. The format metadata is the format of transparent
+    tiles.
+    """
+    def __init__(self, opaque=None, transparent=None, **kwargs):
+        if opaque is None:
+            opaque = JpegRenderer()
+        if transparent is None:
+            transparent = PngRenderer()
+        self.renderers = (opaque, transparent)
+        super(HybridRenderer, self).__init__(**kwargs)
+
+    @property
+    def format(self):
+        return self.renderers[1].format
+
+    @property
+    def formats(self):
+        result = []
+        for renderer in self.renderers:
+            for format in renderer.formats:
+                if format not in result:
+                    result.append(format)
+        return tuple(result)
+
+    @property
+    def batch_size(self):
+        return max(renderer.batch_size for renderer in self.renderers)
+
+    @classmethod
+    def is_opaque(cls, image):
+        """Returns True if the VIPS `image` has no transparent pixels."""
+        if image.bands not in (2, 4):
+            return True
+        return image.extract_band(image.bands - 1).min() == 255
+
+    def render(self, image):
+        """Returns the rendered VIPS `image`."""
+        return self.postrender([self.prerender(image)])[0]
+
+    def prerender(self, image):
+        """
+        Returns (index, contents) where contents is the VIPS `image`
+        prerendered by the renderer at `index` in `renderers`.
+        """
+        index = 0 if self.is_opaque(image) else 1
+        return index, self.renderers[index].prerender(image)
+
+    def render_solid(self, image, pixel):
+        """Returns the VIPS `image`, where every pixel is `pixel`, rendered."""
+        index = 0 if self.is_opaque(image) else 1
+        return self.renderers[index].render_solid(image, pixel)
+
+    def postrender(self, contents):
+        """Returns the finished tiles for a list of `prerender` results."""
+        result = [None] * len(contents)
+        for index, renderer in enumerate(self.renderers):
+            positions = [i for i, (r, _) in enumerate(contents) if r == index]
+            if not positions:
+                continue
+            rendered = renderer.postrender([contents[i][1]
+                                            for i in positions])
+            for i, data in zip(positions, rendered):
+                result[i] = data
+        return result
+
+
+class DataRenderer(Renderer):
+    """
+    Render a VIPS image of raw band values as a lossless TIFF, for clients
+    that style or query the values themselves.
+
+    compression: TIFF compression, one of COMPRESSIONS. Default 'deflate'.
+    suffix: Suffix for filename. Default '.tif'.
+
+    Images hold a band of values, in their original format, and a mask band
+    that is 0 where there is no data. See `VipsDataset.extract_values`.
+    """
+    _suffix = '.tif'
+
+    format = 'tiff'
+
+    COMPRESSIONS = ('deflate', 'lzw', 'none')
+
+    def __init__(self, compression=None, **kwargs):
+        if compression is None:
+            compression = 'deflate'
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(
+                'compression must be one of {0}: {1!r}'.format(
+                    ', '.join(self.COMPRESSIONS), compression
+                )
+            )
+        self.compression = compression
+        super(DataRenderer, self).__init__(**kwargs)
+
+    def render(self, image):
+        """Returns the rendered VIPS `image`."""
+        # Differences between neighbouring values compress much better
+        predictor = 'horizontal'
+        if image.format in ('float', 'double', 'complex', 'dpcomplex'):
+            predictor = 'float'
+        if self.compression == 'none':
+            predictor = 'none'
+        return image.write_to_buffer('.tif', compression=self.compression,
+                                     predictor=predictor)
 
 
 class TouchRenderer(Renderer):
@@ -195,3 +748,120 @@ class TouchRenderer(Renderer):
     def render(self, image):
         """Touches `filename` and returns its value."""
         return b''
+
+
+def nearest_colors(colors, palette):
+    """
+    Returns the indexes of the `palette` colors nearest to each of the RGBA
+    `colors`, an array of shape (N, 4).
+
+    Colors are compared with their alpha premultiplied, so that all fully
+    transparent colors are alike.
+    """
+    def premultiply(array):
+        array = array.astype(numpy.float32)
+        array[:, :3] *= array[:, 3:] / 255
+        return array
+
+    targets = premultiply(numpy.array([tuple(color) for color in palette]))
+    colors = premultiply(numpy.asarray(colors))
+    result = numpy.empty(len(colors), dtype=numpy.int16)
+    # Bound the memory used by the distance matrix
+    step = 4096
+    for i in range(0, len(colors), step):
+        distances = ((colors[i:i + step, None, :] -
+                      targets[None, :, :]) ** 2).sum(axis=2)
+        result[i:i + step] = distances.argmin(axis=1)
+    return result
+
+
+def png_palette(contents):
+    """Returns the palette of a paletted PNG, as a list of rgba colors."""
+    colors = alphas = None
+    offset = 8
+    while offset < len(contents):
+        length, kind = unpack(b'>I4s', contents[offset:offset + 8])
+        data = contents[offset + 8:offset + 8 + length]
+        if kind == b'PLTE':
+            colors = bytearray(data)
+        elif kind == b'tRNS':
+            alphas = bytearray(data)
+        elif kind == b'IDAT':
+            break
+        offset += 12 + length
+    if colors is None:
+        raise ValueError('PNG has no palette')
+    if alphas is None:
+        alphas = bytearray()
+    count = len(colors) // 3
+    alphas.extend(b'\xff' * (count - len(alphas)))
+    return [rgba(colors[3 * i], colors[3 * i + 1], colors[3 * i + 2],
+                 alphas[i])
+            for i in range(count)]
+
+
+def paletted_png(data, width, height, palette, compression=6):
+    """
+    Returns a paletted PNG of palette indexes.
+
+    data: Palette indexes, one byte per pixel, row by row.
+    width: Integer dimension
+    height: Integer dimension
+    palette: List of rgba colors for each index.
+    compression: zlib compression level. Default 6.
+
+    The bit depth is the smallest that fits the palette, so that small
+    palettes pack several pixels in each byte.
+    """
+    if not 1 <= len(palette) <= 256:
+        raise ValueError(
+            'palette must have between 1 and 256 colors: {0!r}'.format(
+                len(palette)
+            )
+        )
+    bitdepth = 1
+    while len(palette) > 1 << bitdepth:
+        bitdepth *= 2
+
+    indexes = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width)
+    if bitdepth < 8:
+        per_byte = 8 // bitdepth
+        padding = -width % per_byte
+        if padding:
+            indexes = numpy.hstack([
+                indexes, numpy.zeros((height, padding), dtype=numpy.uint8)
+            ])
+        indexes = indexes.reshape(height, -1, per_byte)
+        packed = numpy.zeros(indexes.shape[:2], dtype=numpy.uint8)
+        for i in range(per_byte):
+            packed |= (indexes[:, :, i] <<
+                       (8 - bitdepth * (i + 1))).astype(numpy.uint8)
+        indexes = packed
+    # Every row starts with filter type 0, which suits paletted images best
+    rows = numpy.hstack([numpy.zeros((height, 1), dtype=numpy.uint8),
+                         indexes])
+
+    def chunk(kind, data):
+        return (pack(b'>I', len(data)) + kind + data +
+                pack(b'>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    colors = bytearray()
+    alphas = bytearray()
+    for color in palette:
+        colors.extend((color.r, color.g, color.b))
+        alphas.append(color.a)
+    # Trailing opaque entries may be left out of tRNS
+    alphas = alphas.rstrip(b'\xff')
+
+    contents = [
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', pack(b'>IIBBBBB', width, height, bitdepth, 3, 0, 0, 0)),
+        chunk(b'PLTE', bytes(colors)),
+    ]
+    if alphas:
+        contents.append(chunk(b'tRNS', bytes(alphas)))
+    contents.extend([
+        chunk(b'IDAT', zlib.compress(rows.tobytes(), compression)),
+        chunk(b'IEND', b''),
+    ])
+    return b''.join(contents)
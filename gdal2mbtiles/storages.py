@@ -24,13 +24,14 @@ import sys
 
 from collections import defaultdict
 from functools import partial
+import logging
 import os
 
 from .constants import TILE_SIDE
 from .gdal import SpatialReference
-from .mbtiles import MBTiles
+from .mbtiles import MBTiles, tile_id
 from .gd_types import rgba
-from .utils import intmd5, makedirs
+from .utils import intmd5, makedirs, rmfile, solid_pixel
 from .vips import VImageAdapter
 
 
@@ -40,19 +41,34 @@ except NameError:
   basestring = str
 
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
 class Storage(object):
     """Base class for storages."""
 
-    def __init__(self, renderer, pool=None):
+    def __init__(self, renderer, pool=None, cache=None):
         """
         Initialize a storage.
 
         renderer: Used to render images into tiles.
+        cache: Optional `caches.TileCache` of rendered tiles, to skip
+               rendering images that were rendered before.
         """
         self.renderer = renderer
+        self.cache = cache
 
         self.hasher = intmd5
 
+        # Hashes of single colour images, by colour and shape, and the
+        # reverse. See `get_hash`.
+        self._solids = {}
+        self._solid_pixels = {}
+        # Rendered single colour tiles, by hash and renderer settings. See
+        # `render`.
+        self._solid_tiles = {}
+
     def __enter__(self):
         return self
 
@@ -60,8 +76,60 @@ class Storage(object):
         return
 
     def get_hash(self, image):
-        """Returns the image content hash."""
-        return self.hasher(image.write_to_memory())
+        """
+        Returns the image content hash.
+
+        Single colour images, like oceans or fill colours, are only hashed
+        once per colour.
+        """
+        data = image.write_to_memory()
+        pixel = solid_pixel(data, len(data) // (image.width * image.height))
+        if pixel is None:
+            return self.hasher(data)
+
+        key = (pixel, image.width, image.height, image.bands, image.format)
+        hashed = self._solids.get(key)
+        if hashed is None:
+            hashed = self._solids[key] = self.hasher(data)
+            self._solid_pixels[hashed] = pixel
+        return hashed
+
+    def render(self, image, hashed):
+        """
+        Returns `image` rendered into a tile, from the cache if possible.
+
+        hashed: Content hash of the image. See `get_hash`.
+
+        Single colour images are only rendered once per colour and shape.
+        """
+        pixel = self._solid_pixels.get(hashed)
+        if pixel is not None:
+            key = (hashed, self.renderer.settings)
+            contents = self._solid_tiles.get(key)
+            if contents is None:
+                contents = self.renderer.render_solid(image, pixel)
+                self._solid_tiles[key] = contents
+            return contents
+
+        contents = self.cached(hashed=hashed)
+        if contents is None:
+            contents = self.renderer.render(image)
+            self.cache_rendered(hashed=hashed, contents=contents)
+        return contents
+
+    def cached(self, hashed):
+        """Returns the cached tile for content hash `hashed`, or None."""
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache.key(hashed=hashed,
+                                             renderer=self.renderer))
+
+    def cache_rendered(self, hashed, contents):
+        """Caches the tile `contents` for content hash `hashed`."""
+        if self.cache is None:
+            return
+        self.cache.put(self.cache.key(hashed=hashed, renderer=self.renderer),
+                       contents)
 
     def filepath(self, x, y, z, hashed):
         """Returns the filepath."""
@@ -125,7 +193,7 @@ class SimpleFileStorage(Storage):
             self.symlink(src=self.seen[hashed], dst=filepath)
         else:
             self.seen[hashed] = filepath
-            contents = self.renderer.render(image)
+            contents = self.render(image=image, hashed=hashed)
             outputfile = os.path.join(self.outputdir, filepath)
             with open(outputfile, 'wb') as output:
                 output.write(contents)
@@ -195,7 +263,13 @@ class MbtilesStorage(Storage):
 
     http://mapbox.com/developers/mbtiles/
     """
+
+    # Number of tiles inserted between checks of the staging database size
+    # against memory_limit
+    MEMORY_CHECK_INTERVAL = 256
+
     def __init__(self, renderer, filename, zoom_offset=None, seen=None,
+                 target=None, checkpoint=None, memory_limit=None,
                  **kwargs):
         """
         Initializes storage.
@@ -203,6 +277,13 @@ class MbtilesStorage(Storage):
         renderer: Used to render images into tiles.
         filename: Name of the MBTiles file.
         pool: Process pool to coordinate subprocesses.
+
+        target: Name of the MBTiles file that `filename` is staged for. See
+                `create`.
+        checkpoint: Copy the staged tiles into `target` every N tiles.
+        memory_limit: Write into `target` directly once the staging
+                      database grows beyond this many bytes, checked every
+                      MEMORY_CHECK_INTERVAL tiles.
         """
         super(MbtilesStorage, self).__init__(renderer=renderer,
                                              **kwargs)
@@ -210,11 +291,15 @@ class MbtilesStorage(Storage):
             zoom_offset = 0
         self.zoom_offset = zoom_offset
 
+        # Tiles are deduplicated by their tile_id in the images table
         if seen is None:
             seen = set()
         self.seen = seen
         self._border_hashed = None
 
+        # Prerendered images waiting for the renderer to finish them in bulk
+        self._pending = []
+
         self.mbtiles = None
 
         if isinstance(filename, basestring):
@@ -224,17 +309,82 @@ class MbtilesStorage(Storage):
             self.mbtiles = filename
             self.filename = self.mbtiles.filename
 
+        self.target = target
+        self._staging = None
+        if target is not None:
+            self._staging = self.filename
+            self.filename = target
+        self.checkpoint = checkpoint
+        self.memory_limit = memory_limit
+        self._unflushed = 0
+        self._unchecked = 0
+
     def __del__(self):
-        if self.mbtiles is not None:
-            self.mbtiles.close()
+        self.close()
 
     def __exit__(self, type, value, traceback):
-        if self.mbtiles is not None:
+        self.close()
+
+    def close(self):
+        """
+        Copies any staged tiles into the target, and closes the file. The
+        staging database is removed.
+        """
+        if self.mbtiles is not None and not self.mbtiles.closed:
+            self.flush()
             self.mbtiles.close()
+            self._remove_staging()
+
+    def _remove_staging(self):
+        """Removes the staging database, once copied into the target."""
+        if self._staging is not None and self._staging != ':memory:':
+            # Frees the space it takes, on a tmpfs in memory
+            rmfile(self._staging, ignore_missing=True)
+        self._staging = None
+
+    def flush(self):
+        """
+        Finishes rendering pending tiles, and copies the staging database into
+        the target, if staging.
+        """
+        self._render_pending()
+        if self.target is not None:
+            logger.debug(
+                'Copying staged tiles into {0}'.format(self.target)
+            )
+            self.mbtiles.backup(filename=self.target)
+        self._unflushed = 0
+
+    def _inserted(self):
+        """Runs after each tile is inserted, to manage the staging database."""
+        if self.target is None:
+            return
+
+        self._unflushed += 1
+        self._unchecked += 1
+        if self.memory_limit is not None and \
+           self._unchecked >= self.MEMORY_CHECK_INTERVAL:
+            self._unchecked = 0
+            if self.mbtiles.size > self.memory_limit:
+                # Spill into the target and carry on writing there
+                logger.debug(
+                    'Staging database exceeds {0} bytes, '
+                    'writing into {1}'.format(self.memory_limit, self.target)
+                )
+                self.flush()
+                self.mbtiles.close()
+                self._remove_staging()
+                self.mbtiles = MBTiles(filename=self.target)
+                self.target = None
+                return
+        if self.checkpoint is not None and \
+           self._unflushed >= self.checkpoint:
+            self.flush()
 
     @classmethod
     def create(cls, renderer, filename, metadata, zoom_offset=None,
-               version=None, **kwargs):
+               version=None, compact=False, order=None, staging=None,
+               **kwargs):
         """
         Creates a new MBTiles file.
 
@@ -244,22 +394,65 @@ class MbtilesStorage(Storage):
         zoom_offset: Offset zoom level.
 
         version: Optional MBTiles version.
+        compact: Use the compact MBTiles schema. See `MBTiles._create`.
+        order: Order of the packed keys of the compact schema.
         pool: Process pool to coordinate subprocesses.
 
+        staging: Name of a staging database, like ':memory:' or a file on a
+                 tmpfs. Tiles are written there, and copied into `filename`
+                 with SQLite's online backup API at checkpoints and on close.
+                 A staging file is removed once it has been copied.
+        checkpoint: Copy the staged tiles into `filename` every N tiles.
+                    Defaults to only copying them on close.
+        memory_limit: Write into `filename` directly once the staging
+                      database grows beyond this many bytes.
+
         Metadata is also taken as **kwargs. See `mbtiles.Metadata`.
         """
         bounds = metadata.get('bounds', None)
         if bounds is not None:
             metadata['bounds'] = bounds.lower_left + bounds.upper_right
+
+        target = None
+        if staging is not None:
+            target, filename = filename, staging
         mbtiles = MBTiles.create(filename=filename, metadata=metadata,
-                                 version=version)
+                                 version=version, compact=compact,
+                                 order=order)
+        if target is not None:
+            # Fails early if the target can't be written
+            mbtiles.backup(filename=target)
         return cls(renderer=renderer,
                    filename=mbtiles,
                    zoom_offset=zoom_offset,
+                   target=target,
+                   **kwargs)
+
+    @classmethod
+    def append(cls, renderer, filename, zoom_offset=None, **kwargs):
+        """
+        Opens an existing MBTiles file to add more tiles to it.
+
+        renderer: Used to render images into tiles.
+        filename: Name of the MBTiles file.
+        zoom_offset: Offset zoom level.
+
+        pool: Process pool to coordinate subprocesses.
+
+        Images that are already in the file are not rendered again.
+        """
+        mbtiles = MBTiles(filename=filename)
+        return cls(renderer=renderer,
+                   filename=mbtiles,
+                   zoom_offset=zoom_offset,
+                   seen=set(mbtiles.tile_ids()),
                    **kwargs)
 
     def post_import(self, pyramid):
-        """Insert the dataset extents into the metadata."""
+        """
+        Insert the dataset extents into the metadata, and record which tiles
+        exist or are empty. See `MBTiles.write_coverage`.
+        """
         # The MBTiles spec says that the bounds must be in EPSG:4326
         transform = pyramid.dataset.GetCoordinateTransformation(
             dst_ref=SpatialReference.FromEPSG(4326)
@@ -271,16 +464,84 @@ class MbtilesStorage(Storage):
         self.mbtiles.metadata['bounds'] = (lower_left.x, lower_left.y,
                                            upper_right.x, upper_right.y)
 
+        self.write_coverage()
+
+    def write_coverage(self):
+        """
+        Records which tiles exist or are empty. See `MBTiles.write_coverage`.
+        """
+        # Inserting pending images would drop the new coverage
+        self._render_pending()
+
+        # Transparent tiles inside the dataset hash the same as borders
+        empty = self._border_hashed
+        if empty is None:
+            empty = self.get_hash(self._border_image())
+        self.mbtiles.write_coverage(empty=empty)
+
     def save(self, x, y, z, image):
         """Saves `image` at coordinates `x`, `y`, and `z`."""
         hashed = self.get_hash(image)
-        if hashed in self.seen:
+        contents = None
+        if tile_id(hashed) not in self.seen:
+            if self.renderer.batch_size > 1 and \
+                    hashed not in self._solid_pixels:
+                contents = self.cached(hashed=hashed)
+                if contents is None:
+                    self._save_pending(x=x, y=y, z=z, hashed=hashed,
+                                       image=image)
+                    return
+            else:
+                contents = self.render(image=image, hashed=hashed)
+        self.save_rendered(x=x, y=y, z=z, hashed=hashed, contents=contents)
+
+    def _save_pending(self, x, y, z, hashed, image):
+        """
+        Saves `image` at coordinates `x`, `y`, and `z`, but only inserts its
+        data once a whole batch has been rendered. See `Renderer.batch_size`.
+        """
+        self.seen.add(tile_id(hashed))
+        self._pending.append((x, y, z + self.zoom_offset, hashed,
+                              self.renderer.prerender(image)))
+        # Later tiles with the same image link to this one meanwhile
+        self.mbtiles.insert(x=x, y=y, z=z + self.zoom_offset, hashed=hashed)
+        if len(self._pending) >= self.renderer.batch_size:
+            self._render_pending()
+        self._inserted()
+
+    def _render_pending(self):
+        """Finishes rendering the pending tiles, and inserts their data."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        contents = self.renderer.postrender([p[-1] for p in pending])
+        for (x, y, z, hashed, _), data in zip(pending, contents):
+            self.cache_rendered(hashed=hashed, contents=data)
+            if sys.version_info < (3, 0):
+                data = buffer(data)
+            else:
+                data = memoryview(data)
+            self.mbtiles.insert(x=x, y=y, z=z, hashed=hashed, data=data)
+
+    def save_rendered(self, x, y, z, hashed, contents=None):
+        """
+        Saves an image that has already been hashed, and perhaps rendered, at
+        coordinates `x`, `y`, and `z`.
+
+        hashed: Content hash of the image. See `get_hash`.
+        contents: Rendered image. Only needed if the storage has not already
+                  seen `hashed`.
+        """
+        if tile_id(hashed) in self.seen:
             self.mbtiles.insert(x=x, y=y,
                                 z=z + self.zoom_offset,
                                 hashed=hashed)
         else:
-            self.seen.add(hashed)
-            contents = self.renderer.render(image)
+            if contents is None:
+                raise ValueError(
+                    'Contents required for unseen image {0!r}'.format(hashed)
+                )
+            self.seen.add(tile_id(hashed))
             if sys.version_info < (3, 0):
                 data = buffer(contents)
             else:
@@ -289,6 +550,7 @@ class MbtilesStorage(Storage):
                                 z=z + self.zoom_offset,
                                 hashed=hashed,
                                 data=data)
+        self._inserted()
 
     def save_border(self, x, y, z):
         """Saves a border image at coordinates `x`, `y`, and `z`."""
@@ -301,3 +563,4 @@ class MbtilesStorage(Storage):
             self.mbtiles.insert(x=x, y=y,
                                 z=z + self.zoom_offset,
                                 hashed=self._border_hashed)
+            self._inserted()
@@ -81,3 +81,69 @@ def recursive_listdir(directory):
 def intmd5(x):
     """Returns the MD5 digest of `x` as an integer."""
     return int(md5(x).hexdigest(), base=16)
+
+
+def solid_pixel(data, size):
+    """
+    Returns the bytes of the only pixel value in `data`, or None if it holds
+    more than one.
+
+    size: Number of bytes per pixel.
+    """
+    pixel = data[:size]
+    # Most tiles differ somewhere along their diagonal, so fail fast there
+    # before comparing the whole buffer.
+    middle = (len(data) // size // 2) * size
+    if data[-size:] != pixel or data[middle:middle + size] != pixel:
+        return None
+    if data != pixel * (len(data) // size):
+        return None
+    return pixel
+
+
+def hilbert_index(order, x, y):
+    """
+    Returns the distance of (`x`, `y`) along a Hilbert curve.
+
+    The curve fills a 2**order × 2**order grid, starting at (0, 0) and ending
+    at (2**order - 1, 0).
+    """
+    n = 1 << order
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so that the curve stays continuous
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def hilbert_coordinates(order, d):
+    """
+    Returns the (x, y) at distance `d` along a Hilbert curve. This is the
+    inverse of `hilbert_index`.
+    """
+    n = 1 << order
+    x = y = 0
+    s = 1
+    while s < n:
+        rx = 1 & (d >> 1)
+        ry = 1 & (d ^ rx)
+        # Undo the rotation of the quadrant, like `hilbert_index`
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        d >>= 2
+        s <<= 1
+    return x, y
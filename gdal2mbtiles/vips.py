@@ -20,14 +20,16 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import json
 import os
 
 from contextlib import contextmanager
 from ctypes import c_double, c_int, c_void_p, cdll
 from ctypes.util import find_library
+from functools import partial
 from itertools import groupby
 import logging
-from math import ceil, floor
+from math import ceil, floor, isnan
 from multiprocessing import cpu_count
 from operator import itemgetter
 
@@ -37,7 +39,7 @@ import numpy
 from .constants import TILE_SIDE
 from .gdal import Dataset, Band
 from .gd_types import rgba, XY
-from .utils import tempenv
+from .utils import hilbert_index, tempenv
 
 from pyvips import Image, Interpolate
 from pyvips.enums import BandFormat, Coding
@@ -179,6 +181,20 @@ class VImageAdapter(object):
             )
         return image
 
+    @classmethod
+    def from_buffer(cls, data):
+        """
+        Returns a new RGBA pyvips.Image decoded from `data`.
+
+        data: Encoded image, like the tile data of a PNG or JPEG tile.
+        """
+        image = Image.new_from_buffer(data, '')
+        if image.bands < 3:
+            image = image.colourspace('srgb')
+        if not image.hasalpha():
+            image = image.bandjoin(255)
+        return image.cast(BandFormat.UCHAR)
+
     @classmethod
     def from_gdal_dataset(cls, dataset, band):
         """
@@ -348,7 +364,8 @@ class VImageAdapter(object):
                            ow=output_width, oh=output_height,
                            interpolate=interpolate)
 
-    def shrink_affine(self, xscale, yscale, output_size=None):
+    def shrink_affine(self, xscale, yscale, output_size=None,
+                      interpolate='bilinear'):
         """
         Image.shrink uses lipvips shrink method which use reduce, not affine,
         for any residual shrink.  This method uses affine.
@@ -358,6 +375,7 @@ class VImageAdapter(object):
         xscale: floating point scaling value for image
         yscale: floating point scaling value for image
         output_size: output width and height in pixels (tuple)
+        interpolate: intepolation method (near, bilinear). Default: bilinear
         """
         if not 0.0 < xscale <= 1.0:
             raise ValueError(
@@ -368,7 +386,8 @@ class VImageAdapter(object):
                 'yscale {0!r} be between 0.0 and 1.0'.format(yscale)
             )
         return self._scale(
-            xscale=xscale, yscale=yscale, output_size=output_size, interpolate='bilinear'
+            xscale=xscale, yscale=yscale, output_size=output_size,
+            interpolate=interpolate
         )
 
     def stretch(self, xscale, yscale, output_size=None):
@@ -425,7 +444,8 @@ class VImageAdapter(object):
 
         # Resize
         return self.image.embed(
-            x, y, width, height, background=[0, 0, 0, 0]  # Transparent
+            x, y, width, height,
+            background=[0] * self.image.bands  # Transparent
         )
 
     def BufferSize(self):
@@ -512,6 +532,13 @@ class VipsDataset(Dataset):
         self.inputfile = inputfile
         self._image = None
 
+        # Colors of the palette indexes in the image, if colorized with
+        # indexed=True. See `colorize`.
+        self.palette = None
+
+        # Whether the image holds raw band values. See `extract_values`.
+        self.values = False
+
     @property
     def image(self):
         if self._image is None:
@@ -545,11 +572,40 @@ class VipsDataset(Dataset):
                              buffer=bytes(area.write_to_memory()),
                              dtype=datatype)
 
-    def colorize(self, colors):
-        """Replaces this image with a colorized version."""
+    def colorize(self, colors, indexed=False):
+        """
+        Replaces this image with a colorized version.
+
+        indexed: Replace it with palette indexes instead of RGBA, and keep
+                 the palette in `palette`. See `ColorBase.colorize_indexed`.
+        """
+        with LibVips.disable_warnings():
+            nodata = self.GetRasterBand(1).GetNoDataValue()
+            if indexed:
+                self._image, self.palette = colors.colorize_indexed(
+                    image=self.image, nodata=nodata
+                )
+            else:
+                self._image = colors.colorize(image=self.image, nodata=nodata)
+
+    def extract_values(self):
+        """
+        Replaces this image with the raw values of its first band, followed
+        by a mask band that is 0 where there is no data.
+
+        Padding the image with zeros masks it out, as it makes RGBA images
+        transparent. Values are resampled by nearest neighbour from now on,
+        so that they stay exact.
+        """
         with LibVips.disable_warnings():
             nodata = self.GetRasterBand(1).GetNoDataValue()
-            self._image = colors.colorize(image=self.image, nodata=nodata)
+            values = self.image.extract_band(0)
+            # NaN never equals itself
+            mask = values == values
+            if nodata is not None and not isnan(nodata):
+                mask = mask & (values != nodata)
+            self._image = values.bandjoin(mask.cast(values.format))
+            self.values = True
 
     def _resample(self, ratios):
         if ratios == XY(x=1.0, y=1.0):
@@ -582,9 +638,14 @@ class VipsDataset(Dataset):
                     output_size=(dst_width, dst_height)
                 )
             else:
+                # Palette indexes and raw values can't be interpolated
+                interpolate = 'bilinear'
+                if self.palette is not None or self.values:
+                    interpolate = 'near'
                 self._image = VImageAdapter(self.image).shrink_affine(
                     xscale=ratios.x, yscale=ratios.y,
-                    output_size=(dst_width, dst_height)
+                    output_size=(dst_width, dst_height),
+                    interpolate=interpolate
                 )
 
             # Fix the dataset's metadata
@@ -734,8 +795,15 @@ class TmsTiles(object):
     IMAGE_BUFFER_MEMORY_THRESHOLD = 1024 ** 2  # 1 MiB
     IMAGE_BUFFER_DISK_THRESHOLD = 1024 ** 3    # 1 GiB
 
+    # Orders in which tiles are sliced and saved
+    ORDERS = ('row', 'hilbert')
+
+    # Number of tile rows in each strip, when slicing in Hilbert order.
+    # Must be a power of 2.
+    HILBERT_STRIP_TILES = 16
+
     def __init__(self, image, storage, tile_width, tile_height, offset,
-                 resolution):
+                 resolution, order=None, indexed=False):
         """
         image: gdal2mbtiles.vips.VImage
         storage: Storage for rendered tiles
@@ -743,13 +811,29 @@ class TmsTiles(object):
         tile_height: Number of pixels for each tile
         offset: TMS offset for the lower-left tile
         resolution: TMS resolution for this image.
+        order: Order in which tiles are saved, one of ORDERS.
+               Defaults to 'row', which is raster order.
+        indexed: The image holds palette indexes or raw values, which are
+                 downsampled by nearest neighbour instead of being
+                 interpolated.
         """
+        if order is None:
+            order = 'row'
+        if order not in self.ORDERS:
+            raise ValueError(
+                'order {0!r} must be one of: {1}'.format(
+                    order, ', '.join(self.ORDERS)
+                )
+            )
+
         self.image = image
         self.storage = storage
         self.tile_width = tile_width
         self.tile_height = tile_height
         self.offset = offset
         self.resolution = resolution
+        self.order = order
+        self.indexed = indexed
 
         # Used to determine whether this TmsTiles is backed by a buffer.
         self._parent = None
@@ -768,25 +852,62 @@ class TmsTiles(object):
         for x, y in borders:
             self.storage.save_border(x=x, y=y, z=resolution)
 
+    def _row_positions(self):
+        """Yields the pixel offsets of each tile in raster order."""
+        for y in range(0, self.image_height, self.tile_height):
+            for x in range(0, self.image_width, self.tile_width):
+                yield x, y
+
+    def _hilbert_positions(self):
+        """
+        Yields the pixel offsets of each tile in Hilbert order.
+
+        The image is walked in horizontal strips of HILBERT_STRIP_TILES tile
+        rows, so that VIPS still reads the image from top to bottom. Each
+        strip is cut into square blocks, which are walked from left to right,
+        and the tiles within each block follow a Hilbert curve. Since each
+        curve ends next to where the following one starts, neighbouring tiles
+        stay close to each other in the output.
+        """
+        side = self.HILBERT_STRIP_TILES
+        order = side.bit_length() - 1
+        block = sorted(
+            ((x, y) for x in range(side) for y in range(side)),
+            key=lambda xy: hilbert_index(order=order, x=xy[0], y=xy[1])
+        )
+
+        # Count partial tiles at the edges, like _row_positions
+        columns = int(ceil(self.image_width / self.tile_width))
+        rows = int(ceil(self.image_height / self.tile_height))
+        for top in range(0, rows, side):
+            for left in range(0, columns, side):
+                for x, y in block:
+                    x += left
+                    y += top
+                    if x < columns and y < rows:
+                        yield x * self.tile_width, y * self.tile_height
+
     def _slice(self):
         """Helper function that actually slices tiles. See ``slice``."""
+        if self.order == 'hilbert':
+            positions = self._hilbert_positions()
+        else:
+            positions = self._row_positions()
+
         with LibVips.disable_warnings():
-            xys = []
-            for y in range(0, self.image_height, self.tile_height):
-                for x in range(0, self.image_width, self.tile_width):
-                    out = self.image.extract_area(
-                        x, y,                    # left, top offsets
-                        self.tile_width, self.tile_height
-                    )
-                    offset = XY(
-                        x=int(x / self.tile_width + self.offset.x),
-                        y=int((self.image_height - y) / self.tile_height +
-                              self.offset.y - 1)
-                    )
-                    xys.append((x, y))
-                    self.storage.save(x=offset.x, y=offset.y,
-                                      z=self.resolution,
-                                      image=out)
+            for x, y in positions:
+                out = self.image.extract_area(
+                    x, y,                    # left, top offsets
+                    self.tile_width, self.tile_height
+                )
+                offset = XY(
+                    x=int(x / self.tile_width + self.offset.x),
+                    y=int((self.image_height - y) / self.tile_height +
+                          self.offset.y - 1)
+                )
+                self.storage.save(x=offset.x, y=offset.y,
+                                  z=self.resolution,
+                                  image=out)
 
     def slice(self):
         """
@@ -826,10 +947,13 @@ class TmsTiles(object):
         parent = self._parent if self._parent is not None else self
         parent_resolution = parent.resolution
         parent_size = VImageAdapter(parent.image).BufferSize()
+        interpolate = 'near' if self.indexed else 'bilinear'
 
         for res in reversed(list(range(self.resolution - levels, self.resolution))):
             offset /= 2.0
-            shrunk = VImageAdapter(image).shrink_affine(xscale=0.5, yscale=0.5)
+            shrunk = VImageAdapter(image).shrink_affine(
+                xscale=0.5, yscale=0.5, interpolate=interpolate
+            )
             image = VImageAdapter(shrunk).tms_align(tile_width=self.tile_width,
                                      tile_height=self.tile_height,
                                      offset=offset)
@@ -867,7 +991,9 @@ class TmsTiles(object):
                                 tile_width=self.tile_width,
                                 tile_height=self.tile_height,
                                 offset=offset,
-                                resolution=res)
+                                resolution=res,
+                                order=self.order,
+                                indexed=self.indexed)
         result._parent = parent
         return result
 
@@ -894,7 +1020,9 @@ class TmsTiles(object):
                               tile_width=self.tile_width,
                               tile_height=self.tile_height,
                               offset=offset.floor(),
-                              resolution=self.resolution + levels)
+                              resolution=self.resolution + levels,
+                              order=self.order,
+                              indexed=self.indexed)
 
     def write_buffer(self, image, resolution):
         if VImageAdapter(image).BufferSize() >= self.IMAGE_BUFFER_DISK_THRESHOLD:
@@ -920,7 +1048,7 @@ class TmsPyramid(object):
     TmsTiles = TmsTiles
 
     def __init__(self, inputfile, storage,
-                 min_resolution=None, max_resolution=None):
+                 min_resolution=None, max_resolution=None, order=None):
         """
         Represents a pyramid of PNG tiles.
 
@@ -928,6 +1056,7 @@ class TmsPyramid(object):
         storage: Storage for rendered tiles
         min_resolution: Minimum resolution to downsample tiles.
         max_resolution: Maximum resolution to upsample tiles.
+        order: Order in which tiles are saved. See TmsTiles.ORDERS.
 
         Filenames are in the format `{tms_z}/{tms_x}-{tms_y}-{image_hash}.png`.
 
@@ -941,13 +1070,24 @@ class TmsPyramid(object):
         self.storage = storage
         self.min_resolution = min_resolution
         self.max_resolution = max_resolution
+        self.order = order
 
         self._dataset = None
         self._resolution = None
 
-    def colorize(self, colors):
-        """Replaces this image with a colorized version."""
-        return self.dataset.colorize(colors)
+    def colorize(self, colors, indexed=False):
+        """
+        Replaces this image with a colorized version. See
+        `VipsDataset.colorize`.
+        """
+        return self.dataset.colorize(colors, indexed=indexed)
+
+    def extract_values(self):
+        """
+        Replaces this image with its raw values. See
+        `VipsDataset.extract_values`.
+        """
+        return self.dataset.extract_values()
 
     @property
     def dataset(self):
@@ -959,6 +1099,11 @@ class TmsPyramid(object):
     def image(self):
         return self.dataset.image
 
+    @property
+    def palette(self):
+        """Returns the colors of the palette indexes in the image, or None."""
+        return self.dataset.palette
+
     @property
     def resolution(self):
         if self._resolution is None:
@@ -973,7 +1118,10 @@ class TmsPyramid(object):
                                  storage=self.storage,
                                  tile_width=TILE_SIDE, tile_height=TILE_SIDE,
                                  offset=offset.lower_left,
-                                 resolution=self.resolution)
+                                 resolution=self.resolution,
+                                 order=self.order,
+                                 indexed=(self.palette is not None or
+                                          self.dataset.values))
 
     def slice_downsample(self, tiles, min_resolution, max_resolution=None,
                          fill_borders=None):
@@ -1090,6 +1238,75 @@ class TmsPyramid(object):
         self.storage.post_import(pyramid=self)
 
 
+# Kernels for reduce_tiles
+REDUCE_KERNELS = ('nearest', 'linear', 'cubic', 'mitchell',
+                  'lanczos2', 'lanczos3')
+
+
+def reduce_tiles(upper_left, upper_right, lower_left, lower_right,
+                 kernel=None, values=False):
+    """
+    Returns the RGBA pyvips.Image of a tile at the zoom level below the four
+    tiles, which it covers.
+
+    upper_left, upper_right, lower_left, lower_right: Encoded tile data, or
+        None for missing tiles, which are transparent.
+    kernel: Reduction kernel, one of REDUCE_KERNELS. Defaults to 'linear',
+            or 'nearest' for values.
+    values: The tiles hold raw values and a mask band, from a DataRenderer.
+            They are decoded as they are, and can only be reduced by
+            nearest neighbour, so that values stay exact. Missing tiles are
+            masked out.
+
+    The result is computed into memory, so that it can be built on a
+    different thread from the one that uses it.
+    """
+    if kernel is None:
+        kernel = 'nearest' if values else 'linear'
+    if kernel not in REDUCE_KERNELS:
+        raise ValueError(
+            'kernel {0!r} must be one of: {1}'.format(
+                kernel, ', '.join(REDUCE_KERNELS)
+            )
+        )
+    if values and kernel != 'nearest':
+        raise ValueError(
+            'Raw values can only be reduced by the nearest kernel: '
+            '{0!r}'.format(kernel)
+        )
+
+    if values:
+        decode = partial(Image.new_from_buffer, options='')
+    else:
+        decode = VImageAdapter.from_buffer
+    tiles = [None if data is None else decode(data)
+             for data in (upper_left, upper_right, lower_left, lower_right)]
+    first = next((t for t in tiles if t is not None), None)
+    width, height = TILE_SIDE, TILE_SIDE
+    if first is not None:
+        width, height = first.width, first.height
+    if values:
+        if first is None:
+            raise ValueError('Cannot reduce raw values without any tiles')
+        # Zeros in the mask band mean no data
+        empty = Image.black(width, height,
+                            bands=first.bands).cast(first.format)
+    else:
+        empty = VImageAdapter.new_rgba(width=width, height=height,
+                                       ink=rgba(r=0, g=0, b=0, a=0))
+    tiles = [empty if t is None else t for t in tiles]
+
+    with LibVips.disable_warnings():
+        image = Image.arrayjoin(tiles, across=2)
+        if kernel == 'nearest':
+            image = image.reduce(2, 2, kernel=kernel)
+        else:
+            # Premultiply, so that transparent pixels don't bleed colour
+            image = image.premultiply().reduce(2, 2, kernel=kernel)
+            image = image.unpremultiply().rint().cast(BandFormat.UCHAR)
+        return image.copy_memory()
+
+
 def validate_resolutions(resolution,
                          min_resolution=None, max_resolution=None,
                          strict=True):
@@ -1183,6 +1400,34 @@ class ColorBase(dict):
     def _clauses(self, band, nodata=None):
         raise NotImplementedError()
 
+    def _index_colors(self, nodata=None):
+        """
+        Returns a list of (band_value, color) for palette indexes, sorted by
+        band_value.
+        """
+        raise NotImplementedError()
+
+    def _index(self, data, values, indexes):
+        """
+        Returns a uchar numpy array of the palette index for each value in
+        `data`, where `values` is a sorted numpy array of the band values
+        from `_index_colors`, and `indexes` their palette indexes.
+        """
+        raise NotImplementedError()
+
+    def to_json(self):
+        """
+        Returns this coloring as JSON, so that clients can style raw values
+        themselves. See `renderers.DataRenderer`.
+        """
+        return json.dumps({
+            'coloring': type(self).__name__,
+            'colors': [
+                [band_value, '#{0:02x}{1:02x}{2:02x}{3:02x}'.format(*color)]
+                for band_value, color in sorted(self.items())
+            ],
+        })
+
     def _colors(self, band):
         """Returns a list of (band_value, color) for `band`"""
         colors = ColorList((band_value, getattr(color, band))
@@ -1235,6 +1480,59 @@ class ColorBase(dict):
 
         return VImageAdapter.gbandjoin(bands=images)
 
+    def colorize_indexed(self, image, nodata=None):
+        """
+        Returns (index, palette), where index is a new 1-band uchar VImage of
+        indexes into palette, a list of rgba colors.
+
+        Index 0 is always the transparent background, so that padding the
+        image with zeros keeps it transparent. Colors are looked up with
+        numpy, so that all 255 other indexes can be used.
+        """
+        if image.bands != 1:
+            raise ValueError(
+                'image {0!r} has more than one band'.format(image)
+            )
+
+        logging.info('Coloring data as palette indexes')
+        logging.debug(
+            'Algorithm: {0} {1}'.format(
+                type(self).__name__, self
+            )
+        )
+
+        palette = [self.BACKGROUND]
+        values = []
+        indexes = []
+        for band_value, color in self._index_colors(nodata=nodata):
+            if color not in palette:
+                palette.append(color)
+            values.append(band_value)
+            indexes.append(palette.index(color))
+        if len(palette) > 256:
+            raise ValueError(
+                '{0} has more than 255 colors'.format(type(self).__name__)
+            )
+
+        data = numpy.frombuffer(buffer=image.write_to_memory(),
+                                dtype=VImageAdapter(image).NumPyType())
+        if len(palette) == 1:
+            array = numpy.zeros(shape=data.size, dtype=numpy.uint8)
+        else:
+            array = self._index(data=data, values=numpy.array(values),
+                                indexes=numpy.array(indexes,
+                                                    dtype=numpy.uint8))
+            # NaN never equals itself
+            array[data != data] = 0
+            if nodata is not None:
+                array[data == nodata] = 0
+
+        index = VImageAdapter.from_numpy_array(
+            array=array, width=image.width, height=image.height, bands=1,
+            format='uchar'
+        )
+        return index, palette
+
     def _expression(self, band, nodata=None):
         clauses = self._clauses(band=band, nodata=nodata)
         if not clauses:
@@ -1274,6 +1572,20 @@ class ColorExact(ColorBase):
                 for band_value, color in colors
                 if band_value != nodata and color != background]
 
+    def _index_colors(self, nodata=None):
+        return [(band_value, color)
+                for band_value, color in sorted(self.items())
+                if band_value != nodata and color != self.BACKGROUND]
+
+    def _index(self, data, values, indexes):
+        positions = numpy.searchsorted(values, data)
+        positions = positions.clip(max=len(values) - 1)
+        found = values[positions] == data
+
+        result = numpy.zeros(shape=data.shape, dtype=numpy.uint8)
+        result[found] = indexes[positions[found]]
+        return result
+
 
 class ColorPalette(ColorBase):
     """
@@ -1308,6 +1620,21 @@ class ColorPalette(ColorBase):
 
         return result
 
+    def _index_colors(self, nodata=None):
+        colors = ColorList(sorted(self.items()))
+        colors.lstrip(value=self.BACKGROUND)
+        colors.deduplicate()
+        return colors
+
+    def _index(self, data, values, indexes):
+        # Each value takes the color of the largest band value below it
+        positions = numpy.searchsorted(values, data, side='right') - 1
+        above = positions >= 0
+
+        result = numpy.zeros(shape=data.shape, dtype=numpy.uint8)
+        result[above] = indexes[positions[above]]
+        return result
+
 
 class ColorGradient(ColorBase):
     """
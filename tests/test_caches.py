@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import unittest
+
+from gdal2mbtiles.caches import TileCache, WarpCache
+from gdal2mbtiles.renderers import JpegRenderer, PngRenderer
+from gdal2mbtiles.utils import NamedTemporaryDir
+
+
+class TestTileCache(unittest.TestCase):
+    def test_simple(self):
+        with NamedTemporaryDir() as outputdir:
+            cache = TileCache(directory=outputdir)
+            key = cache.key(hashed=0xdeadbeef, renderer=PngRenderer())
+            self.assertEqual(cache.get(key), None)
+            self.assertEqual(cache.misses, 1)
+
+            cache.put(key, b'PNG image')
+            self.assertEqual(cache.get(key), b'PNG image')
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(cache.size, len(b'PNG image'))
+
+            # Persists across instances
+            cache = TileCache(directory=outputdir)
+            self.assertEqual(cache.get(key), b'PNG image')
+            self.assertEqual(cache.size, len(b'PNG image'))
+
+    def test_key(self):
+        key = TileCache.key(hashed=1, renderer=PngRenderer())
+        self.assertEqual(key, TileCache.key(hashed=1, renderer=PngRenderer()))
+        self.assertNotEqual(key,
+                            TileCache.key(hashed=2, renderer=PngRenderer()))
+        # Settings that change tiles change the key
+        self.assertNotEqual(key,
+                            TileCache.key(hashed=1,
+                                          renderer=PngRenderer(png8=16)))
+        self.assertNotEqual(key,
+                            TileCache.key(hashed=1, renderer=JpegRenderer()))
+        # Settings that don't are ignored
+        self.assertEqual(key,
+                         TileCache.key(hashed=1,
+                                       renderer=PngRenderer(processes=1,
+                                                            suffix='.PNG')))
+
+    def test_evict(self):
+        with NamedTemporaryDir() as outputdir:
+            cache = TileCache(directory=outputdir, max_size=30)
+            renderer = PngRenderer()
+            keys = [cache.key(hashed=i, renderer=renderer) for i in range(4)]
+            for i, key in enumerate(keys[:3]):
+                cache.put(key, b'0123456789')
+                # Order by access time without sleeping
+                os.utime(cache.filepath(key), (i, i))
+            self.assertEqual(cache.size, 30)
+
+            # Using the first tile makes the second the least recently used
+            self.assertEqual(cache.get(keys[0]), b'0123456789')
+            cache.put(keys[3], b'0123456789')
+            self.assertEqual(cache.size, 20)
+            self.assertEqual(cache.get(keys[1]), None)
+            self.assertEqual(cache.get(keys[2]), None)
+            self.assertEqual(cache.get(keys[0]), b'0123456789')
+            self.assertEqual(cache.get(keys[3]), b'0123456789')
+
+    def test_max_size(self):
+        self.assertRaises(ValueError, TileCache, directory='.', max_size=-1)
+
+
+class TestWarpCache(unittest.TestCase):
+    def setUp(self):
+        self.inputfile = os.path.join(os.path.dirname(__file__),
+                                      'bluemarble.tif')
+
+    def warp(self, cache, contents):
+        filename = cache.mktemp()
+        with open(filename, 'wb') as f:
+            f.write(contents)
+        return filename
+
+    def test_simple(self):
+        with NamedTemporaryDir() as outputdir:
+            cache = WarpCache(directory=outputdir)
+            key = cache.key(self.inputfile, band=1)
+            self.assertEqual(cache.get(key), None)
+            self.assertEqual(cache.misses, 1)
+            # Temporary files are ignored until they are put
+            filename = self.warp(cache, b'GeoTIFF')
+            self.assertEqual(cache.size, 0)
+
+            filepath = cache.put(key, filename)
+            self.assertFalse(os.path.exists(filename))
+            self.assertEqual(cache.get(key), filepath)
+            self.assertEqual(cache.hits, 1)
+            with open(filepath, 'rb') as f:
+                self.assertEqual(f.read(), b'GeoTIFF')
+
+            # Persists across instances
+            cache = WarpCache(directory=outputdir)
+            self.assertEqual(cache.get(key), filepath)
+            self.assertEqual(cache.size, len(b'GeoTIFF'))
+
+    def test_key(self):
+        key = WarpCache.key(self.inputfile, band=1, resampling='near')
+        self.assertEqual(key, WarpCache.key(self.inputfile, resampling='near',
+                                            band=1))
+        # Settings change the key
+        self.assertNotEqual(key, WarpCache.key(self.inputfile, band=2,
+                                               resampling='near'))
+        self.assertNotEqual(key, WarpCache.key(self.inputfile, band=1,
+                                               resampling='cubic'))
+
+        with NamedTemporaryDir() as outputdir:
+            # So does the input file
+            inputfile = os.path.join(outputdir, 'input.tif')
+            with open(inputfile, 'wb') as f:
+                f.write(b'GeoTIFF')
+            key = WarpCache.key(inputfile, band=1)
+            os.utime(inputfile, (0, 0))
+            self.assertNotEqual(key, WarpCache.key(inputfile, band=1))
+
+    def test_evict(self):
+        with NamedTemporaryDir() as outputdir:
+            cache = WarpCache(directory=outputdir, max_size=30)
+            keys = [cache.key(self.inputfile, band=i) for i in range(4)]
+            for i, key in enumerate(keys[:3]):
+                cache.put(key, self.warp(cache, b'0123456789'))
+                # Order by access time without sleeping
+                os.utime(cache.filepath(key), (i, i))
+            self.assertEqual(cache.size, 30)
+
+            # Using the first GeoTIFF makes the second the least recently used
+            self.assertTrue(cache.get(keys[0]))
+            cache.put(keys[3], self.warp(cache, b'0123456789'))
+            self.assertEqual(cache.size, 20)
+            self.assertEqual(cache.get(keys[1]), None)
+            self.assertEqual(cache.get(keys[2]), None)
+            self.assertTrue(cache.get(keys[0]))
+            self.assertTrue(cache.get(keys[3]))
+
+            # GeoTIFFs larger than the cache are still kept
+            key = cache.key(self.inputfile, band=5)
+            cache.put(key, self.warp(cache, b'0123456789' * 4))
+            self.assertEqual(cache.size, 40)
+            self.assertTrue(cache.get(key))
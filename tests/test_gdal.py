@@ -16,13 +16,17 @@ from osgeo.gdalconst import GRA_Cubic
 
 import pytest
 
+from gdal2mbtiles.caches import WarpCache
 from gdal2mbtiles.constants import EPSG_WEB_MERCATOR, GDALINFO, TILE_SIDE
 from gdal2mbtiles.exceptions import (GdalError, CalledGdalError,
                                      UnalignedInputError,
                                      UnknownResamplingMethodError)
-from gdal2mbtiles.gdal import (Dataset, extract_color_band, preprocess,
-                               SpatialReference, warp, VRT)
+from gdal2mbtiles.gdal import (Dataset, extract_color_band, extract_window,
+                               preprocess, resampling_methods,
+                               SpatialReference, supported_formats, warp,
+                               VRT)
 from gdal2mbtiles.gd_types import Extents, XY
+from gdal2mbtiles.utils import NamedTemporaryDir
 
 
 __dir__ = os.path.dirname(__file__)
@@ -67,6 +71,41 @@ class TestExtractColorBand(unittest.TestCase):
                           inputfile=self.inputfile, band=10)
 
 
+class TestExtractWindow(TestCase):
+    def setUp(self):
+        self.inputfile = os.path.join(__dir__,
+                                      'bluemarble.tif')
+
+    def test_simple(self):
+        dataset = Dataset(self.inputfile)
+        vrt = extract_window(inputfile=self.inputfile,
+                             xoff=256, yoff=256, xsize=512, ysize=256)
+        with vrt.get_tempfile(suffix='.vrt') as tempfile:
+            window = Dataset(tempfile.name)
+            self.assertEqual((window.RasterXSize, window.RasterYSize),
+                             (512, 256))
+            # Same pixel size, shifted by the offset
+            self.assertEqual(window.GetPixelDimensions(),
+                             dataset.GetPixelDimensions())
+            lower_left = dataset.PixelCoordinates(256, 512)
+            upper_right = dataset.PixelCoordinates(768, 256)
+            self.assertExtentsEqual(
+                window.GetExtents(),
+                Extents(lower_left=lower_left, upper_right=upper_right)
+            )
+
+    def test_invalid(self):
+        self.assertRaises(ValueError,
+                          extract_window, inputfile=self.inputfile,
+                          xoff=-1, yoff=0, xsize=256, ysize=256)
+        self.assertRaises(ValueError,
+                          extract_window, inputfile=self.inputfile,
+                          xoff=0, yoff=0, xsize=0, ysize=256)
+        self.assertRaises(ValueError,
+                          extract_window, inputfile=self.inputfile,
+                          xoff=1024, yoff=0, xsize=1, ysize=256)
+
+
 class TestWarp(unittest.TestCase):
     def setUp(self):
         # Whole world: (180°W, 85°S), (180°E, 85°N)
@@ -113,6 +152,25 @@ class TestWarp(unittest.TestCase):
                     spatial_ref=SpatialReference.FromEPSG(4326)).get_root()
         self.assertTrue('WGS 84' in root.find('.//TargetSRS').text)
 
+    def test_threads(self):
+        # Defaults to all CPUs
+        root = warp(self.inputfile).get_root()
+        self.assertEqual(
+            root.find('.//GDALWarpOptions/Option[@name="NUM_THREADS"]').text,
+            'ALL_CPUS'
+        )
+
+        root = warp(self.inputfile, threads=2).get_root()
+        self.assertEqual(
+            root.find('.//GDALWarpOptions/Option[@name="NUM_THREADS"]').text,
+            '2'
+        )
+
+    def test_working_memory(self):
+        root = warp(self.inputfile, working_memory=256).get_root()
+        self.assertEqual(float(root.find('.//WarpMemoryLimit').text),
+                         256 * 1024 * 1024)
+
     def test_invalid(self):
         self.assertRaises(GdalError, warp, '/dev/null')
 
@@ -133,6 +191,22 @@ class TestWarp(unittest.TestCase):
                                  out_data.GetRasterBand(band).GetNoDataValue())
 
 
+class TestCapabilities(unittest.TestCase):
+    def test_supported_formats(self):
+        formats = dict((f.name, f) for f in supported_formats())
+        self.assertTrue(formats['GTiff'].can_read)
+        self.assertTrue(formats['GTiff'].can_write)
+        self.assertTrue(formats['GTiff'].can_update)
+        self.assertTrue(formats['VRT'].has_virtual_io)
+        self.assertEqual(formats['GTiff'].description, 'GeoTIFF')
+
+    def test_resampling_methods(self):
+        methods = resampling_methods()
+        for method in ['near', 'bilinear', 'cubic', 'cubicspline',
+                       'lanczos']:
+            self.assertTrue(method in methods)
+
+
 class TestPreprocess(unittest.TestCase):
     def test_simple(self):
         inputfile = os.path.join(__dir__, 'srtm.tif')
@@ -170,6 +244,34 @@ class TestPreprocess(unittest.TestCase):
                              in_data.GetRasterBand(1).GetNoDataValue())
 
 
+    def test_cache(self):
+        inputfile = os.path.join(__dir__, 'bluemarble-spanning-ll.tif')
+
+        with NamedTemporaryDir() as outputdir:
+            cache = WarpCache(directory=os.path.join(outputdir, 'cache'))
+            outputfile = os.path.join(outputdir, 'warped.tif')
+            warped = preprocess(inputfile=inputfile, outputfile=outputfile,
+                                band=1, cache=cache)
+            self.assertEqual(cache.misses, 1)
+            self.assertTrue(warped.startswith(cache.directory))
+            self.assertEqual(Dataset(warped).RasterXSize, 412)
+
+            # Same settings reuse the GeoTIFF
+            self.assertEqual(preprocess(inputfile=inputfile,
+                                        outputfile=outputfile, band=1,
+                                        cache=cache),
+                             warped)
+            self.assertEqual(cache.hits, 1)
+            self.assertFalse(os.path.exists(outputfile))
+
+            # Other settings don't
+            self.assertNotEqual(preprocess(inputfile=inputfile,
+                                           outputfile=outputfile, band=2,
+                                           cache=cache),
+                                warped)
+            self.assertEqual(cache.misses, 2)
+
+
 class TestVrt(TestCase):
     def setUp(self):
         self.inputfile = os.path.join(__dir__,
@@ -191,6 +293,29 @@ class TestVrt(TestCase):
             self.assertTrue(tempfile.name.endswith('.vrt'))
             self.assertEqual(tempfile.read(), self.empty)
 
+    def test_get_vsimem(self):
+        vrt = VRT(self.empty)
+        with vrt.get_vsimem() as vsimem:
+            # Default suffix is .vrt
+            self.assertTrue(vsimem.name.startswith('/vsimem/'))
+            self.assertTrue(vsimem.name.endswith('.vrt'))
+            self.assertEqual(vsimem.read(), self.empty)
+        # Closing removes the file
+        self.assertRaises(IOError, vsimem.read)
+
+    def test_callback(self):
+        progress = []
+
+        def callback(complete, message, data):
+            progress.append(complete)
+            return 1
+
+        vrt = warp(self.inputfile)
+        with NamedTemporaryFile(suffix='.tif') as tmpfile:
+            vrt.render(outputfile=tmpfile.name, callback=callback)
+        self.assertTrue(progress)
+        self.assertEqual(progress[-1], 1.0)
+
     def test_world(self):
         vrt = warp(self.inputfile)
         with NamedTemporaryFile(suffix='.tif') as tmpfile:
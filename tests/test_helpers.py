@@ -7,13 +7,22 @@ import os
 from tempfile import NamedTemporaryFile
 import unittest
 
+import numpy
+
 from gdal2mbtiles.exceptions import UnalignedInputError
+from gdal2mbtiles.gd_types import rgba
 from gdal2mbtiles.gdal import Dataset
 from gdal2mbtiles.helpers import (image_mbtiles, image_pyramid, image_slice,
-                                  warp_mbtiles, warp_pyramid, warp_slice)
-from gdal2mbtiles.renderers import TouchRenderer
+                                  overview_mbtiles, recommend_renderer,
+                                  transcode_mbtiles, tune_mbtiles,
+                                  tune_raster, warp_mbtiles, warp_pyramid,
+                                  warp_slice)
+from gdal2mbtiles.mbtiles import MBTiles, jpeg_quality, tile_format
+from gdal2mbtiles.renderers import (DataRenderer, HybridRenderer,
+                                    JpegRenderer, PngRenderer, TouchRenderer)
 from gdal2mbtiles.storages import MbtilesStorage
 from gdal2mbtiles.utils import intmd5, NamedTemporaryDir, recursive_listdir
+from gdal2mbtiles.vips import ColorGradient, Image, VImageAdapter
 
 __dir__ = os.path.dirname(__file__)
 
@@ -51,6 +60,456 @@ class TestImageMbtiles(unittest.TestCase):
                 self.assertEqual(storage.mbtiles.metadata['x-minzoom'], '0')
                 self.assertEqual(storage.mbtiles.metadata['x-maxzoom'], '3')
 
+    def test_values(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            metadata = dict(
+                name='bluemarble-aligned',
+                type='baselayer',
+                version='1.0.0',
+                description='BlueMarble 2004-07 Aligned red band',
+                format='tiff',
+            )
+            colors = ColorGradient({0: rgba(0, 0, 0, 255),
+                                    255: rgba(255, 0, 0, 255)})
+            image_mbtiles(inputfile=self.inputfile, outputfile=outputfile.name,
+                          metadata=metadata, colors=colors,
+                          min_resolution=0, max_resolution=2,
+                          renderer=DataRenderer())
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                self.assertEqual(mbtiles.metadata['format'], 'tiff')
+                self.assertEqual(mbtiles.metadata['x-colors'],
+                                 colors.to_json())
+                tiles = list(mbtiles.all())
+                # No border tiles around the image
+                self.assertTrue(len([t for t in tiles if t[0] == 2]) < 16)
+                for z, x, y, data in tiles:
+                    self.assertEqual(tile_format(data), 'tiff')
+                    image = Image.new_from_buffer(data, '')
+                    # Raw values of the red band, and the mask
+                    self.assertEqual(image.bands, 2)
+                    self.assertEqual(image.format, 'uchar')
+
+    def test_append(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            metadata = dict(
+                name='bluemarble-aligned',
+                type='baselayer',
+                version='1.0.0',
+                description='BlueMarble 2004-07 Aligned',
+                format='png',
+            )
+            image_mbtiles(inputfile=self.inputfile, outputfile=outputfile.name,
+                          metadata=metadata,
+                          min_resolution=0, max_resolution=1,
+                          renderer=TouchRenderer(suffix='.png'))
+
+            # Only render the new zoom levels, keeping the metadata
+            image_mbtiles(inputfile=self.inputfile, outputfile=outputfile.name,
+                          metadata=dict(metadata, name='ignored'),
+                          min_resolution=2, max_resolution=3,
+                          renderer=TouchRenderer(suffix='.png'),
+                          append=True)
+            with MbtilesStorage(renderer=None,
+                                filename=outputfile.name) as storage:
+                self.assertEqual(
+                    set((z, x, y) for z, x, y, data in storage.mbtiles.all()),
+                    set([(0, 0, 0)] +
+                        [(1, x, y) for x in range(0, 2) for y in range(0, 2)] +
+                        [(2, x, y) for x in range(0, 4) for y in range(0, 4)] +
+                        [(3, x, y) for x in range(0, 8) for y in range(0, 8)])
+                )
+                self.assertEqual(storage.mbtiles.metadata['name'],
+                                 'bluemarble-aligned')
+                self.assertEqual(storage.mbtiles.metadata['x-minzoom'], '0')
+                self.assertEqual(storage.mbtiles.metadata['x-maxzoom'], '3')
+
+
+class TestOverzoom(unittest.TestCase):
+    def setUp(self):
+        self.inputfile = os.path.join(__dir__, 'bluemarble-aligned-ll.tif')
+        self.metadata = dict(
+            name='bluemarble-aligned',
+            type='baselayer',
+            version='1.0.0',
+            description='BlueMarble 2004-07 Aligned',
+            format='png',
+        )
+
+    def test_image_mbtiles(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as upsampled, \
+                NamedTemporaryFile(suffix='.mbtiles') as overzoomed:
+            image_mbtiles(inputfile=self.inputfile, outputfile=upsampled.name,
+                          metadata=self.metadata,
+                          min_resolution=0, max_resolution=3,
+                          renderer=PngRenderer())
+            image_mbtiles(inputfile=self.inputfile,
+                          outputfile=overzoomed.name,
+                          metadata=self.metadata,
+                          min_resolution=0, max_resolution=3,
+                          renderer=PngRenderer(), overzoom=True)
+
+            with MBTiles(filename=upsampled.name) as expected, \
+                    MBTiles(filename=overzoomed.name) as mbtiles:
+                # Resolution 2 is native, so resolution 3 isn't stored
+                self.assertEqual(mbtiles.zoom_levels(), [0, 1, 2])
+                self.assertEqual(mbtiles.nativezoom, 2)
+                self.assertEqual(mbtiles.metadata['x-maxzoom'], '3')
+
+                for z, x, y, data in expected.all():
+                    self.assertEqual(
+                        VImageAdapter.from_buffer(
+                            mbtiles.get(x=x, y=y, z=z)
+                        ).write_to_memory(),
+                        VImageAdapter.from_buffer(data).write_to_memory()
+                    )
+
+    def test_get(self):
+        blue = VImageAdapter.new_rgba(width=256, height=256)
+        blue = (blue + [0, 0, 255, 255]).cast('uchar')
+        red = VImageAdapter.new_rgba(width=128, height=128)
+        red = (red + [255, 0, 0, 255]).cast('uchar')
+        # Red upper left quarter
+        tile = blue.insert(red, 0, 0)
+
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=self.metadata) as mbtiles:
+                mbtiles.insert(x=1, y=0, z=1, hashed=1,
+                               data=tile.write_to_buffer('.png'))
+                self.assertEqual(mbtiles.nativezoom, None)
+                self.assertEqual(mbtiles.get(x=2, y=1, z=2), None)
+
+                mbtiles.metadata['x-nativezoom'] = 1
+                self.assertEqual(mbtiles.nativezoom, 1)
+                self.assertEqual(mbtiles.get(x=0, y=0, z=2), None)
+
+                # Upper left of (1, 0, 1) is (2, 1, 2) in TMS
+                image = VImageAdapter.from_buffer(mbtiles.get(x=2, y=1, z=2))
+                self.assertEqual((image.width, image.height), (256, 256))
+                self.assertEqual(image(0, 0), [255, 0, 0, 255])
+                self.assertEqual(image(255, 255), [255, 0, 0, 255])
+                image = VImageAdapter.from_buffer(mbtiles.get(x=3, y=0, z=2))
+                self.assertEqual(image(0, 0), [0, 0, 255, 255])
+
+                # Three levels up, each pixel is 8 × 8
+                image = VImageAdapter.from_buffer(mbtiles.get(x=8, y=7, z=4))
+                self.assertEqual(image(0, 0), [255, 0, 0, 255])
+
+    def test_get_jpeg(self):
+        tile = (VImageAdapter.new_rgba(width=256, height=256)
+                .extract_band(0, n=3) + [200, 100, 50]).cast('uchar')
+
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=dict(self.metadata,
+                                              format='jpg')) as mbtiles:
+                mbtiles.insert(x=0, y=0, z=0, hashed=1,
+                               data=tile.write_to_buffer('.jpg', Q=95))
+                mbtiles.metadata['x-nativezoom'] = 0
+
+                # The quality of the ancestor is kept
+                data = mbtiles.get(x=1, y=0, z=1)
+                self.assertEqual(tile_format(data), 'jpg')
+                self.assertEqual(jpeg_quality(data), 95)
+                self.assertTrue(mbtiles.exists(x=1, y=0, z=1))
+
+    def test_get_values(self):
+        tile = Image.black(256, 256, bands=2).cast('float') + [-12.5, 255]
+
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=dict(self.metadata,
+                                              format='tiff')) as mbtiles:
+                mbtiles.insert(x=0, y=0, z=0, hashed=1,
+                               data=DataRenderer().render(tile))
+                mbtiles.metadata['x-nativezoom'] = 0
+
+                # Raw values are kept
+                data = mbtiles.get(x=1, y=1, z=1)
+                self.assertEqual(tile_format(data), 'tiff')
+                image = Image.new_from_buffer(data, '')
+                self.assertEqual(image.format, 'float')
+                self.assertEqual(image(0, 0), [-12.5, 255])
+
+
+class TestOverviewMbtiles(unittest.TestCase):
+    def setUp(self):
+        self.metadata = dict(
+            name='overviews',
+            type='baselayer',
+            version='1.0.0',
+            description='Red tiles',
+            format='png',
+        )
+        image = VImageAdapter.new_rgba(width=256, height=256)
+        image = (image + [255, 0, 0, 255]).cast('uchar')
+        self.red = image.write_to_buffer('.png')
+        self.red_hashed = intmd5(image.write_to_memory())
+
+    def test_simple(self, compact=False, order=None):
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            zoom2 = ([(x, y) for x in range(0, 2) for y in range(0, 4)] +
+                     [(3, 3)])
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=self.metadata,
+                                compact=compact, order=order) as mbtiles:
+                for x, y in zoom2:
+                    mbtiles.insert(x=x, y=y, z=2, hashed=self.red_hashed,
+                                   data=self.red)
+                mbtiles.metadata['x-minzoom'] = 2
+                mbtiles.metadata['x-maxzoom'] = 2
+
+            overview_mbtiles(filename=outputfile.name, kernel='nearest',
+                             processes=2)
+
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                self.assertEqual(
+                    set((z, x, y) for z, x, y, data in mbtiles.all()),
+                    set([(0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 1)] +
+                        [(2, x, y) for x, y in zoom2])
+                )
+                self.assertEqual(mbtiles.metadata['x-minzoom'], '0')
+                self.assertEqual(mbtiles.metadata['x-maxzoom'], '2')
+
+                # Solid red tiles reduce to the same image
+                self.assertEqual(mbtiles.get(x=0, y=0, z=1), self.red)
+
+                # Only the upper right tile at zoom level 2 covers (1, 1)
+                image = VImageAdapter.from_buffer(mbtiles.get(x=1, y=1, z=1))
+                self.assertEqual(image(192, 64), [255, 0, 0, 255])
+                self.assertEqual(image(64, 64)[3], 0)
+                self.assertEqual(image(192, 192)[3], 0)
+
+    def test_simple_hilbert(self):
+        self.test_simple(compact=True, order='hilbert')
+
+    def test_values(self):
+        metadata = dict(self.metadata, format='tiff')
+        values = numpy.full((256, 256, 2), 1234.5, dtype=numpy.float32)
+        values[:, :, 1] = 1.0
+        image = VImageAdapter.from_numpy_array(values, width=256, height=256,
+                                               bands=2, format='float')
+        data = DataRenderer().render(image)
+
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=metadata) as mbtiles:
+                mbtiles.insert(x=1, y=1, z=1, hashed=1, data=data)
+
+            # Raw values can't be interpolated
+            self.assertRaises(ValueError, overview_mbtiles,
+                              filename=outputfile.name, kernel='linear')
+            self.assertRaises(ValueError, overview_mbtiles,
+                              filename=outputfile.name,
+                              renderer=PngRenderer())
+
+            overview_mbtiles(filename=outputfile.name, processes=1)
+
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                contents = mbtiles.get(x=0, y=0, z=0)
+                self.assertEqual(tile_format(contents), 'tiff')
+                self.assertEqual(mbtiles.metadata['format'], 'tiff')
+                reduced = Image.new_from_buffer(contents, '')
+                self.assertEqual(reduced.format, 'float')
+                # The upper right quarter keeps the values, the rest is
+                # masked out
+                self.assertEqual(reduced(192, 64), [1234.5, 1.0])
+                self.assertEqual(reduced(64, 192), [0.0, 0.0])
+
+            # Only a DataRenderer can transcode raw values, and they can't
+            # be tuned
+            self.assertRaises(ValueError, transcode_mbtiles,
+                              filename=outputfile.name,
+                              renderer=PngRenderer())
+            self.assertRaises(ValueError, tune_mbtiles,
+                              filename=outputfile.name,
+                              renderers=[PngRenderer()])
+            transcode_mbtiles(filename=outputfile.name,
+                              renderer=DataRenderer(compression='lzw'),
+                              processes=1)
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                reduced = Image.new_from_buffer(mbtiles.get(x=0, y=0, z=0),
+                                                '')
+                self.assertEqual(reduced(192, 64), [1234.5, 1.0])
+
+    def test_min_zoom(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=self.metadata) as mbtiles:
+                for x in range(0, 4):
+                    for y in range(0, 4):
+                        mbtiles.insert(x=x, y=y, z=2,
+                                       hashed=self.red_hashed, data=self.red)
+
+            overview_mbtiles(filename=outputfile.name, min_zoom=1)
+
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                self.assertEqual(mbtiles.zoom_levels(), [1, 2])
+
+
+class TestTranscodeMbtiles(unittest.TestCase):
+    def test_jpeg(self):
+        metadata = dict(
+            name='transcode',
+            type='baselayer',
+            version='1.0.0',
+            description='Red and blue tiles',
+            format='png',
+        )
+        image = VImageAdapter.new_rgba(width=256, height=256)
+        red = (image + [255, 0, 0, 255]).cast('uchar').write_to_buffer('.png')
+        blue = (image + [0, 0, 255, 255]).cast('uchar').write_to_buffer('.png')
+
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=metadata) as mbtiles:
+                for x in range(0, 4):
+                    for y in range(0, 4):
+                        data = red if x < 2 else blue
+                        mbtiles.insert(x=x, y=y, z=2, hashed=hash(data),
+                                       data=data)
+
+            transcode_mbtiles(filename=outputfile.name,
+                              renderer=JpegRenderer(), processes=2)
+
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                self.assertEqual(mbtiles.metadata['format'], 'jpg')
+                self.assertEqual(len(list(mbtiles.images())), 2)
+                tiles = list(mbtiles.all())
+                self.assertEqual(len(tiles), 16)
+                for z, x, y, data in tiles:
+                    image = VImageAdapter.from_buffer(data)
+                    self.assertEqual(bytes(data[:2]), b'\xff\xd8')
+                    if x < 2:
+                        self.assertTrue(image(128, 128)[0] > 250)
+                    else:
+                        self.assertTrue(image(128, 128)[2] > 250)
+
+    def test_hybrid(self):
+        metadata = dict(
+            name='transcode',
+            type='overlay',
+            version='1.0.0',
+            description='Opaque and translucent tiles',
+            format='png',
+        )
+        image = VImageAdapter.new_rgba(width=256, height=256)
+        opaque = (image + [255, 0, 0, 255]).cast('uchar')
+        opaque = opaque.write_to_buffer('.png')
+        translucent = (image + [0, 0, 255, 128]).cast('uchar')
+        translucent = translucent.write_to_buffer('.png')
+
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=metadata) as mbtiles:
+                mbtiles.insert(x=0, y=0, z=0, hashed=hash(opaque),
+                               data=opaque)
+                mbtiles.insert(x=0, y=0, z=1, hashed=hash(translucent),
+                               data=translucent)
+
+            transcode_mbtiles(filename=outputfile.name,
+                              renderer=HybridRenderer(), processes=2)
+
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                self.assertEqual(mbtiles.metadata['format'], 'png')
+                self.assertEqual(mbtiles.metadata['x-formats'], 'jpg,png')
+                self.assertEqual(tile_format(mbtiles.get(x=0, y=0, z=0)),
+                                 'jpg')
+                self.assertEqual(tile_format(mbtiles.get(x=0, y=0, z=1)),
+                                 'png')
+
+            # Back to a single format
+            transcode_mbtiles(filename=outputfile.name,
+                              renderer=PngRenderer(), processes=2)
+            with MBTiles(filename=outputfile.name) as mbtiles:
+                self.assertFalse('x-formats' in mbtiles.metadata)
+                self.assertEqual(tile_format(mbtiles.get(x=0, y=0, z=0)),
+                                 'png')
+
+
+class TestTuneMbtiles(unittest.TestCase):
+    def test_simple(self):
+        metadata = dict(
+            name='tune',
+            type='baselayer',
+            version='1.0.0',
+            description='Striped and solid tiles',
+            format='png',
+        )
+        image = VImageAdapter.new_rgba(width=256, height=256)
+        solid = (image + [255, 0, 0, 255]).cast('uchar')
+        striped = solid.insert((image + [0, 0, 255, 255]).cast('uchar')
+                               .crop(0, 0, 128, 256), 128, 0)
+
+        with NamedTemporaryFile(suffix='.mbtiles') as outputfile:
+            with MBTiles.create(filename=outputfile.name,
+                                metadata=metadata) as mbtiles:
+                for z, tile in enumerate([solid, striped]):
+                    data = tile.write_to_buffer('.png')
+                    mbtiles.insert(x=0, y=0, z=z, hashed=hash(data),
+                                   data=data)
+
+            missing = PngRenderer(png8=64)
+            missing.PNGQUANT = '/nonexistent/pngquant'
+            renderers = [PngRenderer(compression=1),
+                         PngRenderer(compression=9),
+                         JpegRenderer(),
+                         missing]
+            results = tune_mbtiles(filename=outputfile.name,
+                                   renderers=renderers, count=10)
+
+        self.assertEqual([r for r, _, _ in results], renderers)
+        for renderer, size, seconds in results[:3]:
+            self.assertTrue(size > 0)
+            self.assertTrue(seconds >= 0)
+        self.assertTrue(results[1][1] <= results[0][1])
+        self.assertEqual(results[3][1:], (None, None))
+
+    def test_recommend(self):
+        results = [('fast', 3000, 0.001),
+                   ('small', 1000, 0.010),
+                   ('middle', 2000, 0.005),
+                   ('missing', None, None)]
+        self.assertEqual(recommend_renderer(results), 'small')
+        self.assertEqual(recommend_renderer(results, max_size=2500),
+                         'middle')
+        self.assertEqual(recommend_renderer(results, max_seconds=0.006),
+                         'middle')
+        self.assertEqual(recommend_renderer(results, max_size=2500,
+                                            max_seconds=0.006),
+                         'middle')
+        self.assertEqual(recommend_renderer(results, max_size=500), None)
+
+
+class TestTuneRaster(unittest.TestCase):
+    def setUp(self):
+        self.inputfile = os.path.join(__dir__, 'bluemarble.tif')
+
+    def test_simple(self):
+        renderers = [PngRenderer(compression=1),
+                     PngRenderer(compression=9),
+                     JpegRenderer()]
+        results = tune_raster(inputfile=self.inputfile,
+                              renderers=renderers, count=4,
+                              min_resolution=1, max_resolution=3)
+        self.assertEqual([r for r, _, _ in results], renderers)
+        for renderer, size, seconds in results:
+            self.assertTrue(size > 0)
+            self.assertTrue(seconds >= 0)
+        self.assertTrue(results[1][1] <= results[0][1])
+
+    def test_colors(self):
+        renderers = [PngRenderer()]
+        results = tune_raster(
+            inputfile=os.path.join(__dir__, 'srtm.tif'),
+            renderers=renderers, count=4,
+            colors=ColorGradient({0: rgba(0, 0, 0, 255),
+                                  1000: rgba(255, 255, 255, 255)}),
+            band=1
+        )
+        self.assertEqual([r for r, _, _ in results], renderers)
+        self.assertTrue(results[0][1] > 0)
+
 
 class TestImagePyramid(unittest.TestCase):
     def setUp(self):
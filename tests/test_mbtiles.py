@@ -5,11 +5,17 @@ from __future__ import (absolute_import, division, print_function,
 
 import errno
 import os
+import sys
 from tempfile import NamedTemporaryFile
 import unittest
 
-from gdal2mbtiles.mbtiles import (InvalidFileError, MetadataKeyError,
-                                  MetadataValueError, Metadata, MBTiles)
+from gdal2mbtiles.mbtiles import (COVERAGE_RUN_SIZE, InvalidFileError,
+                                  MetadataKeyError, MetadataValueError,
+                                  Metadata, MBTiles, JPEG_LUMINANCE_TABLE,
+                                  jpeg_quality, pack_tile_key, tile_format,
+                                  tile_id, tile_range,
+                                  unpack_tile_key,
+                                  _pack_runs, _unpack_runs)
 
 
 class TestMBTiles(unittest.TestCase):
@@ -130,6 +136,392 @@ class TestMBTiles(unittest.TestCase):
         # Get tile again
         self.assertEqual(mbtiles.get(x=1, y=1, z=1), data)
 
+    def test_compact(self):
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version,
+                                 compact=True)
+        self.assertTrue(mbtiles.compact)
+        data = 'PNG image'
+        hashed = hash(data)
+
+        # Get missing tile
+        self.assertEqual(mbtiles.get(x=0, y=0, z=0), None)
+
+        # Insert and link tiles
+        mbtiles.insert(x=1, y=0, z=1, hashed=hashed, data=data)
+        mbtiles.insert(x=0, y=1, z=1, hashed=hashed)
+        mbtiles.insert(x=0, y=0, z=0, hashed=hashed)
+        self.assertEqual(mbtiles.get(x=1, y=0, z=1), data)
+        self.assertEqual(mbtiles.get(x=0, y=1, z=1), data)
+
+        # Ordered like the standard schema
+        self.assertEqual(list(mbtiles.all()),
+                         [(0, 0, 0, data), (1, 0, 1, data), (1, 1, 0, data)])
+
+        # The tiles view unpacks coordinates
+        cursor = mbtiles._conn.execute(
+            """
+            SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
+            ORDER BY zoom_level, tile_column, tile_row
+            """
+        )
+        self.assertEqual(cursor.fetchall(), list(mbtiles.all()))
+
+        # Standard files are not compact
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version)
+        self.assertFalse(mbtiles.compact)
+        self.assertEqual(mbtiles.key_order, None)
+
+    def test_compact_hilbert(self):
+        mbtiles = MBTiles.create(filename=self.filename,
+                                 metadata=self.metadata,
+                                 version=self.version,
+                                 compact=True, order='hilbert')
+        self.assertTrue(mbtiles.compact)
+        self.assertEqual(mbtiles.key_order, 'hilbert')
+        data = 'PNG image'
+        hashed = hash(data)
+
+        coordinates = [(x, y, z) for z in range(4)
+                       for x in range(2 ** z) for y in range(2 ** z)]
+        for x, y, z in coordinates:
+            mbtiles.insert(x=x, y=y, z=z, hashed=hashed, data=data)
+        self.assertEqual(mbtiles.get(x=5, y=2, z=3), data)
+        self.assertTrue(mbtiles.exists(x=5, y=2, z=3))
+        self.assertEqual(
+            sorted(list(mbtiles.all())),
+            sorted((z, x, y, data) for x, y, z in coordinates)
+        )
+
+        # Rows are stored along the Hilbert curve, whatever the insert order
+        cursor = mbtiles._conn.execute(
+            'SELECT hilbert_key FROM map WHERE hilbert_key >> 56 = 3 '
+            'ORDER BY rowid'
+        )
+        self.assertEqual(
+            [unpack_tile_key(row[0], order='hilbert')[:2]
+             for row in cursor.fetchall()][:4],
+            [(0, 0), (0, 1), (1, 1), (1, 0)]
+        )
+
+        # The tiles view unpacks coordinates
+        cursor = mbtiles._conn.execute(
+            """
+            SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
+            ORDER BY zoom_level, tile_column, tile_row
+            """
+        )
+        self.assertEqual(cursor.fetchall(), sorted(list(mbtiles.all())))
+
+        # The key order survives reopening
+        mbtiles.open()
+        self.assertEqual(mbtiles.key_order, 'hilbert')
+        self.assertEqual(mbtiles.get(x=5, y=2, z=3), data)
+
+        self.assertRaises(ValueError, MBTiles.create, filename=':memory:',
+                          metadata=self.metadata, version=self.version,
+                          compact=True, order='spiral')
+
+    def test_invalid_coordinates(self, compact=False, order=None):
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version,
+                                 compact=compact, order=order)
+        mbtiles.insert(x=0, y=0, z=0, hashed=0, data='PNG image')
+
+        # No tiles, rather than errors
+        for x, y, z in [(-1, 0, 1), (0, -1, 1), (0, 0, 300)]:
+            self.assertEqual(mbtiles.get(x=x, y=y, z=z), None)
+            self.assertFalse(mbtiles.exists(x=x, y=y, z=z))
+        self.assertEqual(mbtiles.get(x=0, y=0, z=0), 'PNG image')
+
+    def test_invalid_coordinates_compact(self):
+        self.test_invalid_coordinates(compact=True)
+
+    def test_invalid_coordinates_hilbert(self):
+        self.test_invalid_coordinates(compact=True, order='hilbert')
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version,
+                                 compact=True, order='hilbert')
+        mbtiles.insert(x=1, y=1, z=1, hashed=0, data='PNG image')
+        # Beyond the Hilbert curve of zoom level 1
+        self.assertEqual(mbtiles.get(x=5, y=5, z=1), None)
+        self.assertFalse(mbtiles.exists(x=5, y=5, z=1))
+        self.assertTrue(mbtiles.exists(x=1, y=1, z=1))
+
+    def test_tile_key(self):
+        self.assertEqual(pack_tile_key(x=0, y=0, z=0), 0)
+        for x, y, z in [(0, 0, 1), (3, 5, 3), (2 ** 28 - 1, 0, 28),
+                        (0, 2 ** 28 - 1, 28)]:
+            self.assertEqual(unpack_tile_key(pack_tile_key(x=x, y=y, z=z)),
+                             (x, y, z))
+
+        # Keys sort like (z, x, y)
+        coordinates = [(1, 0, 2), (0, 3, 2), (0, 0, 1), (1, 1, 1)]
+        self.assertEqual(
+            sorted(coordinates, key=lambda c: (c[2], c[0], c[1])),
+            sorted(coordinates, key=lambda c: pack_tile_key(*c))
+        )
+
+        self.assertRaises(ValueError, pack_tile_key, x=0, y=0, z=29)
+        self.assertRaises(ValueError, pack_tile_key, x=2 ** 28, y=0, z=28)
+        self.assertRaises(ValueError, pack_tile_key, x=0, y=-1, z=1)
+
+    def test_tile_key_hilbert(self):
+        for x, y, z in [(0, 0, 0), (1, 0, 1), (3, 5, 3),
+                        (2 ** 28 - 1, 0, 28), (12345, 2 ** 28 - 1, 28)]:
+            key = pack_tile_key(x=x, y=y, z=z, order='hilbert')
+            self.assertEqual(key >> 56, z)
+            self.assertEqual(unpack_tile_key(key, order='hilbert'),
+                             (x, y, z))
+
+        # Keys follow the curve within each zoom level
+        self.assertEqual(
+            sorted([(x, y) for x in range(2) for y in range(2)],
+                   key=lambda c: pack_tile_key(*c, z=1, order='hilbert')),
+            [(0, 0), (0, 1), (1, 1), (1, 0)]
+        )
+
+        # The curve only covers the tiles of each zoom level
+        self.assertRaises(ValueError, pack_tile_key, x=2, y=0, z=1,
+                          order='hilbert')
+        self.assertRaises(ValueError, pack_tile_key, x=0, y=0, z=0,
+                          order='spiral')
+
+    def test_coverage(self, compact=False, order=None):
+        mbtiles = MBTiles.create(filename=self.filename,
+                                 metadata=self.metadata,
+                                 version=self.version,
+                                 compact=compact, order=order)
+        MISSING, TILE, EMPTY = (mbtiles.COVERAGE.MISSING,
+                                mbtiles.COVERAGE.TILE,
+                                mbtiles.COVERAGE.EMPTY)
+        data = 'PNG image'
+        hashed = hash(data)
+        empty = hash('Empty image')
+
+        mbtiles.insert(x=0, y=0, z=0, hashed=hashed, data=data)
+        mbtiles.insert(x=1, y=1, z=2, hashed=hashed)
+        mbtiles.insert(x=1, y=3, z=2, hashed=empty, data='')
+        mbtiles.insert(x=3, y=2, z=2, hashed=hashed)
+
+        # Without bitmaps, fall back to the map table
+        self.assertFalse(mbtiles.has_coverage)
+        self.assertEqual(mbtiles.coverage(x=0, y=0, z=0), None)
+        self.assertTrue(mbtiles.exists(x=1, y=3, z=2))
+        self.assertFalse(mbtiles.exists(x=2, y=2, z=2))
+        self.assertFalse(mbtiles.is_empty(x=1, y=3, z=2))
+
+        mbtiles.write_coverage(empty=empty)
+        self.assertTrue(mbtiles.has_coverage)
+        self.assertEqual(mbtiles.coverage(x=0, y=0, z=0), TILE)
+        self.assertEqual(mbtiles.coverage(x=1, y=0, z=0), MISSING)
+        self.assertEqual(
+            [[mbtiles.coverage(x=x, y=y, z=2) for x in range(5)]
+             for y in range(5)],
+            [[MISSING, MISSING, MISSING, MISSING, MISSING],
+             [MISSING, TILE, MISSING, MISSING, MISSING],
+             [MISSING, MISSING, MISSING, TILE, MISSING],
+             [MISSING, EMPTY, MISSING, MISSING, MISSING],
+             [MISSING, MISSING, MISSING, MISSING, MISSING]]
+        )
+        self.assertTrue(mbtiles.exists(x=1, y=3, z=2))
+        self.assertTrue(mbtiles.is_empty(x=1, y=3, z=2))
+        self.assertFalse(mbtiles.is_empty(x=1, y=1, z=2))
+        self.assertFalse(mbtiles.exists(x=2, y=2, z=2))
+        self.assertEqual(mbtiles.coverage(x=0, y=0, z=1), None)
+
+        # Bitmaps survive reopening
+        mbtiles.open()
+        self.assertTrue(mbtiles.is_empty(x=1, y=3, z=2))
+
+        # Inserting a tile drops the stale bitmap for its zoom level
+        mbtiles.insert(x=2, y=2, z=2, hashed=hashed)
+        self.assertEqual(mbtiles.coverage(x=2, y=2, z=2), None)
+        self.assertTrue(mbtiles.exists(x=2, y=2, z=2))
+        self.assertEqual(mbtiles.coverage(x=0, y=0, z=0), TILE)
+        mbtiles.insert(x=2, y=1, z=2, hashed=hashed)
+        self.assertTrue(mbtiles.exists(x=2, y=1, z=2))
+
+        # Rewriting the bitmaps makes them stale again on the next insert
+        mbtiles.write_coverage(empty=empty)
+        self.assertEqual(mbtiles.coverage(x=2, y=1, z=2), TILE)
+        mbtiles.insert(x=0, y=1, z=2, hashed=hashed)
+        self.assertEqual(mbtiles.coverage(x=0, y=1, z=2), None)
+        mbtiles.open()
+        self.assertEqual(mbtiles.coverage(x=0, y=1, z=2), None)
+        self.assertTrue(mbtiles.exists(x=0, y=1, z=2))
+
+    def test_coverage_compact(self):
+        self.test_coverage(compact=True)
+
+    def test_coverage_hilbert(self):
+        self.test_coverage(compact=True, order='hilbert')
+
+    def test_coverage_overzoom(self):
+        mbtiles = MBTiles.create(filename=self.filename,
+                                 metadata=self.metadata,
+                                 version=self.version)
+        hashed = hash('PNG image')
+        empty = hash('Empty image')
+        mbtiles.insert(x=0, y=0, z=0, hashed=hashed, data='PNG image')
+        mbtiles.insert(x=0, y=1, z=1, hashed=hashed)
+        mbtiles.insert(x=1, y=0, z=1, hashed=empty, data='')
+        self.assertFalse(mbtiles.exists(x=1, y=6, z=3))
+
+        # Overzoomed tiles exist where their ancestor does
+        mbtiles.metadata['x-nativezoom'] = 1
+        self.assertTrue(mbtiles.exists(x=1, y=6, z=3))
+        self.assertTrue(mbtiles.exists(x=2, y=1, z=2))
+        self.assertFalse(mbtiles.exists(x=3, y=3, z=2))
+        self.assertEqual(mbtiles.coverage(x=1, y=6, z=3), None)
+
+        mbtiles.write_coverage(empty=empty)
+        self.assertEqual(mbtiles.coverage(x=1, y=6, z=3),
+                         mbtiles.COVERAGE.TILE)
+        self.assertEqual(mbtiles.coverage(x=3, y=3, z=2),
+                         mbtiles.COVERAGE.MISSING)
+        self.assertTrue(mbtiles.is_empty(x=7, y=0, z=3))
+        self.assertFalse(mbtiles.exists(x=3, y=3, z=2))
+
+    def test_coverage_runs(self):
+        runs = [(0, 3), (1, 1), (2, 2 ** 32 + 1), (0, 2)]
+        data = _pack_runs(runs)
+        # The long run is split in two
+        self.assertEqual(len(data), 5 * COVERAGE_RUN_SIZE)
+        self.assertEqual(_unpack_runs(data),
+                         ([3, 4, 2 ** 32 + 5, 2 ** 32 + 7], [0, 1, 2, 0]))
+
+    @unittest.skipUnless(sys.version_info >= (3, 7),
+                         'SQLite online backup requires Python 3.7')
+    def test_backup(self):
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version)
+        data = 'PNG image'
+        mbtiles.insert(x=0, y=0, z=0, hashed=hash(data), data=data)
+        self.assertTrue(mbtiles.size > 0)
+
+        mbtiles.backup(filename=self.filename)
+        with MBTiles(filename=self.filename) as copy:
+            self.assertEqual(list(copy.all()), [(0, 0, 0, data)])
+            self.assertEqual(copy.metadata, self.metadata)
+            self.assertEqual(copy.size, mbtiles.size)
+
+        # Replaces what was there
+        mbtiles.insert(x=1, y=1, z=1, hashed=hash(data))
+        mbtiles.backup(filename=self.filename)
+        with MBTiles(filename=self.filename) as copy:
+            self.assertEqual(list(copy.all()),
+                             [(0, 0, 0, data), (1, 1, 1, data)])
+
+    def test_tile_ids(self):
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version)
+        self.assertEqual(list(mbtiles.tile_ids()), [])
+
+        # tile_ids are signed 64-bit integers
+        mbtiles.insert(x=0, y=0, z=0, hashed=2 ** 64 - 1, data='PNG image')
+        mbtiles.insert(x=0, y=0, z=1, hashed=2 ** 64 - 1)
+        mbtiles.insert(x=0, y=1, z=1, hashed=2 ** 65 + 2, data='PNG image')
+        self.assertEqual(sorted(mbtiles.tile_ids()), [-1, 2])
+        self.assertEqual(tile_id(2 ** 64 - 1), -1)
+
+    def test_columns(self):
+        self._test_columns(compact=False)
+
+    def test_columns_compact(self):
+        self._test_columns(compact=True)
+
+    def test_columns_hilbert(self):
+        self._test_columns(compact=True, order='hilbert')
+
+    def _test_columns(self, compact, order=None):
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version,
+                                 compact=compact, order=order)
+        self.assertEqual(list(mbtiles.columns(z=2)), [])
+        self.assertEqual(list(mbtiles.column(x=0, z=2)), [])
+
+        mbtiles.insert(x=0, y=0, z=1, hashed=0, data='PNG image')
+        for x, y in [(3, 2), (1, 3), (1, 0), (3, 1), (1, 1)]:
+            mbtiles.insert(x=x, y=y, z=2, hashed=x * 4 + y,
+                           data='PNG {0} {1}'.format(x, y))
+        mbtiles.insert(x=2, y=0, z=3, hashed=0)
+
+        self.assertEqual(list(mbtiles.columns(z=2)), [1, 3])
+        self.assertEqual(list(mbtiles.column(x=1, z=2)),
+                         [(0, 'PNG 1 0'), (1, 'PNG 1 1'), (3, 'PNG 1 3')])
+        # Pages don't skip or repeat tiles
+        self.assertEqual(list(mbtiles.column(x=1, z=2, page_size=2)),
+                         list(mbtiles.column(x=1, z=2)))
+        self.assertEqual(list(mbtiles.column(x=2, z=2)), [])
+
+        # Columns of a larger zoom level
+        for y in range(0, 64, 3):
+            mbtiles.insert(x=37, y=y, z=6, hashed=y,
+                           data='PNG 37 {0}'.format(y))
+            mbtiles.insert(x=38, y=y, z=6, hashed=y)
+        self.assertEqual(list(mbtiles.columns(z=6)), [37, 38])
+        self.assertEqual(list(mbtiles.column(x=37, z=6)),
+                         [(y, 'PNG 37 {0}'.format(y))
+                          for y in range(0, 64, 3)])
+        self.assertEqual(list(mbtiles.column(x=38, z=6, page_size=4)),
+                         list(mbtiles.column(x=37, z=6)))
+
+    def test_images(self):
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version)
+        self.assertEqual(list(mbtiles.images()), [])
+
+        for hashed in [3, 1, 2]:
+            mbtiles.insert(x=hashed, y=0, z=2, hashed=hashed,
+                           data='PNG {0}'.format(hashed))
+        mbtiles.insert(x=0, y=0, z=2, hashed=1)
+
+        # Each image once, whichever tiles use it
+        self.assertEqual(list(mbtiles.images(page_size=2)),
+                         [(1, 'PNG 1'), (2, 'PNG 2'), (3, 'PNG 3')])
+
+        mbtiles.replace_images([(1, 'JPG 1'), (3, 'JPG 3')])
+        self.assertEqual(mbtiles.get(x=0, y=0, z=2), 'JPG 1')
+        self.assertEqual(mbtiles.get(x=1, y=0, z=2), 'JPG 1')
+        self.assertEqual(mbtiles.get(x=2, y=0, z=2), 'PNG 2')
+        self.assertEqual(mbtiles.get(x=3, y=0, z=2), 'JPG 3')
+
+    def test_sample(self, compact=False, order=None):
+        mbtiles = MBTiles.create(filename=':memory:',
+                                 metadata=self.metadata,
+                                 version=self.version,
+                                 compact=compact, order=order)
+        self.assertEqual(mbtiles.sample(count=10), [])
+
+        mbtiles.insert(x=0, y=0, z=0, hashed=0, data='PNG 0')
+        for hashed in range(1, 9):
+            mbtiles.insert(x=hashed - 1, y=0, z=3, hashed=hashed,
+                           data='PNG {0}'.format(hashed))
+        # Duplicates count once
+        mbtiles.insert(x=0, y=1, z=3, hashed=1)
+
+        # Zoom level 0 only has one image, so zoom level 3 gets the rest
+        self.assertEqual(sorted(mbtiles.sample(count=4)),
+                         ['PNG 0', 'PNG 1', 'PNG 2', 'PNG 3'])
+        self.assertEqual(len(mbtiles.sample(count=100)), 9)
+        self.assertEqual(mbtiles.sample(count=4), mbtiles.sample(count=4))
+
+    def test_sample_compact(self):
+        self.test_sample(compact=True)
+
+    def test_sample_hilbert(self):
+        self.test_sample(compact=True, order='hilbert')
+
     def test_autocommit(self):
         mbtiles = MBTiles.create(filename=self.filename,
                                  metadata=self.metadata,
@@ -145,6 +537,208 @@ class TestMBTiles(unittest.TestCase):
         mbtiles.open()
         self.assertEqual(mbtiles.get(x=0, y=0, z=0), data)
 
+    def test_jpeg_quality(self):
+        def jpeg(table, precision=0):
+            size = 2 if precision else 1
+            data = bytearray([precision << 4])
+            for value in table:
+                data.extend(bytearray([value >> 8, value & 0xff])[-size:])
+            header = bytearray([0xff, 0xd8, 0xff, 0xdb,
+                                (len(data) + 2) >> 8, (len(data) + 2) & 0xff])
+            return bytes(header + data + bytearray([0xff, 0xda, 0, 2]))
+
+        self.assertEqual(jpeg_quality(jpeg(JPEG_LUMINANCE_TABLE)), 50)
+        self.assertEqual(jpeg_quality(jpeg([1] * 64)), 100)
+        self.assertEqual(jpeg_quality(jpeg([255] * 64)), 1)
+        self.assertEqual(
+            jpeg_quality(jpeg([(v * 50 + 50) // 100
+                               for v in JPEG_LUMINANCE_TABLE],
+                              precision=1)),
+            75
+        )
+        self.assertEqual(jpeg_quality(b'\xff\xd8\xff\xda\x00\x02'), None)
+        self.assertEqual(jpeg_quality(b'\x89PNG\r\n\x1a\n'), None)
+
+    def test_tile_format(self):
+        self.assertEqual(tile_format(b'\x89PNG\r\n\x1a\n\x00'), 'png')
+        self.assertEqual(tile_format(b'\xff\xd8\xff\xe0\x00'), 'jpg')
+        self.assertEqual(tile_format(b'RIFF\x00\x00\x00\x00WEBPVP8 '),
+                         'webp')
+        self.assertEqual(tile_format(b'II*\x00\x08\x00'), 'tiff')
+        self.assertEqual(tile_format(b'MM\x00*\x00\x00'), 'tiff')
+        self.assertEqual(tile_format(memoryview(b'\xff\xd8\xff\xe0')), 'jpg')
+        self.assertEqual(tile_format(b'PNG image'), None)
+        self.assertEqual(tile_format(b''), None)
+
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.tempfiles = [NamedTemporaryFile(suffix='.mbtiles')
+                          for _ in range(3)]
+        self.old, self.new, self.patch = [f.name for f in self.tempfiles]
+        self.metadata = dict(
+            name='transparent',
+            type=Metadata.latest().TYPES.BASELAYER,
+            version='1.0.0',
+            description='Transparent World 2012',
+        )
+
+    def tearDown(self):
+        for f in self.tempfiles:
+            try:
+                f.close()
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def test_diff_apply(self, old_compact=False, new_compact=False,
+                        old_order=None, new_order=None):
+        with MBTiles.create(filename=self.old, metadata=self.metadata,
+                            version='1.0', compact=old_compact,
+                            order=old_order) as old:
+            old.insert(x=0, y=0, z=0, hashed=1, data='unchanged')
+            old.insert(x=0, y=0, z=1, hashed=2, data='changed')
+            old.insert(x=1, y=1, z=1, hashed=3, data='deleted')
+            old.metadata['test'] = 'deleted'
+
+        metadata = dict(self.metadata, description='Updated')
+        with MBTiles.create(filename=self.new, metadata=metadata,
+                            version='1.0', compact=new_compact,
+                            order=new_order) as new:
+            new.insert(x=0, y=0, z=0, hashed=1, data='unchanged')
+            new.insert(x=0, y=0, z=1, hashed=4, data='new image')
+            new.insert(x=1, y=0, z=1, hashed=1, data='unchanged')
+
+        with MBTiles(filename=self.old) as old:
+            with old.diff(other=self.new, filename=self.patch) as patch:
+                # Only changed tiles are in the map
+                cursor = patch._conn.execute(
+                    'SELECT zoom_level, tile_column, tile_row, tile_id '
+                    'FROM map ORDER BY zoom_level, tile_column, tile_row'
+                )
+                self.assertEqual(cursor.fetchall(),
+                                 [(1, 0, 0, 4), (1, 1, 0, 1)])
+
+                # Only missing images are shipped
+                cursor = patch._conn.execute('SELECT tile_id FROM images')
+                self.assertEqual(cursor.fetchall(), [(4,)])
+
+                cursor = patch._conn.execute('SELECT * FROM deletions')
+                self.assertEqual(cursor.fetchall(), [(1, 1, 1)])
+
+            old.apply(patch=self.patch)
+            self.assertEqual(sorted(old.all()),
+                             [(0, 0, 0, 'unchanged'),
+                              (1, 0, 0, 'new image'),
+                              (1, 1, 0, 'unchanged')])
+            self.assertEqual(old.metadata, metadata)
+
+            # Unreferenced images are removed
+            cursor = old._conn.execute('SELECT tile_id FROM images')
+            self.assertEqual(cursor.fetchall(), [(1,), (4,)])
+
+    def test_diff_apply_compact(self):
+        self.test_diff_apply(old_compact=True, new_compact=True)
+        self.test_diff_apply(old_compact=True, new_compact=False)
+        self.test_diff_apply(old_compact=False, new_compact=True)
+
+    def test_diff_apply_hilbert(self):
+        self.test_diff_apply(old_compact=True, new_compact=True,
+                             old_order='hilbert', new_order='hilbert')
+        self.test_diff_apply(old_compact=True, new_compact=True,
+                             old_order='hilbert', new_order='row')
+        self.test_diff_apply(old_compact=True, new_compact=True,
+                             old_order='row', new_order='hilbert')
+        self.test_diff_apply(old_compact=True, new_compact=False,
+                             old_order='hilbert')
+        self.test_diff_apply(old_compact=False, new_compact=True,
+                             new_order='hilbert')
+
+    def test_apply_invalid(self):
+        with MBTiles.create(filename=self.old, metadata=self.metadata,
+                            version='1.0') as old:
+            MBTiles.create(filename=self.new, metadata=self.metadata,
+                           version='1.0').close()
+            self.assertRaises(InvalidFileError, old.apply, patch=self.new)
+
+
+class TestExtract(unittest.TestCase):
+    def setUp(self):
+        self.source = NamedTemporaryFile(suffix='.mbtiles')
+        self.dest = NamedTemporaryFile(suffix='.mbtiles')
+        self.metadata = dict(
+            name='world',
+            type=Metadata.latest().TYPES.BASELAYER,
+            version='1.0.0',
+            description='World 2012',
+            format=Metadata.latest().FORMATS.PNG,
+            bounds='-180.0,-85.0,180.0,85.0',
+        )
+
+    def tearDown(self):
+        for f in (self.source, self.dest):
+            try:
+                f.close()
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def test_tile_range(self):
+        world = (-180, -90, 180, 90)
+        self.assertEqual(tile_range(bounds=world, z=0), (0, 0, 0, 0))
+        self.assertEqual(tile_range(bounds=world, z=2), (0, 0, 3, 3))
+
+        # Edges on tile boundaries don't include the next tile
+        self.assertEqual(tile_range(bounds=(0, 0, 90, 66.51326), z=2),
+                         (2, 2, 2, 2))
+        self.assertEqual(tile_range(bounds=(-180, -85, 0, 0), z=1),
+                         (0, 0, 0, 0))
+
+        # A single point
+        self.assertEqual(tile_range(bounds=(1, 1, 1, 1), z=3),
+                         (4, 4, 4, 4))
+
+        self.assertRaises(ValueError,
+                          tile_range, bounds=(10, 0, -10, 1), z=1)
+
+    def test_extract(self, compact=False, order=None):
+        mbtiles = MBTiles.create(filename=self.source.name,
+                                 metadata=self.metadata,
+                                 compact=compact, order=order)
+        for z in range(3):
+            for x in range(2 ** z):
+                for y in range(2 ** z):
+                    data = '{0}/{1}'.format(x % 2, y % 2)
+                    mbtiles.insert(x=x, y=y, z=z, hashed=hash(data),
+                                   data=data)
+        self.assertEqual(mbtiles.zoom_levels(), [0, 1, 2])
+
+        # North-east quarter of the world, from zoom level 1
+        with mbtiles.extract(bounds=(0, 0, 180, 85), zooms=range(1, 5),
+                             dest=self.dest.name) as extract:
+            self.assertEqual(extract.compact, compact)
+            self.assertEqual(extract.key_order, mbtiles.key_order)
+            self.assertEqual(extract.zoom_levels(), [1, 2])
+            self.assertEqual(
+                sorted((z, x, y) for z, x, y, data in extract.all()),
+                [(1, 1, 1),
+                 (2, 2, 2), (2, 2, 3), (2, 3, 2), (2, 3, 3)]
+            )
+            self.assertEqual(extract.get(x=3, y=2, z=2), '1/0')
+
+            # Each image only once
+            cursor = extract._conn.execute('SELECT COUNT(*) FROM images')
+            self.assertEqual(cursor.fetchone()[0], 4)
+
+            self.assertEqual(extract.metadata['bounds'], '0.0,0.0,180.0,85.0')
+            self.assertEqual(extract.metadata['name'], 'world')
+
+    def test_extract_compact(self):
+        self.test_extract(compact=True)
+
+    def test_extract_hilbert(self):
+        self.test_extract(compact=True, order='hilbert')
+
 
 class TestMetadata(unittest.TestCase):
     def setUp(self):
@@ -296,6 +890,8 @@ class TestMetadata(unittest.TestCase):
             self.assertEqual(metadata['format'], 'png')
             metadata['format'] = metadata.FORMATS.JPG
             self.assertEqual(metadata['format'], 'jpg')
+            metadata['format'] = metadata.FORMATS.WEBP
+            self.assertEqual(metadata['format'], 'webp')
             self.assertRaises(MetadataValueError,
                               metadata.__setitem__, 'format', 'invalid')
 
@@ -375,6 +971,8 @@ class TestMetadata(unittest.TestCase):
             self.assertEqual(metadata['format'], 'png')
             metadata['format'] = metadata.FORMATS.JPG
             self.assertEqual(metadata['format'], 'jpg')
+            metadata['format'] = metadata.FORMATS.WEBP
+            self.assertEqual(metadata['format'], 'webp')
             self.assertRaises(MetadataValueError,
                               metadata.__setitem__, 'format', 'invalid')
 
@@ -3,12 +3,17 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import os
 import unittest
 
-from gdal2mbtiles.renderers import JpegRenderer, PngRenderer, TouchRenderer
+import numpy
+
+from gdal2mbtiles.renderers import (DataRenderer, HybridRenderer,
+                                    JpegRenderer, PngRenderer, TouchRenderer,
+                                    WebpRenderer, paletted_png, png_palette)
 from gdal2mbtiles.gd_types import rgba
-from gdal2mbtiles.utils import intmd5
-from gdal2mbtiles.vips import VImageAdapter
+from gdal2mbtiles.utils import intmd5, NamedTemporaryDir
+from gdal2mbtiles.vips import Image, VImageAdapter
 
 
 class TestJpegRenderer(unittest.TestCase):
@@ -38,6 +43,12 @@ class TestJpegRenderer(unittest.TestCase):
         renderer = JpegRenderer(suffix='.JPEG')
         self.assertEqual(renderer.suffix, '.JPEG')
 
+    def test_tempdir(self):
+        # Rendering is done in memory
+        renderer = JpegRenderer(tempdir='/nonexistent')
+        image = VImageAdapter.new_rgba(width=1, height=1)
+        self.assertEqual(renderer.render(image=image)[:2], b'\xff\xd8')
+
 
 class TestPngRenderer(unittest.TestCase):
     def setUp(self):
@@ -45,6 +56,11 @@ class TestPngRenderer(unittest.TestCase):
         self.image = VImageAdapter.new_rgba(width=1, height=1,
                                      ink=rgba(r=0, g=0, b=0, a=0))
 
+    def assertPaletted(self, contents):
+        # The IHDR chunk is first: its color type 3 means paletted
+        self.assertEqual(contents[12:16], b'IHDR')
+        self.assertEqual(bytearray(contents[25:26]), bytearray([3]))
+
     def test_simple(self):
         renderer = PngRenderer(png8=False, optimize=False)
         contents = renderer.render(image=self.image)
@@ -66,8 +82,23 @@ class TestPngRenderer(unittest.TestCase):
     def test_png8(self):
         renderer = PngRenderer(png8=True, optimize=False)
         contents = renderer.render(image=self.image)
-        self.assertEqual(intmd5(contents),
-                         106831624867432276165545554861383631224)
+        self.assertPaletted(contents)
+
+        # VIPS quantizes to 16 colors, pngquant to 100 colors
+        for png8 in (16, 100):
+            renderer = PngRenderer(png8=png8, effort=1, optimize=False)
+            contents = renderer.render(image=self.image)
+            self.assertPaletted(contents)
+
+        self.assertRaises(ValueError, PngRenderer, png8=True, effort=0)
+        self.assertRaises(ValueError, PngRenderer, png8=True, effort=11)
+
+    def test_vips_palette(self):
+        supported = PngRenderer.vips_palette()
+        self.assertIn(supported, (True, False))
+        self.assertEqual(PngRenderer._vips_palette, supported)
+        self.assertEqual(PngRenderer(png8=256)._pngquant, not supported)
+        self.assertTrue(PngRenderer(png8=100)._pngquant)
 
     def test_optimize(self):
         renderer = PngRenderer(png8=False, optimize=2)
@@ -84,8 +115,129 @@ class TestPngRenderer(unittest.TestCase):
     def test_png8_optimize(self):
         renderer = PngRenderer(png8=True, optimize=2)
         contents = renderer.render(image=self.image)
-        self.assertEqual(intmd5(contents),
-                         106831624867432276165545554861383631224)
+        self.assertPaletted(contents)
+
+    def test_render_solid(self):
+        renderer = PngRenderer(png8=True, optimize=2)
+        for color in ([10, 20, 30, 200], [0, 0, 0, 0], [10, 20, 30, 255]):
+            image = (VImageAdapter.new_rgba(width=256, height=256) +
+                     color).cast('uchar')
+            contents = renderer.render_solid(image,
+                                             image.write_to_memory()[:4])
+            self.assertPaletted(contents)
+            self.assertTrue(len(contents) < 200)
+            decoded = VImageAdapter.from_buffer(contents)
+            self.assertEqual((decoded.width, decoded.height), (256, 256))
+            self.assertEqual(decoded(128, 128)[:3], color[:3])
+            if color[3] != 255:
+                self.assertEqual(decoded(128, 128)[3], color[3])
+
+        # Greyscale
+        image = (VImageAdapter.new_rgba(width=3, height=3)
+                 .extract_band(0) + 77).cast('uchar')
+        decoded = VImageAdapter.from_buffer(renderer.render_solid(image,
+                                                                  b'M'))
+        self.assertEqual(decoded(2, 2)[:3], [77, 77, 77])
+
+    def test_palette(self):
+        palette = [rgba(0, 0, 0, 0), rgba(255, 0, 0, 255),
+                   rgba(0, 0, 255, 128)]
+        renderer = PngRenderer(palette=palette, png8=True)
+        image = VImageAdapter.from_numpy_array(
+            array=numpy.array([0, 1, 2, 1, 0, 2]), width=3, height=2,
+            bands=1, format='uchar'
+        )
+        contents = renderer.render(image=image)
+        self.assertPaletted(contents)
+        decoded = VImageAdapter.from_buffer(contents)
+        self.assertEqual(
+            [decoded(x, y) for y in range(2) for x in range(3)],
+            [list(palette[i]) for i in [0, 1, 2, 1, 0, 2]]
+        )
+
+        # Solid tiles take their color from the palette
+        contents = renderer.render_solid(image, b'\x02')
+        self.assertEqual(VImageAdapter.from_buffer(contents)(1, 1),
+                         list(palette[2]))
+
+        self.assertRaises(ValueError, PngRenderer, palette=[])
+
+    def test_shared_palette(self):
+        red = (VImageAdapter.new_rgba(width=8, height=8) +
+               [250, 0, 0, 255]).cast('uchar')
+        image = red.insert((VImageAdapter.new_rgba(width=8, height=8) +
+                            [0, 0, 250, 255]).cast('uchar'), 4, 0)
+        image = image.insert(VImageAdapter.new_rgba(width=8, height=4), 0, 4)
+
+        renderer = PngRenderer(png8=4)
+        palette = renderer.quantize(image)
+        self.assertTrue(1 <= len(palette) <= 4)
+
+        renderer.shared_palette = palette
+        contents = renderer.render(image=image)
+        self.assertPaletted(contents)
+        decoded = VImageAdapter.from_buffer(contents)
+        self.assertEqual(decoded(0, 0)[:3], [250, 0, 0])
+        self.assertEqual(decoded(7, 0)[:3], [0, 0, 250])
+        self.assertEqual(decoded(7, 7)[3], 0)
+
+        # Nearby colors map to the same palette entry
+        self.assertEqual(renderer.remap(red), renderer.remap(
+            (VImageAdapter.new_rgba(width=8, height=8) +
+             [245, 3, 3, 255]).cast('uchar')
+        ))
+
+        # Solid tiles match the remapped tiles
+        contents = renderer.render_solid(red, b'\xf5\x03\x03\xff')
+        self.assertEqual(VImageAdapter.from_buffer(contents)(0, 0)[:3],
+                         [250, 0, 0])
+
+        self.assertRaises(ValueError, PngRenderer().quantize, image)
+
+    def test_shared_palette_grey(self):
+        # Greyscale tiles are remapped too, not read as palette indexes
+        grey = VImageAdapter.from_numpy_array(
+            array=numpy.array([0, 5, 8, 84, 200, 255] * 6), width=6,
+            height=6, bands=1, format='uchar'
+        )
+        palette = [rgba(8, 8, 8, 255), rgba(84, 84, 84, 255),
+                   rgba(200, 200, 200, 255)]
+        renderer = PngRenderer(png8=4, shared_palette=palette)
+        contents = renderer.render(image=grey)
+        self.assertPaletted(contents)
+        decoded = VImageAdapter.from_buffer(contents)
+        self.assertEqual([decoded(x, 0)[:3] for x in range(6)],
+                         [[8, 8, 8], [8, 8, 8], [8, 8, 8], [84, 84, 84],
+                          [200, 200, 200], [200, 200, 200]])
+
+        contents = renderer.render_solid(grey, b'\x05')
+        self.assertEqual(VImageAdapter.from_buffer(contents)(0, 0)[:3],
+                         [8, 8, 8])
+
+    def test_png_palette(self):
+        palette = [rgba(1, 2, 3, 4), rgba(5, 6, 7, 255)]
+        contents = paletted_png(data=b'\x00\x01', width=2, height=1,
+                                palette=palette)
+        self.assertEqual(png_palette(contents), palette)
+        self.assertRaises(ValueError, png_palette,
+                          VImageAdapter.new_rgba(width=1, height=1)
+                          .write_to_buffer('.png'))
+
+    def test_paletted_png(self):
+        for colors in (2, 3, 16, 17, 256):
+            palette = [rgba(i, i, i, 255) for i in range(colors)]
+            # Widths that don't pack evenly into bytes
+            data = bytes(bytearray(i % colors for i in range(7 * 5)))
+            contents = paletted_png(data=data, width=7, height=5,
+                                    palette=palette)
+            decoded = VImageAdapter.from_buffer(contents)
+            self.assertEqual((decoded.width, decoded.height), (7, 5))
+            self.assertEqual(
+                bytearray(decoded.extract_band(0).write_to_memory()),
+                bytearray(data)
+            )
+        self.assertRaises(ValueError, paletted_png, data=b'', width=0,
+                          height=0, palette=[])
 
     def test_suffix(self):
         # Default
@@ -96,6 +248,165 @@ class TestPngRenderer(unittest.TestCase):
         renderer = PngRenderer(suffix='.PNG')
         self.assertEqual(renderer.suffix, '.PNG')
 
+    def test_tempdir(self):
+        # Only OptiPNG needs a temporary file
+        renderer = PngRenderer(png8=True, optimize=False,
+                               tempdir='/nonexistent')
+        contents = renderer.render(image=self.image)
+        self.assertPaletted(contents)
+
+        renderer = PngRenderer(png8=False, optimize=2,
+                               tempdir='/nonexistent')
+        self.assertRaises(OSError, renderer.render, image=self.image)
+
+    def test_batches(self):
+        with NamedTemporaryDir() as tempdir:
+            # Stand-in for optipng, which logs its number of files
+            log = os.path.join(tempdir, 'log')
+            optipng = os.path.join(tempdir, 'optipng')
+            with open(optipng, 'w') as script:
+                script.write('#!/bin/sh\n'
+                             'shift 2\n'
+                             'echo $# >> {0}\n'.format(log))
+            os.chmod(optipng, 0o755)
+
+            renderer = PngRenderer(png8=False, optimize=2, processes=2,
+                                   tempdir=tempdir)
+            renderer.OPTIPNG = optipng
+            renderer.BATCH_SIZE = 3
+            self.assertEqual(renderer.batch_size, 6)
+
+            contents = renderer.render_all([self.image] * 7)
+            self.assertEqual(contents, [renderer.prerender(self.image)] * 7)
+            with open(log) as lines:
+                self.assertEqual(sorted(int(line) for line in lines),
+                                 [1, 3, 3])
+
+            # Scratch directories are removed
+            self.assertEqual(sorted(os.listdir(tempdir)), ['log', 'optipng'])
+
+        # Without external tools, there is nothing to batch
+        renderer = PngRenderer(png8=False, optimize=False)
+        self.assertEqual(renderer.batch_size, 1)
+
+
+class TestWebpRenderer(unittest.TestCase):
+    def setUp(self):
+        # Translucent 16×16 image
+        self.image = (VImageAdapter.new_rgba(width=16, height=16) +
+                      [10, 20, 30, 200]).cast('uchar')
+
+    def test_simple(self):
+        renderer = WebpRenderer()
+        contents = renderer.render(image=self.image)
+        self.assertEqual(contents[:4], b'RIFF')
+        self.assertEqual(contents[8:12], b'WEBP')
+
+        # Transparency is kept
+        image = VImageAdapter.from_buffer(contents)
+        self.assertEqual(image(0, 0)[3], 200)
+
+    def test_lossless(self):
+        renderer = WebpRenderer(lossless=True, effort=0)
+        contents = renderer.render(image=self.image)
+        self.assertEqual(VImageAdapter.from_buffer(contents).write_to_memory(),
+                         self.image.write_to_memory())
+
+    def test_render_solid(self):
+        renderer = WebpRenderer(quality=50)
+        contents = renderer.render_solid(self.image,
+                                         self.image.write_to_memory()[:4])
+        self.assertEqual(contents[8:12], b'WEBP')
+        # Exact, despite the lossy renderer
+        self.assertEqual(VImageAdapter.from_buffer(contents).write_to_memory(),
+                         self.image.write_to_memory())
+
+    def test_options(self):
+        self.assertRaises(ValueError, WebpRenderer, quality=101)
+        self.assertRaises(ValueError, WebpRenderer, effort=7)
+        self.assertEqual(WebpRenderer().format, 'webp')
+
+    def test_suffix(self):
+        # Default
+        renderer = WebpRenderer()
+        self.assertEqual(renderer.suffix, '.webp')
+
+        # Specified
+        renderer = WebpRenderer(suffix='.WEBP')
+        self.assertEqual(renderer.suffix, '.WEBP')
+
+
+class TestDataRenderer(unittest.TestCase):
+    def setUp(self):
+        values = numpy.linspace(-100.5, 8848.25, 256 * 256,
+                                dtype=numpy.float32)
+        mask = (numpy.arange(256 * 256) % 3 != 0).astype(numpy.float32)
+        self.image = Image.new_from_memory(
+            numpy.stack([values, mask], axis=1).tobytes(),
+            256, 256, 2, 'float'
+        )
+
+    def test_simple(self):
+        for compression in DataRenderer.COMPRESSIONS:
+            renderer = DataRenderer(compression=compression)
+            contents = renderer.render(self.image)
+            self.assertEqual(contents[:4], b'II*\x00')
+            # Lossless
+            decoded = Image.new_from_buffer(contents, '')
+            self.assertEqual(decoded.format, 'float')
+            self.assertEqual(decoded.bands, 2)
+            self.assertEqual(decoded.write_to_memory(),
+                             self.image.write_to_memory())
+
+        # Integer values
+        image = (self.image * 10).cast('ushort')
+        decoded = Image.new_from_buffer(DataRenderer().render(image), '')
+        self.assertEqual(decoded.format, 'ushort')
+        self.assertEqual(decoded.write_to_memory(), image.write_to_memory())
+
+    def test_options(self):
+        self.assertRaises(ValueError, DataRenderer, compression='jpeg')
+        self.assertEqual(DataRenderer().format, 'tiff')
+        self.assertEqual(DataRenderer().suffix, '.tif')
+
+
+class TestHybridRenderer(unittest.TestCase):
+    def setUp(self):
+        self.opaque = (VImageAdapter.new_rgba(width=16, height=16) +
+                       [10, 20, 30, 255]).cast('uchar')
+        self.translucent = (VImageAdapter.new_rgba(width=16, height=16) +
+                            [10, 20, 30, 200]).cast('uchar')
+
+    def test_simple(self):
+        renderer = HybridRenderer()
+        self.assertTrue(renderer.render(image=self.opaque)
+                        .startswith(b'\xff\xd8\xff'))
+        self.assertTrue(renderer.render(image=self.translucent)
+                        .startswith(b'\x89PNG'))
+
+    def test_is_opaque(self):
+        self.assertTrue(HybridRenderer.is_opaque(self.opaque))
+        self.assertFalse(HybridRenderer.is_opaque(self.translucent))
+        rgb = self.opaque.extract_band(0, n=3)
+        self.assertTrue(HybridRenderer.is_opaque(rgb))
+
+    def test_render_all(self):
+        renderer = HybridRenderer(opaque=WebpRenderer())
+        contents = renderer.render_all([self.translucent, self.opaque,
+                                        self.translucent])
+        self.assertTrue(contents[0].startswith(b'\x89PNG'))
+        self.assertEqual(contents[1][8:12], b'WEBP')
+        self.assertTrue(contents[2].startswith(b'\x89PNG'))
+
+    def test_formats(self):
+        renderer = HybridRenderer()
+        self.assertEqual(renderer.format, 'png')
+        self.assertEqual(renderer.formats, ('jpg', 'png'))
+        self.assertEqual(HybridRenderer(opaque=WebpRenderer()).formats,
+                         ('webp', 'png'))
+        self.assertEqual(PngRenderer().formats, ('png',))
+        self.assertEqual(TouchRenderer().formats, ())
+
 
 class TestTouchRenderer(unittest.TestCase):
     def test_simple(self):
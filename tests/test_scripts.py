@@ -5,7 +5,7 @@ from __future__ import (absolute_import, division, print_function,
 
 import os
 import pytest
-from subprocess import CalledProcessError, check_call
+from subprocess import CalledProcessError, check_call, check_output
 import sys
 from tempfile import NamedTemporaryFile
 import unittest
@@ -89,6 +89,106 @@ class TestGdal2mbtilesScript(unittest.TestCase):
                                      'x-maxzoom': '0',
                                  })
 
+    def test_diff_apply(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as old, \
+                NamedTemporaryFile(suffix='.mbtiles') as new, \
+                NamedTemporaryFile(suffix='.mbtiles') as patch:
+            check_call([sys.executable, self.script,
+                        self.inputfile, old.name], env=self.environ)
+            check_call([sys.executable, self.script,
+                        '--max-resolution', '1',
+                        self.inputfile, new.name], env=self.environ)
+
+            check_call([sys.executable, self.script, 'diff',
+                        old.name, new.name, patch.name], env=self.environ)
+            check_call([sys.executable, self.script, 'apply',
+                        old.name, patch.name], env=self.environ)
+
+            with MBTiles(old.name) as patched, MBTiles(new.name) as expected:
+                self.assertEqual(list(patched.all()), list(expected.all()))
+                self.assertEqual(patched.metadata, expected.metadata)
+
+    def test_extract(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as source, \
+                NamedTemporaryFile(suffix='.mbtiles') as dest:
+            check_call([sys.executable, self.script,
+                        '--min-resolution', '0', '--max-resolution', '2',
+                        self.inputfile, source.name], env=self.environ)
+
+            # North-east quarter of the world, from zoom level 1
+            check_call([sys.executable, self.script, 'extract',
+                        '--bounds', '0', '0', '180', '85',
+                        '--min-zoom', '1',
+                        source.name, dest.name], env=self.environ)
+
+            with MBTiles(dest.name) as mbtiles:
+                self.assertEqual(
+                    sorted((z, x, y) for z, x, y, data in mbtiles.all()),
+                    [(1, 1, 1),
+                     (2, 2, 2), (2, 2, 3), (2, 3, 2), (2, 3, 3)]
+                )
+
+    def test_overviews(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as output:
+            check_call([sys.executable, self.script,
+                        '--min-resolution', '2', '--max-resolution', '2',
+                        self.inputfile, output.name], env=self.environ)
+            check_call([sys.executable, self.script, 'overviews',
+                        '--kernel', 'nearest', '--processes', '2',
+                        output.name], env=self.environ)
+
+            with MBTiles(output.name) as mbtiles:
+                self.assertEqual(mbtiles.zoom_levels(), [0, 1, 2])
+                self.assertEqual(mbtiles.metadata['x-minzoom'], '0')
+                self.assertEqual(mbtiles.metadata['x-maxzoom'], '2')
+
+    def test_transcode(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as output:
+            check_call([sys.executable, self.script, self.inputfile,
+                        output.name], env=self.environ)
+            with MBTiles(output.name) as mbtiles:
+                tiles = sorted((z, x, y) for z, x, y, data in mbtiles.all())
+
+            check_call([sys.executable, self.script, 'transcode',
+                        '--format', 'jpg', '--jpeg-quality', '90',
+                        output.name], env=self.environ)
+
+            with MBTiles(output.name) as mbtiles:
+                self.assertEqual(mbtiles.metadata['format'], 'jpg')
+                self.assertEqual(
+                    sorted((z, x, y) for z, x, y, data in mbtiles.all()),
+                    tiles
+                )
+                for z, x, y, data in mbtiles.all():
+                    self.assertEqual(bytes(data[:2]), b'\xff\xd8')
+
+            check_call([sys.executable, self.script, 'transcode',
+                        '--format', 'webp', '--webp-effort', '0',
+                        output.name], env=self.environ)
+
+            with MBTiles(output.name) as mbtiles:
+                self.assertEqual(mbtiles.metadata['format'], 'webp')
+                for z, x, y, data in mbtiles.all():
+                    self.assertEqual(bytes(data[:4]), b'RIFF')
+
+    def test_tune(self):
+        with NamedTemporaryFile(suffix='.mbtiles') as output:
+            check_call([sys.executable, self.script, self.inputfile,
+                        output.name], env=self.environ)
+            report = check_output([sys.executable, self.script, 'tune',
+                                   '--count', '10', '--format', 'png',
+                                   '--format', 'webp', output.name],
+                                  env=self.environ).decode('utf-8')
+
+        lines = report.splitlines()
+        self.assertTrue(lines[0].startswith('SETTINGS'))
+        self.assertTrue(any(line.startswith('png compression=9')
+                            for line in lines))
+        self.assertTrue(any(line.startswith('webp lossless')
+                            for line in lines))
+        self.assertFalse(any(line.startswith('jpg') for line in lines))
+        self.assertTrue(lines[-1].startswith('Recommended: '))
+
     def test_warp(self):
         null = open('/dev/null', 'r+')
 
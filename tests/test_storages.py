@@ -9,7 +9,8 @@ from shutil import rmtree
 from tempfile import NamedTemporaryFile
 import unittest
 
-from gdal2mbtiles.mbtiles import Metadata
+from gdal2mbtiles.caches import TileCache
+from gdal2mbtiles.mbtiles import MBTiles, Metadata, tile_id
 from gdal2mbtiles.renderers import PngRenderer, TouchRenderer
 from gdal2mbtiles.storages import (MbtilesStorage,
                                    NestedFileStorage, SimpleFileStorage)
@@ -306,8 +307,8 @@ class TestMbtilesStorage(unittest.TestCase):
             [(z, x, y, intmd5(data))
              for z, x, y, data in self.storage.mbtiles.all()],
             [
-                (2, 0, 1, 89446660811628514001822794642426893173),
-                (2, 1, 0, 89446660811628514001822794642426893173),
+                (2, 0, 1, 263144120123797388684789708545857402140),
+                (2, 1, 0, 263144120123797388684789708545857402140),
             ]
         )
 
@@ -323,8 +324,8 @@ class TestMbtilesStorage(unittest.TestCase):
             [(z, x, y, intmd5(data))
              for z, x, y, data in storage.mbtiles.all()],
             [
-                (2, 0, 1, 89446660811628514001822794642426893173),
-                (2, 1, 0, 89446660811628514001822794642426893173),
+                (2, 0, 1, 263144120123797388684789708545857402140),
+                (2, 1, 0, 263144120123797388684789708545857402140),
             ]
         )
 
@@ -342,3 +343,229 @@ class TestMbtilesStorage(unittest.TestCase):
                 (1, 0, 1, 182760986852492185208562855341207287999),
             ]
         )
+
+    def test_staging(self):
+        # Transparent 1×1 image
+        image = VImageAdapter.new_rgba(width=1, height=1,
+                                       ink=rgba(r=0, g=0, b=0, a=0))
+
+        storage = MbtilesStorage.create(renderer=self.renderer,
+                                        filename=self.tempfile.name,
+                                        metadata=self.metadata,
+                                        staging=':memory:',
+                                        checkpoint=2)
+        self.assertEqual(storage.filename, self.tempfile.name)
+        self.assertEqual(storage.mbtiles.filename, ':memory:')
+
+        def saved():
+            with MBTiles(filename=self.tempfile.name) as mbtiles:
+                return [(z, x, y) for z, x, y, data in mbtiles.all()]
+
+        # Nothing reaches the target until a checkpoint
+        storage.save(x=0, y=1, z=2, image=image)
+        self.assertEqual(saved(), [])
+        storage.save(x=1, y=0, z=2, image=image)
+        self.assertEqual(saved(), [(2, 0, 1), (2, 1, 0)])
+
+        # ...or until the storage is closed
+        storage.save(x=1, y=1, z=2, image=image)
+        self.assertEqual(saved(), [(2, 0, 1), (2, 1, 0)])
+        storage.close()
+        self.assertEqual(saved(), [(2, 0, 1), (2, 1, 0), (2, 1, 1)])
+
+    def test_staging_memory_limit(self):
+        image = VImageAdapter.new_rgba(width=1, height=1,
+                                       ink=rgba(r=0, g=0, b=0, a=0))
+
+        with MbtilesStorage.create(renderer=self.renderer,
+                                   filename=self.tempfile.name,
+                                   metadata=self.metadata,
+                                   staging=':memory:',
+                                   memory_limit=1) as storage:
+            # The size is only checked every MEMORY_CHECK_INTERVAL tiles
+            storage.save(x=0, y=0, z=2, image=image)
+            self.assertEqual(storage.target, self.tempfile.name)
+
+            # Spills into the target once it has grown too big
+            storage.MEMORY_CHECK_INTERVAL = 2
+            storage.save(x=0, y=1, z=2, image=image)
+            self.assertEqual(storage.target, None)
+            self.assertEqual(storage.mbtiles.filename, self.tempfile.name)
+            storage.save(x=1, y=0, z=2, image=image)
+
+        with MBTiles(filename=self.tempfile.name) as mbtiles:
+            self.assertEqual([(z, x, y) for z, x, y, data in mbtiles.all()],
+                             [(2, 0, 0), (2, 0, 1), (2, 1, 0)])
+
+    def test_staging_file(self):
+        image = VImageAdapter.new_rgba(width=1, height=1,
+                                       ink=rgba(r=0, g=0, b=0, a=0))
+
+        for memory_limit in (None, 1):
+            with NamedTemporaryDir() as tempdir:
+                staging = os.path.join(tempdir, 'staging.mbtiles')
+                storage = MbtilesStorage.create(renderer=self.renderer,
+                                                filename=self.tempfile.name,
+                                                metadata=self.metadata,
+                                                staging=staging,
+                                                memory_limit=memory_limit)
+                storage.MEMORY_CHECK_INTERVAL = 1
+                storage.save(x=0, y=1, z=2, image=image)
+                # Removed after spilling into the target...
+                self.assertEqual(os.path.exists(staging),
+                                 memory_limit is None)
+                storage.close()
+                # ...or after being copied into it on close
+                self.assertFalse(os.path.exists(staging))
+
+            with MBTiles(filename=self.tempfile.name) as mbtiles:
+                self.assertEqual(
+                    [(z, x, y) for z, x, y, data in mbtiles.all()],
+                    [(2, 0, 1)]
+                )
+
+    def test_append(self):
+        # Transparent 1×1 image
+        image = VImageAdapter.new_rgba(width=1, height=1,
+                                       ink=rgba(r=0, g=0, b=0, a=0))
+        hashed = self.storage.get_hash(image)
+
+        storage = MbtilesStorage.create(renderer=self.renderer,
+                                        filename=self.tempfile.name,
+                                        metadata=self.metadata)
+        storage.save(x=0, y=0, z=0, image=image)
+        storage.close()
+
+        # Existing images are not rendered again
+        storage = MbtilesStorage.append(renderer=None,
+                                        filename=self.tempfile.name)
+        self.assertEqual(storage.seen, set([tile_id(hashed)]))
+        storage.save(x=0, y=1, z=1, image=image)
+        self.assertEqual(
+            [(z, x, y, intmd5(data))
+             for z, x, y, data in storage.mbtiles.all()],
+            [
+                (0, 0, 0, 263144120123797388684789708545857402140),
+                (1, 0, 1, 263144120123797388684789708545857402140),
+            ]
+        )
+        self.assertEqual(storage.mbtiles.metadata, self.metadata)
+        storage.close()
+
+    def test_batches(self):
+        class BatchRenderer(PngRenderer):
+            batch_size = 2
+            batches = []
+
+            def postrender(self, contents):
+                self.batches.append(len(contents))
+                return contents
+
+        renderer = BatchRenderer(png8=False, optimize=False)
+        storage = MbtilesStorage.create(renderer=renderer,
+                                        filename=self.tempfile.name,
+                                        metadata=self.metadata)
+        # Two colours, so that they aren't rendered as solid tiles
+        images = [VImageAdapter.new_rgba(width=2, height=1).insert(
+                      (VImageAdapter.new_rgba(width=1, height=1) +
+                       [i, 0, 0, 255]).cast('uchar'), 0, 0
+                  )
+                  for i in range(3)]
+        for x, i in enumerate([0, 1, 0, 2]):
+            storage.save(x=x, y=0, z=2, image=images[i])
+        # The third image is still pending
+        self.assertEqual(renderer.batches, [2])
+        storage.close()
+        self.assertEqual(renderer.batches, [2, 1])
+
+        with MBTiles(filename=self.tempfile.name) as mbtiles:
+            self.assertEqual(
+                [(z, x, y, data) for z, x, y, data in mbtiles.all()],
+                [(2, x, 0, renderer.prerender(images[i]))
+                 for x, i in enumerate([0, 1, 0, 2])]
+            )
+
+    def test_solid(self):
+        images = [(VImageAdapter.new_rgba(width=16, height=16) +
+                   [i, 0, 0, 255]).cast('uchar')
+                  for i in range(2)]
+        hashes = [self.storage.get_hash(image) for image in images]
+        self.assertEqual(hashes, [intmd5(image.write_to_memory())
+                                  for image in images])
+
+        # Hashed once per colour
+        hashed = []
+        self.storage.hasher = lambda data: hashed.append(data) or 0
+        self.assertEqual(self.storage.get_hash(images[0]), hashes[0])
+        self.assertEqual(hashed, [])
+
+        # Images with more than one colour are always hashed
+        image = images[0].insert(images[1].crop(0, 0, 1, 1), 8, 8)
+        self.storage.get_hash(image)
+        self.assertEqual(len(hashed), 1)
+
+        # Solid tiles are minimal PNGs
+        self.storage.save(x=0, y=0, z=0, image=images[1])
+        data = self.storage.mbtiles.get(x=0, y=0, z=0)
+        self.assertEqual(
+            bytes(data),
+            self.renderer.render_solid(images[1], b'\x01\x00\x00\xff')
+        )
+
+    def test_solid_rendered_once(self):
+        rendered = []
+
+        class CountingRenderer(PngRenderer):
+            def render_solid(self, image, pixel):
+                rendered.append(pixel)
+                return super(CountingRenderer, self).render_solid(image,
+                                                                  pixel)
+
+        storage = MbtilesStorage.create(renderer=CountingRenderer(),
+                                        filename=':memory:',
+                                        metadata=self.metadata)
+        image = (VImageAdapter.new_rgba(width=16, height=16) +
+                 [1, 0, 0, 255]).cast('uchar')
+        hashed = storage.get_hash(image)
+        contents = storage.render(image=image, hashed=hashed)
+        self.assertEqual(storage.render(image=image, hashed=hashed),
+                         contents)
+        self.assertEqual(len(rendered), 1)
+
+        # Other settings render it again
+        storage.renderer = CountingRenderer(compression=1)
+        storage.render(image=image, hashed=hashed)
+        self.assertEqual(len(rendered), 2)
+
+    def test_cache(self):
+        rendered = []
+
+        class CountingRenderer(PngRenderer):
+            def render(self, image):
+                rendered.append(image)
+                return super(CountingRenderer, self).render(image)
+
+        # Two colours, so that they aren't rendered as solid tiles
+        images = [VImageAdapter.new_rgba(width=2, height=1).insert(
+                      (VImageAdapter.new_rgba(width=1, height=1) +
+                       [i, 0, 0, 255]).cast('uchar'), 0, 0
+                  )
+                  for i in range(2)]
+        with NamedTemporaryDir() as cachedir:
+            for renderer, count in [(CountingRenderer(), 2),
+                                    (CountingRenderer(), 0),
+                                    (CountingRenderer(png8=16), 2)]:
+                del rendered[:]
+                cache = TileCache(directory=cachedir)
+                storage = MbtilesStorage.create(renderer=renderer,
+                                                filename=':memory:',
+                                                metadata=self.metadata,
+                                                cache=cache)
+                for x, image in enumerate(images):
+                    storage.save(x=x, y=0, z=1, image=image)
+                self.assertEqual(len(rendered), count)
+                self.assertEqual(
+                    storage.mbtiles.get(x=1, y=0, z=1),
+                    renderer.render(images[1])
+                )
+                storage.close()
@@ -4,6 +4,7 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import pytest
 
+import json
 import os
 import unittest
 
@@ -14,7 +15,8 @@ from gdal2mbtiles.gdal import Dataset
 from gdal2mbtiles.storages import Storage
 from gdal2mbtiles.gd_types import rgba, XY
 from gdal2mbtiles.vips import (ColorExact, ColorGradient, ColorPalette,
-                               LibVips, TmsTiles, VImageAdapter, VipsDataset, VIPS)
+                               LibVips, TmsTiles, VImageAdapter, VipsDataset, VIPS,
+                               reduce_tiles)
 
 from tests.test_gdal import TestCase as GdalTestCase
 
@@ -149,6 +151,13 @@ class TestVImageAdapter(unittest.TestCase):
         self.assertEqual(result.width, image.width * 2)
         self.assertEqual(result.height, image.height * 2)
 
+        # Single band, like palette indexes
+        result = VImageAdapter(image.extract_band(0)).tms_align(
+            tile_width=32, tile_height=32, offset=XY(1, 1)
+        )
+        self.assertEqual(result.bands, 1)
+        self.assertEqual(result.width, image.width * 2)
+
 
 class TestVipsDataset(GdalTestCase):
     def setUp(self):
@@ -176,6 +185,23 @@ class TestVipsDataset(GdalTestCase):
         self.assertEqual(dataset.RasterXSize, 512)
         self.assertEqual(dataset.RasterYSize, 512)
 
+    def test_extract_values(self):
+        dataset = VipsDataset(inputfile=os.path.join(__dir__,
+                                                     'srtm.nodata.tif'))
+        nodata = dataset.GetRasterBand(1).GetNoDataValue()
+        dataset.extract_values()
+        self.assertTrue(dataset.values)
+
+        image = dataset.image
+        self.assertEqual(image.bands, 2)
+        self.assertEqual(image.format, 'short')
+        data = numpy.ndarray(shape=(image.height, image.width, 2),
+                             buffer=image.write_to_memory(),
+                             dtype=numpy.int16)
+        # Masked out exactly where there is no data
+        self.assertTrue(((data[..., 0] == nodata) ==
+                         (data[..., 1] == 0)).all())
+
     @pytest.mark.newtest
     def test_downsample(self):
         """
@@ -331,6 +357,27 @@ class TestTmsTiles(unittest.TestCase):
         self.assertRaises(AssertionError,
                           tiles.downsample, levels=3)
 
+    def test_downsample_indexed(self):
+        # Palette indexes 1 and 3 in a checkerboard of single pixels
+        array = numpy.indices((TILE_SIDE * 2, TILE_SIDE * 2)).sum(axis=0)
+        image = VImageAdapter.from_numpy_array(
+            array=1 + 2 * (array % 2), width=TILE_SIDE * 2,
+            height=TILE_SIDE * 2, bands=1, format='uchar'
+        )
+        tiles = TmsTiles(image=image,
+                         storage=Storage(renderer=None),
+                         tile_width=TILE_SIDE, tile_height=TILE_SIDE,
+                         offset=XY(0, 0),
+                         resolution=1,
+                         indexed=True)
+        downsampled = tiles.downsample()
+        self.assertTrue(downsampled.indexed)
+        self.assertEqual(downsampled.image.bands, 1)
+        # Indexes are picked, never averaged into index 2
+        indexes = set(bytearray(downsampled.image.write_to_memory()))
+        self.assertTrue(indexes)
+        self.assertTrue(indexes <= set([1, 3]))
+
     def test_upsample(self):
         resolution = 0
         image = VImageAdapter.new_rgba(width=TILE_SIDE * 2 ** resolution,
@@ -371,6 +418,99 @@ class TestTmsTiles(unittest.TestCase):
         self.assertEqual(tiles2.resolution,
                          resolution + 2)
 
+    def test_order(self):
+        class RecordingStorage(Storage):
+            def save(self, x, y, z, image):
+                self.saved.append((x, y))
+
+        # Not a multiple of HILBERT_STRIP_TILES in either direction
+        width, height = 20, 17
+        image = VImageAdapter.new_rgba(width=width, height=height)
+
+        self.assertRaises(ValueError,
+                          TmsTiles, image=image,
+                          storage=Storage(renderer=None),
+                          tile_width=1, tile_height=1,
+                          offset=XY(0, 0), resolution=0, order='spiral')
+
+        saved = {}
+        for order in TmsTiles.ORDERS:
+            storage = RecordingStorage(renderer=None)
+            storage.saved = []
+            tiles = TmsTiles(image=image,
+                             storage=storage,
+                             tile_width=1, tile_height=1,
+                             offset=XY(0, 0), resolution=0, order=order)
+            self.assertEqual(tiles.order, order)
+            self.assertEqual(tiles.upsample().order, order)
+            tiles._slice()
+            saved[order] = storage.saved
+
+        # Same tiles, written exactly once each
+        self.assertEqual(len(saved['hilbert']), width * height)
+        self.assertEqual(set(saved['hilbert']), set(saved['row']))
+
+        # Within a full block, each tile neighbours the previous one
+        side = TmsTiles.HILBERT_STRIP_TILES
+        block = saved['hilbert'][:side * side]
+        for (x1, y1), (x2, y2) in zip(block, block[1:]):
+            self.assertEqual(abs(x1 - x2) + abs(y1 - y2), 1)
+
+    def test_order_partial_tiles(self):
+        # Partial tiles at the right and bottom edges are kept in both orders
+        image = VImageAdapter.new_rgba(width=5, height=3)
+        tiles = TmsTiles(image=image,
+                         storage=Storage(renderer=None),
+                         tile_width=2, tile_height=2,
+                         offset=XY(0, 0), resolution=0, order='hilbert')
+        self.assertEqual(sorted(tiles._hilbert_positions()),
+                         sorted(tiles._row_positions()))
+        self.assertEqual(len(list(tiles._hilbert_positions())), 6)
+
+
+class TestReduceTiles(unittest.TestCase):
+    def tile(self, color, suffix='.png'):
+        image = VImageAdapter.new_rgba(width=TILE_SIDE, height=TILE_SIDE)
+        image = (image + list(color)).cast('uchar')
+        if suffix == '.jpg':
+            image = image.extract_band(0, n=3)
+        return image.write_to_buffer(suffix)
+
+    def test_quadrants(self):
+        red = self.tile(rgba(255, 0, 0, 255))
+        green = self.tile(rgba(0, 255, 0, 128))
+        blue = self.tile(rgba(0, 0, 255, 255), suffix='.jpg')
+
+        for kernel in ('nearest', 'linear', 'lanczos3'):
+            image = reduce_tiles(upper_left=red, upper_right=green,
+                                 lower_left=blue, lower_right=None,
+                                 kernel=kernel)
+            self.assertEqual((image.width, image.height, image.bands),
+                             (TILE_SIDE, TILE_SIDE, 4))
+            self.assertEqual(image.format, 'uchar')
+
+            quarter = TILE_SIDE // 4
+            self.assertEqual(image(quarter, quarter), [255, 0, 0, 255])
+            self.assertEqual(image(3 * quarter, quarter), [0, 255, 0, 128])
+            # JPEG tiles are opaque
+            self.assertEqual(image(quarter, 3 * quarter)[3], 255)
+            # Missing tiles are transparent
+            self.assertEqual(image(3 * quarter, 3 * quarter)[3], 0)
+
+    def test_premultiplied(self):
+        red = self.tile(rgba(255, 0, 0, 255))
+        image = reduce_tiles(upper_left=red, upper_right=None,
+                             lower_left=None, lower_right=None,
+                             kernel='linear')
+        # Transparent pixels don't darken the edge
+        edge = image(TILE_SIDE // 2 - 1, 0)
+        self.assertEqual(edge[:3], [255, 0, 0])
+        self.assertTrue(0 < edge[3] < 255)
+
+    def test_kernel(self):
+        self.assertRaises(ValueError, reduce_tiles,
+                          None, None, None, None, kernel='bogus')
+
 
 class TestColors(unittest.TestCase):
     def setUp(self):
@@ -381,6 +521,13 @@ class TestColors(unittest.TestCase):
         self.blue = rgba(0, 0, 255, 255)
         self.white = rgba(255, 255, 255, 255)
 
+    def test_to_json(self):
+        colors = ColorGradient({10: self.white, 0: self.transparent})
+        self.assertEqual(json.loads(colors.to_json()), {
+            'coloring': 'ColorGradient',
+            'colors': [[0, '#00000000'], [10, '#ffffffff']],
+        })
+
     def test_exact_0(self):
         # Empty
         colors = ColorExact()
@@ -643,6 +790,83 @@ class TestColors(unittest.TestCase):
                 false=ColorPalette.BACKGROUND.a
             ))
 
+    def _indexed(self, colors, values, nodata=None):
+        """Returns (indexes, palette) for a row of `values`."""
+        image = VImageAdapter.from_numpy_array(
+            array=numpy.array(values), width=len(values), height=1, bands=1,
+            format='int'
+        )
+        index, palette = colors.colorize_indexed(image=image, nodata=nodata)
+        self.assertEqual((index.bands, index.format), (1, 'uchar'))
+        return list(bytearray(index.write_to_memory())), palette
+
+    def test_exact_indexed(self):
+        colors = ColorExact({0: self.red,
+                             2: self.green,
+                             4: self.red,
+                             6: self.transparent})
+        indexes, palette = self._indexed(colors, [-1, 0, 1, 2, 3, 4, 6])
+        self.assertEqual(palette,
+                         [ColorExact.BACKGROUND, self.red, self.green])
+        self.assertEqual(indexes, [0, 1, 0, 2, 0, 1, 0])
+
+        # With nodata
+        indexes, palette = self._indexed(colors, [0, 2, 4], nodata=2)
+        self.assertEqual(palette, [ColorExact.BACKGROUND, self.red])
+        self.assertEqual(indexes, [1, 0, 1])
+
+        # Empty
+        indexes, palette = self._indexed(ColorExact(), [0, 1])
+        self.assertEqual(palette, [ColorExact.BACKGROUND])
+        self.assertEqual(indexes, [0, 0])
+
+    def test_palette_indexed(self):
+        colors = ColorPalette({0: self.transparent,
+                               1: self.red,
+                               2: self.red,
+                               3: self.green,
+                               5: self.red})
+        indexes, palette = self._indexed(colors,
+                                         [-1, 0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(palette,
+                         [ColorPalette.BACKGROUND, self.red, self.green])
+        self.assertEqual(indexes, [0, 0, 1, 1, 2, 2, 1, 1])
+
+        # With nodata
+        indexes, palette = self._indexed(colors, [1, 3, 4], nodata=3)
+        self.assertEqual(indexes, [1, 0, 2])
+
+    def test_indexed_many(self):
+        # Every index is used, which nested expressions couldn't handle
+        colors = [rgba(r=i, g=255 - i, b=0, a=255) for i in range(255)]
+        values = list(range(-1, 256))
+
+        indexes, palette = self._indexed(
+            ColorExact(dict(zip(range(255), colors))), values
+        )
+        self.assertEqual(palette, [ColorExact.BACKGROUND] + colors)
+        self.assertEqual(indexes, [0] + list(range(1, 256)) + [0])
+
+        indexes, palette = self._indexed(
+            ColorPalette(dict(zip(range(0, 510, 2), colors))), values,
+            nodata=100
+        )
+        self.assertEqual(palette, [ColorPalette.BACKGROUND] + colors)
+        self.assertEqual(indexes,
+                         [0] + [v // 2 + 1 if v != 100 else 0
+                                for v in values[1:]])
+
+        self.assertRaises(
+            ValueError, self._indexed,
+            ColorExact(dict((i, rgba(r=i, g=i // 256, b=0, a=255))
+                            for i in range(256))),
+            [0]
+        )
+
+    def test_gradient_indexed(self):
+        self.assertRaises(NotImplementedError, self._indexed,
+                          ColorGradient({0: self.red}), [0])
+
     def test_gradient_0(self):
         # Empty
         colors = ColorGradient()